@@ -0,0 +1,63 @@
+package ApkPatcher;
+
+import java.lang.management.ManagementFactory;
+import java.lang.management.ThreadMXBean;
+import java.util.LinkedHashMap;
+import java.util.Map;
+
+
+/**
+ * Measurements of a single operation, taken on the thread running it.
+ * The clocks start when the object is created, and {@link #finish()} returns:
+ * <ul>
+ *      <li><b>wall_ns</b>: elapsed time, in nanoseconds</li>
+ *      <li><b>cpu_ns</b>: CPU time of the thread, in nanoseconds (only if the JVM supports it)</li>
+ *      <li><b>heap_used</b>: Bytes in use in the JVM heap at the end</li>
+ *      <li>Any other value added with {@link #put(java.lang.String, long)} (e.g.: "bytes_read", "bytes_written",
+ *      "entries")</li>
+ * </ul>
+ */
+public class OperationMetrics {
+
+    private static final ThreadMXBean THREADS = ManagementFactory.getThreadMXBean ();
+
+    private final Map<String, Long> values = new LinkedHashMap<> ();
+    private final long wallStart;
+    private final long cpuStart;
+
+    public OperationMetrics () {
+
+        wallStart = System.nanoTime ();
+        cpuStart = THREADS.isCurrentThreadCpuTimeSupported () ? THREADS.getCurrentThreadCpuTime () : -1;
+    }
+
+    /**
+     * Adds (or replaces) a measurement.
+     *
+     * @return This same object.
+     */
+    public OperationMetrics put (String name, long value) {
+
+        values.put (name, Long.valueOf (value));
+        return this;
+    }
+
+    /**
+     * Stops the clocks.
+     *
+     * @return All the measurements, by name.
+     */
+    public Map<String, Long> finish () {
+
+        values.put ("wall_ns", Long.valueOf (System.nanoTime () - wallStart));
+
+        if (cpuStart >= 0) {
+            values.put ("cpu_ns", Long.valueOf (THREADS.getCurrentThreadCpuTime () - cpuStart));
+        }
+
+        Runtime runtime = Runtime.getRuntime ();
+        values.put ("heap_used", Long.valueOf (runtime.totalMemory () - runtime.freeMemory ()));
+
+        return values;
+    }
+}
@@ -26,31 +26,66 @@ import com.android.tools.smali.dexlib2.rewriter.Rewriters;
 import com.android.tools.smali.dexlib2.writer.io.MemoryDataStore;
 import com.android.tools.smali.dexlib2.writer.pool.DexPool;
 import com.iyxan23.zipalignjava.InvalidZipException;
-import com.iyxan23.zipalignjava.ZipAlign;
 import java.io.ByteArrayInputStream;
 import java.io.ByteArrayOutputStream;
 import java.io.File;
-import java.io.FileOutputStream;
 import java.io.IOException;
-import java.io.RandomAccessFile;
+import java.nio.ByteBuffer;
 import java.security.GeneralSecurityException;
 import java.security.KeyFactory;
 import java.security.KeyPairGenerator;
-import java.security.KeyStore;
 import java.security.NoSuchAlgorithmException;
 import java.security.PrivateKey;
 import java.security.PublicKey;
-import java.security.cert.Certificate;
 import java.security.cert.X509Certificate;
 import java.security.interfaces.ECPrivateKey;
 import java.security.spec.ECPublicKeySpec;
 import java.security.spec.InvalidKeySpecException;
 import java.util.ArrayList;
+import java.util.Collections;
+import java.util.LinkedHashSet;
 import java.util.List;
+import java.util.Map;
+import java.util.Set;
 
 
 public class Patcher {
 
+    /* Receiver of the messages and measurements. If it's not set, the messages are printed to stdout */
+    private static volatile Reporter reporter = null;
+
+    /**
+     * Sets the object that receives the log messages and the measurements of every operation (the dex rewrite, the
+     * alignment and the signature), instead of printing them to stdout.
+     *
+     * @param newReporter The new receiver, or null to go back to stdout.
+     */
+    public static void setReporter (Reporter newReporter) {
+
+        reporter = newReporter;
+    }
+
+    /**
+     * Sends a message (and, optionally, the measurements of an operation) to the {@link Reporter}. Without one, only
+     * the message is printed: errors to stderr, and the rest to stdout.
+     *
+     * @see Reporter#report(java.lang.String, java.lang.String, java.lang.String, java.util.Map)
+     */
+    static void report (String level, String event, String message, Map<String, Long> metrics) {
+
+        Reporter current = reporter;
+
+        if (current != null) {
+            current.report (level, event, message, metrics);
+
+        } else if ("ERROR".equals (level)) {
+            System.err.println ("[" + level + "][JAVA] " + message);
+
+        } else {
+            System.out.println ("[" + level + "][JAVA] " + message);
+        }
+    }
+
     /**
      * Adds the following instructions at the beginning of the specified method implementation:
      * <pre>
@@ -123,18 +158,17 @@ public class Patcher {
     }
 
     /**
-     * Patches the given method of the specified class within the provided dex file, and returns the
-     * rewritten copy.
+     * Patches the given methods within the provided dex file, and returns the rewritten copy.
+     * All the targets are applied in the same rewrite, so the file is only parsed and written once.
      *
      * @param input DexFile to patch.
      *
-     * @param classToPatch Class name (e.g.: "Lcom/example/SomeClass;") to target.
-     *
-     * @param methodToPatch Method within the aforementioned class. This will be the target of the rewrite.
+     * @param targets Methods to patch, as "&lt;class name&gt;-&gt;&lt;method name&gt;" (e.g.:
+     *          "Lcom/example/SomeClass;-&gt;&lt;init&gt;"). All the overloads of a method are patched.
      *
      * @return The rewritten DexFile.
      */
-    private static DexFile patchDex (DexBackedDexFile input, String classToPatch, String methodToPatch) {
+    private static DexFile patchDex (DexBackedDexFile input, Set<String> targets) {
 
         DexRewriter rewriter = new DexRewriter (new RewriterModule() {
             @Override
@@ -145,9 +179,7 @@ public class Patcher {
                         DexBackedMethodImplementation methodImpl = (DexBackedMethodImplementation) impl;
                         DexBackedMethod method = methodImpl.method;
 
-                        if (method.getDefiningClass ().equals (classToPatch)
-                            && method.getName ().equals (methodToPatch)
-                        ) {
+                        if (targets.contains (method.getDefiningClass () + "->" + method.getName ())) {
                             return addPreamble (methodImpl);
                         }
                     }
@@ -211,23 +243,27 @@ public class Patcher {
             throw new IOException ("The provided DEX input stream is null.");
         }
         
+        OperationMetrics metrics = new OperationMetrics ();
         ByteArrayOutputStream output = new ByteArrayOutputStream ();
  
         Opcodes opcodes = dexVersion <= 0 ? Opcodes.getDefault () : Opcodes.forDexVersion (dexVersion);
 
-        System.out.println ("[INFO][JAVA] Parsing DEX file " + className + "->" + methodName);
+        report ("INFO", "patchDex", "Parsing DEX file " + className + "->" + methodName, null);
         DexBackedDexFile dex = DexBackedDexFile.fromInputStream (opcodes, dexBytes);
-        System.out.println ("[DEBUG][JAVA] Size of the original DEX: " + dex.getFileSize () + " Bytes");
+        report ("DEBUG", "patchDex", "Size of the original DEX: " + dex.getFileSize () + " Bytes", null);
         
-        DexFile rewritten = patchDex (dex, className, methodName);
+        DexFile rewritten = patchDex (dex, Collections.singleton (className + "->" + methodName));
         
         MemoryDataStore store = new MemoryDataStore ();
         DexPool.writeTo (store, rewritten);
 
-        System.out.println ("[DEBUG][JAVA] Size of the new generated DEX: " + store.getSize () + " Bytes");
-
         output.write (store.getData ());
 
+        metrics.put ("bytes_read", dex.getFileSize ())
+            .put ("bytes_written", store.getSize ())
+            .put ("entries", 1);
+        report ("DEBUG", "patchDex", "Size of the new generated DEX: " + store.getSize () + " Bytes", metrics.finish ());
+
         return output;
     }
     
@@ -239,6 +275,94 @@ public class Patcher {
         return patchDexFile (dexBytes, className, methodName, -1);
     }
 
+    /**
+     * Same as {@link #patchDexFile(java.io.ByteArrayInputStream, java.lang.String, java.lang.String, int) }, but the
+     * data is exchanged through ByteBuffers to avoid the copies of the streams.
+     * <p>
+     * From Python, the input can be any buffer (bytes, a memoryview of a memory-mapped APK...) wrapped with
+     * <code>jpype.nio.convertToDirectBuffer ()</code>, and the output can be read with <code>memoryview ()</code>.
+     * Since dexlib2 needs a byte[], the input is copied once into the Java heap; and the rewritten dex is copied once
+     * into the returned buffer.
+     *
+     * @param dexBuffer Raw bytes of the dex file, from its position to its limit.
+     *
+     * @param className Class name (e.g.: "Lcom/example/SomeClass;") to target.
+     *
+     * @param methodName Method within the aforementioned class. This will be the target of the rewrite.
+     *
+     * @param dexVersion Version of the dex file, or -1 to use the default one.
+     *
+     * @return The rewritten DexFile, in a direct ByteBuffer.
+     *
+     * @throws IOException If the rewritten dex could not be written.
+     */
+    public static ByteBuffer patchDexBuffer (ByteBuffer dexBuffer, String className, String methodName, int dexVersion) throws IOException {
+
+        return patchDexBuffer (dexBuffer, new String[] { className }, new String[] { methodName }, dexVersion);
+    }
+
+    /**
+     * Same as {@link #patchDexBuffer(java.nio.ByteBuffer, java.lang.String, java.lang.String, int) }, but patching
+     * many methods (e.g.: the entry points whose classes live in the same dex) in a single rewrite.
+     *
+     * @param dexBuffer Raw bytes of the dex file, from its position to its limit.
+     *
+     * @param classNames Class names (e.g.: "Lcom/example/SomeClass;") to target.
+     *
+     * @param methodNames Method to patch within each of the aforementioned classes (same length as classNames).
+     *
+     * @param dexVersion Version of the dex file, or -1 to use the default one.
+     *
+     * @return The rewritten DexFile, in a direct ByteBuffer.
+     *
+     * @throws IOException If the rewritten dex could not be written, or the targets are not valid.
+     */
+    public static ByteBuffer patchDexBuffer (ByteBuffer dexBuffer, String[] classNames, String[] methodNames, int dexVersion) throws IOException {
+
+        if (dexBuffer == null) {
+            throw new IOException ("The provided DEX buffer is null.");
+        }
+
+        OperationMetrics metrics = new OperationMetrics ();
+        Opcodes opcodes = dexVersion <= 0 ? Opcodes.getDefault () : Opcodes.forDexVersion (dexVersion);
+
+        /* The position of the caller's buffer is left untouched */
+        int position = dexBuffer.position ();
+        byte[] dexBytes = new byte [dexBuffer.remaining ()];
+        dexBuffer.get (dexBytes);
+        dexBuffer.position (position);
+
+        if (classNames.length != methodNames.length) {
+            throw new IOException ("Got " + classNames.length + " classes, but " + methodNames.length + " methods.");
+        }
+
+        Set<String> targets = new LinkedHashSet<> ();
+        for (int i = 0; i < classNames.length; i++) {
+            targets.add (classNames [i] + "->" + methodNames [i]);
+        }
+
+        report ("INFO", "patchDex", "Parsing DEX file " + targets, null);
+        DexBackedDexFile dex = new DexBackedDexFile (opcodes, dexBytes);
+        report ("DEBUG", "patchDex", "Size of the original DEX: " + dex.getFileSize () + " Bytes", null);
+
+        DexFile rewritten = patchDex (dex, targets);
+
+        MemoryDataStore store = new MemoryDataStore ();
+        DexPool.writeTo (store, rewritten);
+
+        /* getBuffer () returns the internal buffer (which may be bigger than the dex), while getData () copies it */
+        ByteBuffer output = ByteBuffer.allocateDirect (store.getSize ());
+        output.put (store.getBuffer (), 0, store.getSize ());
+        output.flip ();
+
+        metrics.put ("bytes_read", dexBytes.length)
+            .put ("bytes_written", store.getSize ())
+            .put ("entries", targets.size ());
+        report ("DEBUG", "patchDex", "Size of the new generated DEX: " + store.getSize () + " Bytes", metrics.finish ());
+
+        return output;
+    }
+
     // This seems to break shit
 //    /**
 //     * Writes the specified file (given as a full path) on the existing Zip file located at pathToZip with the given data.
@@ -277,26 +401,49 @@ public class Patcher {
 //    }
     
     /**
-     * Modifies the given zip file to align its contents to a 4-Byte boundary
-     * 
+     * Modifies the given zip file to align its contents to a 4-Byte boundary (and the native libraries to 4 KB pages)
+     *
      * @param zipPath Path to the Zip file to be aligned. This file will be overwritten.
-     * 
+     *
      * @throws IOException If the given file does not exist or couldn't be read
      *
      * @throws com.iyxan23.zipalignjava.InvalidZipException If the given file is not a valid Zip file
      */
-    public static void zipAlign (String zipPath) throws IOException, InvalidZipException {
-        
-        RandomAccessFile zipIn = new RandomAccessFile (zipPath, "r");
-        ByteArrayOutputStream aligned_zip = new ByteArrayOutputStream ();
+    public static ZipAligner zipAlign (String zipPath) throws IOException, InvalidZipException {
 
-        ZipAlign.alignZip (zipIn, aligned_zip, 4, true);
+        return zipAlign (zipPath, 4, 4096);
+    }
 
-        System.out.println ("[DEBUG][JAVA] Original Zip file: " + zipIn.length () + " Bytes // Aligned Zip file: " + aligned_zip.size () + " Bytes.");
-        
-        /* Overwrites the original file */        
-        FileOutputStream zipOut = new FileOutputStream (zipPath);
-        aligned_zip.writeTo (zipOut);
+    /**
+     * Modifies the given zip file to align its uncompressed contents.
+     * The aligned file is streamed to a temporary file that then replaces the original one, so the whole APK is never
+     * loaded in memory. See {@link ZipAligner}.
+     *
+     * @param zipPath Path to the Zip file to be aligned. This file will be overwritten.
+     *
+     * @param alignment Alignment (in Bytes) of the uncompressed entries.
+     *
+     * @param soAlignment Alignment (in Bytes) of the uncompressed native libraries (e.g.: 16384 for 16 KB pages).
+     *
+     * @return The aligner, with the sizes and the time spent.
+     *
+     * @throws IOException If the given file does not exist or couldn't be read
+     *
+     * @throws com.iyxan23.zipalignjava.InvalidZipException If the given file is not a valid Zip file
+     */
+    public static ZipAligner zipAlign (String zipPath, int alignment, int soAlignment) throws IOException, InvalidZipException {
+
+        OperationMetrics metrics = new OperationMetrics ();
+        ZipAligner aligner = new ZipAligner (alignment, soAlignment);
+        aligner.align (zipPath);
+
+        metrics.put ("bytes_read", aligner.getInputSize ())
+            .put ("bytes_written", aligner.getOutputSize ())
+            .put ("entries", aligner.getEntryCount ());
+        report ("DEBUG", "zipAlign", "Original Zip file: " + aligner.getInputSize () + " Bytes // Aligned Zip file: "
+            + aligner.getOutputSize () + " Bytes (" + aligner.getElapsedMillis () + " ms).", metrics.finish ());
+
+        return aligner;
     }
 
     
@@ -318,7 +465,7 @@ public class Patcher {
 
         } catch (NoSuchAlgorithmException ex) {
             /* Is there any system where no Elliptic Curve is implemented ?? */
-            System.err.println ("[ERROR][JAVA] Couldn't generate a private key: " + ex.getMessage ());
+            report ("ERROR", "genPrivKey", "Couldn't generate a private key: " + ex.getMessage (), null);
         }
 
         return priv;
@@ -348,7 +495,7 @@ public class Patcher {
             
         } catch (NoSuchAlgorithmException | InvalidKeySpecException ex) {
 
-            System.err.println ("[ERROR][JAVA] Couldn't generate an X.509 certificate from the provided private key: " + ex.getMessage ());
+            report ("ERROR", "genCert", "Couldn't generate an X.509 certificate from the provided private key: " + ex.getMessage (), null);
         }
         
         return cert;
@@ -385,6 +532,7 @@ public class Patcher {
      *      <li>The <b>password</b> of the KeyStore and the private key is always "<b>123456</b>"</li>
      *      <li>The <b>alias</b> of the key is "<b>alias</b>"</li>
      * </ul>
+     * To sign many APKs, use a {@link SigningSession} instead, which only loads the KeyStore once.
      * 
      * @param filename Path to the APK to sign.
      * 
@@ -399,47 +547,14 @@ public class Patcher {
      */
     public static String signApk (String filename, byte[] keyStoreBytes) throws IOException, GeneralSecurityException {
 
-        File apkFile = new File (filename);
         File tmpFile = new File (filename + "_signed.tmp");
 
-        KeyStore store = KeyStore.getInstance ("pkcs12");
-        store.load (
-                new ByteArrayInputStream (keyStoreBytes),
-                "123456".toCharArray ()
-            );
-
-        List<X509Certificate> certs = new ArrayList<>();
-
-        /* If the hardcoded KeyStore is used, this should be a PrivateKey (actually, an RSAPrivateKey, but that doesn't matter)  */
-        PrivateKey privKey = (PrivateKey) store.getKey ("alias", "123456".toCharArray ());
-        Certificate cert = store.getCertificate ("alias");
-
-        certs.add ((X509Certificate) cert);
-
-        List<ApkSigner.SignerConfig> signerConfigs = genSignerConfigs (privKey, certs);
-      
-        ApkSigner signer = new ApkSigner.Builder (signerConfigs)
-                .setDebuggableApkPermitted (true)
-                .setInputApk (apkFile)
-                .setOutputApk (tmpFile)
-                .setV1SigningEnabled (true)
-                .setV2SigningEnabled (true)
-                .setV3SigningEnabled (true)
-//                .setV4SigningEnabled (true)
-//                .setV4ErrorReportingEnabled​ (true)
-//                .setV4SignatureOutputFile (new File (outputFilename + ".idsig"))
-//                .setOtherSignersSignaturesPreserved (true) // Not compatible with v3 Signing
-                .setCreatedBy ("Foo-Manroot/apk-patcher")
-                .build ();
-
         try {
-            signer.sign ();
-
-            System.out.println ("[DEBUG][JAVA] Apk signed.");
+            new SigningSession (keyStoreBytes).sign (filename, tmpFile.getAbsolutePath ());
 
         } catch (IllegalStateException | ApkFormatException ex) {
 
-            System.err.println ("[ERROR][JAVA] Error signing " + filename + ": " + ex.getMessage ());
+            report ("ERROR", "sign", "Error signing " + filename + ": " + ex.getMessage (), null);
         }
 
         return tmpFile.getAbsolutePath ();
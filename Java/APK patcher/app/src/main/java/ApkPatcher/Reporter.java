@@ -0,0 +1,26 @@
+package ApkPatcher;
+
+import java.util.Map;
+
+
+/**
+ * Receives the messages and the measurements of the Java side, so the caller can log and collect them (e.g.: from
+ * Python, through a JPype proxy) instead of reading them from stdout.
+ * <p>
+ * It can be called from many threads at the same time (e.g.: when several APKs are signed concurrently).
+ *
+ * @see Patcher#setReporter(Reporter)
+ */
+public interface Reporter {
+
+    /**
+     * @param level Log level: "DEBUG", "INFO", "WARNING" or "ERROR".
+     *
+     * @param event Operation that generated the report: "patchDex", "zipAlign" or "sign".
+     *
+     * @param message Human-readable description.
+     *
+     * @param metrics Measurements of the operation, or null if it's just a message. See {@link OperationMetrics}.
+     */
+    void report (String level, String event, String message, Map<String, Long> metrics);
+}
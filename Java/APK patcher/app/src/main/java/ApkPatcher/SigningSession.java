@@ -0,0 +1,114 @@
+package ApkPatcher;
+
+import com.android.apksig.ApkSigner;
+import com.android.apksig.apk.ApkFormatException;
+import java.io.ByteArrayInputStream;
+import java.io.File;
+import java.io.IOException;
+import java.security.GeneralSecurityException;
+import java.security.KeyStore;
+import java.security.PrivateKey;
+import java.security.cert.X509Certificate;
+import java.util.ArrayList;
+import java.util.List;
+
+
+/**
+ * Signs many APKs with the same key.
+ * The KeyStore is parsed (and the SignerConfig built) only once, when the session is created, so signing every APK
+ * only costs the signature itself.
+ * <p>
+ * The following <b>assumptions</b> are made about the KeyStore:
+ * <ul>
+ *      <li>It is a PKCS12 key-store</li>
+ *      <li>The <b>password</b> of the KeyStore and the private key is always "<b>123456</b>"</li>
+ *      <li>The <b>alias</b> of the key is "<b>alias</b>"</li>
+ * </ul>
+ */
+public class SigningSession {
+
+    private static final String KEYSTORE_PASSWORD = "123456";
+    private static final String KEY_ALIAS = "alias";
+
+    private final List<ApkSigner.SignerConfig> signerConfigs;
+
+    private boolean v1SigningEnabled = true;
+    private boolean v2SigningEnabled = true;
+    private boolean v3SigningEnabled = true;
+
+    /**
+     * @param keyStoreBytes Raw Bytes of the KeyStore to sign the APKs.
+     *
+     * @throws java.io.IOException If the KeyStore couldn't be read.
+     * @throws GeneralSecurityException If the key or the certificate couldn't be extracted from the KeyStore.
+     */
+    public SigningSession (byte[] keyStoreBytes) throws IOException, GeneralSecurityException {
+
+        KeyStore store = KeyStore.getInstance ("pkcs12");
+        store.load (
+                new ByteArrayInputStream (keyStoreBytes),
+                KEYSTORE_PASSWORD.toCharArray ()
+            );
+
+        /* If the hardcoded KeyStore is used, this should be a PrivateKey (actually, an RSAPrivateKey, but that doesn't matter)  */
+        PrivateKey privKey = (PrivateKey) store.getKey (KEY_ALIAS, KEYSTORE_PASSWORD.toCharArray ());
+
+        List<X509Certificate> certs = new ArrayList<>();
+        certs.add ((X509Certificate) store.getCertificate (KEY_ALIAS));
+
+        signerConfigs = Patcher.genSignerConfigs (privKey, certs);
+    }
+
+    /**
+     * Selects the signature schemes to apply. By default, all of v1 (JAR signing), v2 and v3 are used.
+     * <p>
+     * v1 is only needed by Android versions older than 7.0 (API 24), so it can be skipped for apps with
+     * minSdkVersion &gt;= 24, which saves the digest of every entry for the JAR manifest.
+     *
+     * @return This same session.
+     */
+    public SigningSession setSchemes (boolean v1, boolean v2, boolean v3) {
+
+        v1SigningEnabled = v1;
+        v2SigningEnabled = v2;
+        v3SigningEnabled = v3;
+
+        return this;
+    }
+
+    /**
+     * Signs the APK at inputPath and writes the signed copy to outputPath.
+     *
+     * @param inputPath Path to the APK to sign.
+     *
+     * @param outputPath Path where the signed APK is written. It must be different from inputPath.
+     *
+     * @throws java.io.IOException If the APK couldn't be read or written.
+     * @throws ApkFormatException If the input is not a valid APK.
+     * @throws GeneralSecurityException If the signature process failed.
+     */
+    public void sign (String inputPath, String outputPath) throws IOException, ApkFormatException, GeneralSecurityException {
+
+        OperationMetrics metrics = new OperationMetrics ();
+
+        ApkSigner signer = new ApkSigner.Builder (signerConfigs)
+                .setDebuggableApkPermitted (true)
+                .setInputApk (new File (inputPath))
+                .setOutputApk (new File (outputPath))
+                .setV1SigningEnabled (v1SigningEnabled)
+                .setV2SigningEnabled (v2SigningEnabled)
+                .setV3SigningEnabled (v3SigningEnabled)
+//                .setV4SigningEnabled (true)
+//                .setV4ErrorReportingEnabled (true)
+//                .setV4SignatureOutputFile (new File (outputPath + ".idsig"))
+//                .setOtherSignersSignaturesPreserved (true) // Not compatible with v3 Signing
+                .setCreatedBy ("Foo-Manroot/apk-patcher")
+                .build ();
+
+        signer.sign ();
+
+        metrics.put ("bytes_read", new File (inputPath).length ())
+            .put ("bytes_written", new File (outputPath).length ());
+        Patcher.report ("DEBUG", "sign", "Apk signed: " + outputPath, metrics.finish ());
+    }
+}
@@ -0,0 +1,347 @@
+package ApkPatcher;
+
+import com.iyxan23.zipalignjava.InvalidZipException;
+import java.io.BufferedOutputStream;
+import java.io.File;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.RandomAccessFile;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.StandardCopyOption;
+
+
+/**
+ * Streaming zipalign.
+ * The aligned copy is written to a sibling temporary file using a fixed-size buffer, so the memory used doesn't depend
+ * on the size of the APK, and then renamed over the original file.
+ * <p>
+ * The uncompressed entries are padded using the same extra field as apksigner (0xD935), which also records the
+ * alignment. Zip64 archives are not supported.
+ */
+public class ZipAligner {
+
+    /** Size of the buffer used to copy the data of the entries */
+    public static final int BUFFER_SIZE = 64 * 1024;
+
+    /** ID of the extra field used for the padding */
+    public static final short ALIGNMENT_EXTRA_ID = (short) 0xD935;
+
+    private static final int LOCAL_HEADER_SIGNATURE = 0x04034b50;
+    private static final int CENTRAL_HEADER_SIGNATURE = 0x02014b50;
+    private static final int END_OF_CENTRAL_DIR_SIGNATURE = 0x06054b50;
+    private static final int DATA_DESCRIPTOR_SIGNATURE = 0x08074b50;
+
+    private static final int LOCAL_HEADER_SIZE = 30;
+    private static final int CENTRAL_HEADER_SIZE = 46;
+    private static final int END_OF_CENTRAL_DIR_SIZE = 22;
+
+    private final int alignment;
+    private final int soAlignment;
+    private final byte[] buffer = new byte [BUFFER_SIZE];
+
+    /* Statistics of the last call to align () */
+    private long inputSize = 0;
+    private long outputSize = 0;
+    private int entryCount = 0;
+    private long elapsedMillis = 0;
+
+    /**
+     * @param alignment Alignment (in Bytes) of the uncompressed entries. Android requires 4.
+     *
+     * @param soAlignment Alignment (in Bytes) of the uncompressed native libraries, which must be page-aligned to be
+     *          mapped directly from the APK: 4096 for 4 KB pages, or 16384 for devices with 16 KB pages.
+     */
+    public ZipAligner (int alignment, int soAlignment) {
+
+        this.alignment = alignment;
+        this.soAlignment = soAlignment;
+    }
+
+    public long getInputSize () {
+
+        return inputSize;
+    }
+
+    public long getOutputSize () {
+
+        return outputSize;
+    }
+
+    public int getEntryCount () {
+
+        return entryCount;
+    }
+
+    public long getElapsedMillis () {
+
+        return elapsedMillis;
+    }
+
+    /**
+     * Aligns the given Zip file in place.
+     *
+     * @param zipPath Path to the Zip file to be aligned. It's only replaced once the aligned copy is complete.
+     *
+     * @throws IOException If the file couldn't be read or written.
+     *
+     * @throws com.iyxan23.zipalignjava.InvalidZipException If the given file is not a valid Zip file (or it uses Zip64).
+     */
+    public void align (String zipPath) throws IOException, InvalidZipException {
+
+        long start = System.nanoTime ();
+
+        File zipFile = new File (zipPath);
+        File tmpFile = new File (zipPath + ".aligned.tmp");
+
+        try {
+            try (RandomAccessFile zipIn = new RandomAccessFile (zipFile, "r")) {
+                try (OutputStream zipOut = new BufferedOutputStream (new FileOutputStream (tmpFile), BUFFER_SIZE)) {
+                    inputSize = zipIn.length ();
+                    outputSize = 0;
+                    entryCount = 0;
+                    align (zipIn, zipOut);
+                }
+            }
+
+            Files.move (
+                    tmpFile.toPath (),
+                    zipFile.toPath (),
+                    StandardCopyOption.REPLACE_EXISTING,
+                    StandardCopyOption.ATOMIC_MOVE
+                );
+
+        } finally {
+            Files.deleteIfExists (tmpFile.toPath ());
+        }
+
+        elapsedMillis = (System.nanoTime () - start) / 1000000;
+    }
+
+    /**
+     * Writes the aligned copy of zipIn into zipOut.
+     * The entries are written in the order of the central directory, and everything else (e.g.: an APK Signing Block)
+     * is discarded.
+     */
+    private void align (RandomAccessFile zipIn, OutputStream zipOut) throws IOException, InvalidZipException {
+
+        ByteBuffer eocd = findEndOfCentralDir (zipIn);
+        int entryCount = eocd.getShort (10) & 0xffff;
+        long centralDirSize = eocd.getInt (12) & 0xffffffffL;
+        long centralDirOffset = eocd.getInt (16) & 0xffffffffL;
+
+        if (entryCount == 0xffff || centralDirSize == 0xffffffffL || centralDirOffset == 0xffffffffL) {
+            throw new InvalidZipException ("Zip64 is not supported");
+        }
+
+        ByteBuffer centralDir = read (zipIn, centralDirOffset, (int) centralDirSize);
+        long[] newOffsets = new long [entryCount];
+        this.entryCount = entryCount;
+
+        /* Local headers and data */
+        int position = 0;
+        for (int i = 0; i < entryCount; i++) {
+
+            if (centralDir.getInt (position) != CENTRAL_HEADER_SIGNATURE) {
+                throw new InvalidZipException ("Invalid central directory header at entry " + i);
+            }
+
+            int flags = centralDir.getShort (position + 8) & 0xffff;
+            int method = centralDir.getShort (position + 10) & 0xffff;
+            long compressedSize = centralDir.getInt (position + 20) & 0xffffffffL;
+            int nameLength = centralDir.getShort (position + 28) & 0xffff;
+            int extraLength = centralDir.getShort (position + 30) & 0xffff;
+            int commentLength = centralDir.getShort (position + 32) & 0xffff;
+            long localOffset = centralDir.getInt (position + 42) & 0xffffffffL;
+
+            String name = new String (
+                    centralDir.array (),
+                    position + CENTRAL_HEADER_SIZE,
+                    nameLength,
+                    StandardCharsets.UTF_8
+                );
+
+            newOffsets [i] = outputSize;
+            copyEntry (zipIn, zipOut, name, localOffset, flags, method, compressedSize);
+
+            position += CENTRAL_HEADER_SIZE + nameLength + extraLength + commentLength;
+        }
+
+        /* Central directory, with the new offsets */
+        long newCentralDirOffset = outputSize;
+        position = 0;
+        for (int i = 0; i < entryCount; i++) {
+
+            int entryLength = CENTRAL_HEADER_SIZE
+                + (centralDir.getShort (position + 28) & 0xffff)
+                + (centralDir.getShort (position + 30) & 0xffff)
+                + (centralDir.getShort (position + 32) & 0xffff);
+
+            centralDir.putInt (position + 42, (int) newOffsets [i]);
+            write (zipOut, centralDir.array (), position, entryLength);
+
+            position += entryLength;
+        }
+
+        /* End of central directory (and the Zip comment, if any) */
+        eocd.putInt (16, (int) newCentralDirOffset);
+        write (zipOut, eocd.array (), 0, eocd.capacity ());
+
+        if (outputSize > 0xffffffffL) {
+            throw new InvalidZipException ("The aligned Zip file would require Zip64");
+        }
+    }
+
+    /**
+     * Copies the given entry (local header, data and data descriptor, if any) to the current position of zipOut.
+     * If the entry is not compressed, its extra field is replaced so the data is properly aligned.
+     */
+    private void copyEntry (
+        RandomAccessFile zipIn,
+        OutputStream zipOut,
+        String name,
+        long localOffset,
+        int flags,
+        int method,
+        long compressedSize
+    ) throws IOException, InvalidZipException {
+
+        ByteBuffer header = read (zipIn, localOffset, LOCAL_HEADER_SIZE);
+        if (header.getInt (0) != LOCAL_HEADER_SIGNATURE) {
+            throw new InvalidZipException ("Invalid local header for " + name);
+        }
+
+        int nameLength = header.getShort (26) & 0xffff;
+        int extraLength = header.getShort (28) & 0xffff;
+        ByteBuffer nameAndExtra = read (zipIn, localOffset + LOCAL_HEADER_SIZE, nameLength + extraLength);
+        long dataOffset = localOffset + LOCAL_HEADER_SIZE + nameLength + extraLength;
+
+        byte[] extra = new byte [extraLength];
+        System.arraycopy (nameAndExtra.array (), nameLength, extra, 0, extraLength);
+
+        /* Method 0 -> stored */
+        if (method == 0) {
+            int entryAlignment = name.endsWith (".so") ? soAlignment : alignment;
+            extra = alignExtra (extra, outputSize + LOCAL_HEADER_SIZE + nameLength, entryAlignment);
+        }
+
+        header.putShort (28, (short) extra.length);
+        write (zipOut, header.array (), 0, LOCAL_HEADER_SIZE);
+        write (zipOut, nameAndExtra.array (), 0, nameLength);
+        write (zipOut, extra, 0, extra.length);
+
+        long remaining = compressedSize;
+        /* Flag 0x08 -> the CRC and sizes are in a data descriptor after the data (with an optional signature) */
+        if ((flags & 0x08) != 0) {
+            ByteBuffer descriptor = read (zipIn, dataOffset + compressedSize, 4);
+            remaining += descriptor.getInt (0) == DATA_DESCRIPTOR_SIGNATURE ? 16 : 12;
+        }
+
+        zipIn.seek (dataOffset);
+        while (remaining > 0) {
+            int length = (int) Math.min (remaining, buffer.length);
+            zipIn.readFully (buffer, 0, length);
+            write (zipOut, buffer, 0, length);
+            remaining -= length;
+        }
+    }
+
+    /**
+     * Returns a copy of the given extra field (without any previous alignment padding) with an 0xD935 field at the end,
+     * so the data that comes after it starts at a multiple of `entryAlignment`.
+     *
+     * @param extra Original extra field of the local header.
+     *
+     * @param extraOffset Offset in the output file where the extra field is going to be written.
+     *
+     * @param entryAlignment Required alignment for the data of this entry.
+     */
+    private static byte[] alignExtra (byte[] extra, long extraOffset, int entryAlignment) {
+
+        ByteBuffer original = ByteBuffer.wrap (extra).order (ByteOrder.LITTLE_ENDIAN);
+        ByteBuffer kept = ByteBuffer.allocate (extra.length).order (ByteOrder.LITTLE_ENDIAN);
+
+        /* The padding added by zipalign (zeroes) is not a valid field, so everything from there on is dropped */
+        while (original.remaining () >= 4) {
+            short id = original.getShort ();
+            int length = original.getShort () & 0xffff;
+
+            if (id == 0 || length > original.remaining ()) {
+                break;
+            }
+
+            if (id == ALIGNMENT_EXTRA_ID) {
+                original.position (original.position () + length);
+                continue;
+            }
+
+            kept.putShort (id);
+            kept.putShort ((short) length);
+            kept.put (extra, original.position (), length);
+            original.position (original.position () + length);
+        }
+
+        /* Our field has at least 6 Bytes: ID, length and alignment */
+        int padding = (int) ((entryAlignment - (extraOffset + kept.position () + 6) % entryAlignment) % entryAlignment);
+
+        ByteBuffer aligned = ByteBuffer.allocate (kept.position () + 6 + padding).order (ByteOrder.LITTLE_ENDIAN);
+        aligned.put (kept.array (), 0, kept.position ());
+        aligned.putShort (ALIGNMENT_EXTRA_ID);
+        aligned.putShort ((short) (2 + padding));
+        aligned.putShort ((short) entryAlignment);
+
+        return aligned.array ();
+    }
+
+    /**
+     * Locates the "end of central directory" record, which is at the end of the file, followed by the Zip comment.
+     *
+     * @return The whole record, including the comment.
+     */
+    private static ByteBuffer findEndOfCentralDir (RandomAccessFile zipIn) throws IOException, InvalidZipException {
+
+        long fileSize = zipIn.length ();
+        /* The comment can be, at most, 0xffff Bytes long */
+        int tailSize = (int) Math.min (fileSize, END_OF_CENTRAL_DIR_SIZE + 0xffff);
+        ByteBuffer tail = read (zipIn, fileSize - tailSize, tailSize);
+
+        for (int i = tailSize - END_OF_CENTRAL_DIR_SIZE; i >= 0; i--) {
+
+            int commentLength = tail.getShort (i + 20) & 0xffff;
+
+            if (tail.getInt (i) == END_OF_CENTRAL_DIR_SIGNATURE
+                && i + END_OF_CENTRAL_DIR_SIZE + commentLength == tailSize
+            ) {
+                ByteBuffer eocd = ByteBuffer.allocate (tailSize - i).order (ByteOrder.LITTLE_ENDIAN);
+                eocd.put (tail.array (), i, tailSize - i);
+                return eocd;
+            }
+        }
+
+        throw new InvalidZipException ("End of central directory not found");
+    }
+
+    /**
+     * Reads `length` Bytes at the given offset.
+     */
+    private static ByteBuffer read (RandomAccessFile zipIn, long offset, int length) throws IOException {
+
+        byte[] data = new byte [length];
+        zipIn.seek (offset);
+        zipIn.readFully (data);
+
+        return ByteBuffer.wrap (data).order (ByteOrder.LITTLE_ENDIAN);
+    }
+
+    /**
+     * Writes the data and keeps track of the current position in the output file.
+     */
+    private void write (OutputStream zipOut, byte[] data, int offset, int length) throws IOException {
+
+        zipOut.write (data, offset, length);
+        outputSize += length;
+    }
+}
@@ -2,53 +2,34 @@
 
 import argparse
 import re
+import os
 import zipfile
-import requests
 import base64
+import hashlib
+import mmap
+import struct
+import json
+import multiprocessing
+import sys
+import threading
+import zlib
+import copy
 from sys import exit as sys_exit
 from sys import stderr, stdout
 
-from lzma import decompress, FORMAT_XZ
-from shutil import rmtree, move, copy
+from lzma import LZMADecompressor, FORMAT_XZ
+from shutil import rmtree, copyfileobj
 from pathlib import Path
-from io import BytesIO, BufferedReader
-
-from androguard.core.axml import AXMLPrinter
-from androguard.core.dex import DEX
-from androguard.util import set_log
+from io import BytesIO, BufferedReader, RawIOBase
+from time import perf_counter, process_time, sleep, time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 
 from loguru import logger
 
-import pyaxml
-try:
-    from lxml import etree
-#    logger.debug ("[DEBUG] Running with lxml.etree")
-except ImportError:
-    import xml.etree.ElementTree as etree
-#    logger.debug ("[DEBUG] Running with Python's xml.etree.ElementTree")
-
-import jpype
-import jpype.imports
-# Required before importing the Java classes
-jpype.startJVM (classpath = [
-    str (Path (__file__).parent / "java_libs" / "*"),
-    str (Path (__file__).parent / "Java" / "APK patcher" / "app" / "build" / "libs" / "*")
-])
-
-from java.lang import String, UnsupportedClassVersionError
-from java.io import (
-    IOException,
-    ByteArrayInputStream
-)
-try:
-    from ApkPatcher import Patcher
-except UnsupportedClassVersionError as e:
-    logger.critical (f"{e}")
-    logger.debug (f"Using JVM at {jpype.getDefaultJVMPath ()}")
-    logger.error (f"(FIX) -> Try to recompile the Java library. See './Java/APK patcher/README.md'")
-    logger.error (f"(FIX 2) -> If you have another version of Java installed, try that one instead")
-    sys_exit (-1)
-
+# The heavier dependencies (pyaxml, lxml, requests and the JVM) are imported only by the stages that use them, so
+# `-h`, argument errors and scripts importing this file don't have to wait for them
 
 
 ############
@@ -67,6 +48,34 @@ GADGET_CONFIG = b"""{
 """
 
 FRIDA_ASSETS_URL = "https://api.github.com/repos/frida/frida/releases/latest"
+# Used instead of FRIDA_ASSETS_URL when a specific version is requested with --frida-version
+FRIDA_TAG_URL = "https://api.github.com/repos/frida/frida/releases/tags/{version}"
+
+# Location of the local caches (e.g.: the decompressed Frida gadgets, under CACHE_DIR/gadgets)
+CACHE_DIR = Path.home () / ".cache" / "apk-patcher"
+# Maximum size (in MB) of the gadget cache. The least recently used gadgets are evicted first
+GADGET_CACHE_SIZE = 512
+# Maximum size (in MB) of the cache of patched dex files (under CACHE_DIR/dex)
+DEX_CACHE_SIZE = 256
+# Maximum size (in MB) of the cache of aligned and signed splits that don't have to be modified (under CACHE_DIR/splits)
+SPLIT_CACHE_SIZE = 1024
+# Address where the patch server listens by default (see `serve`). Unix sockets are given as "unix:<path>"
+SERVER_ADDRESS = "127.0.0.1:8765"
+# Number of jobs the patch server accepts on top of the ones it's running. Beyond that, new jobs are rejected
+SERVER_QUEUE_SIZE = 16
+# Share of the --max-memory budget given to the heap of the JVM. The rest is for Python and the buffers shared with Java
+JVM_HEAP_SHARE = 0.5
+# Minimum heap (in MB) of the JVM, whatever the --max-memory budget is
+JVM_MIN_HEAP = 128
+# Share of the --max-memory budget above which the dex files are kept in temporary files instead of in memory
+SPILL_SHARE = 0.125
+# Seconds between checks of the watched files, with --watch
+WATCH_INTERVAL = 0.5
+# Part of the key of every patched dex file in the cache. It must be increased whenever the output of the patcher
+# changes (e.g.: a new preamble), so the dex files patched by older versions are not used anymore
+DEX_CACHE_VERSION = 1
+# Same as DEX_CACHE_VERSION, for the signed splits. It must be increased whenever the output of finalize_apk() changes
+SPLIT_CACHE_VERSION = 1
 
 # Android ABI => Frida ABI
 # https://developer.android.com/ndk/guides/abis
@@ -78,6 +87,52 @@ ABI_MAPPING = {
     "x86_64": "x86_64"
 }
 
+# Every ABI directory that can hold native libraries, with the Frida architecture of the gadget it needs
+NATIVE_ABI_MAPPING = { **ABI_MAPPING, "armeabi": "arm" }
+
+# Extensions of the bundles (archives with all the APKs of an app) that can be read directly
+BUNDLE_EXTENSIONS = { ".apks", ".xapk", ".apkm" }
+
+# ID of the extra field used to align the uncompressed entries of the APKs (same as apksigner)
+ALIGNMENT_EXTRA_ID = 0xD935
+
+# Magic at the end of the APK Signing Block, right before the central directory
+# https://source.android.com/docs/security/features/apksigning/v2#apk-signing-block
+APK_SIGNING_BLOCK_MAGIC = b"APK Sig Block 42"
+# General purpose flag of the Zip entries whose CRC and sizes come after the data, instead of in the local header
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+# Size of the chunks used to copy the raw data of the Zip entries
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# APK signature schemes supported by the signer
+SIGNATURE_SCHEMES = { "v1", "v2", "v3" }
+# Android 7.0, the first version that verifies v2 signatures. Older ones only know about v1 (JAR signing)
+V2_MIN_SDK = 24
+
+# Chunk types of the binary XML (AXML) files, like AndroidManifest.xml
+# https://android.googlesource.com/platform/frameworks/base/+/refs/heads/main/libs/androidfw/include/androidfw/ResourceTypes.h
+AXML_STRING_POOL = 0x0001
+AXML_FILE = 0x0003
+AXML_START_ELEMENT = 0x0102
+AXML_END_ELEMENT = 0x0103
+AXML_RESOURCE_MAP = 0x0180
+ANDROID_NS = "http://schemas.android.com/apk/res/android"
+# Resource ID of the android: attributes read from the manifest => name. The IDs are used when they're present, since
+# obfuscators tend to remove (or change) the names in the string pool, but the system only looks at the IDs
+# https://developer.android.com/reference/android/R.attr
+ANDROID_ATTRIBUTES = {
+    0x01010003: "name",
+    0x0101020c: "minSdkVersion",
+    0x01010202: "targetActivity",
+    0x010104ea: "extractNativeLibs"
+}
+
+# Classpath of the JVM started by get_patcher()
+JAVA_CLASSPATH = [
+    str (Path (__file__).parent / "java_libs" / "*"),
+    str (Path (__file__).parent / "Java" / "APK patcher" / "app" / "build" / "libs" / "*")
+]
+
 # Location of the generated APKs (the app stem will be appended later in __main__)
 OUT_DIR = Path.cwd ()
 
@@ -86,27 +141,67 @@ KEYSTORE_B64 = "MIIKEQIBAzCCCcoGCSqGSIb3DQEHAaCCCbsEggm3MIIJszCCBWcGCSqGSIb3DQEH
 
 
 
-def parse_args ():
+def positive_int (value):
+    """
+    Type of the arguments that must be an integer greater than 0 (e.g.: the number of workers).
+    """
+    number = int (value)
+    if number < 1:
+        raise argparse.ArgumentTypeError (f"must be greater than 0: {value}")
+
+    return number
 
-    parser = argparse.ArgumentParser (
-            prog = "APK patcher",
-            description = "Script to automate the decompilation, patch and rebuild of any Android split applications (those apps that have base.apk, plus .config.<something>.apk) to inject the provided Frida script.",
-            formatter_class = argparse.RawTextHelpFormatter
+
+def add_cache_arguments (parser):
+    """
+    Adds the options of the caches, shared by all the modes (including the `serve` subcommand).
+    """
+    parser.add_argument (
+            '--cache-dir',
+            type = Path,
+            default = CACHE_DIR,
+            help = ("Directory where the downloaded Frida gadgets, the patched dex files and the signed splits are kept between\n"
+                f"runs. Default: {CACHE_DIR}"
+            )
         )
 
     parser.add_argument (
-            'base_path',
-            type = str,
-            help = ("Common prefix for all the split apk files.\n"
-                    "For example, if we have:\n"
-                    "  - com.example.1234.apk\n"
-                    "  - com.example.1234.config.armeabi_v7a.apk\n"
-                    "  - com.example.1234.config.en.apk\n"
-                    "  - com.example.1234.config.xxhdpi.apk\n\n"
-                    "'base-name' must be \"com.example.1234.\" (note the dot at the end)\n"
-                )
+            '--cache-size',
+            metavar = "MB",
+            type = int,
+            default = GADGET_CACHE_SIZE,
+            help = ("Maximum size of the gadget cache, in MB. When exceeded, the least recently used gadgets are removed.\n"
+                f"Default: {GADGET_CACHE_SIZE}"
+            )
+        )
+
+    parser.add_argument (
+            '--dex-cache-size',
+            metavar = "MB",
+            type = int,
+            default = DEX_CACHE_SIZE,
+            help = ("Maximum size of the cache of patched dex files, in MB. Patching the same app again (e.g.: with another\n"
+                "Frida script) reuses the dex files patched the first time. Use 0 to disable it.\n"
+                f"Default: {DEX_CACHE_SIZE}"
+            )
+        )
+
+    parser.add_argument (
+            '--split-cache-size',
+            metavar = "MB",
+            type = int,
+            default = SPLIT_CACHE_SIZE,
+            help = ("Maximum size of the cache of aligned and signed splits, in MB. The splits that are not modified (e.g.:\n"
+                "density and language splits) are only aligned and signed the first time. Use 0 to disable it.\n"
+                f"Default: {SPLIT_CACHE_SIZE}"
+            )
         )
 
+
+def add_common_arguments (parser):
+    """
+    Adds the options shared by the single-app mode and the `batch` subcommand.
+    """
     parser.add_argument (
             '-f', '--fix_manifest',
             action = "store_true",
@@ -119,7 +214,7 @@ def parse_args ():
     parser.add_argument (
             '-c', '--config',
             dest = "gadget_config",
-            type = argparse.FileType ("r"),
+            type = argparse.FileType ("rb"),
             help = "Path to a custom Gadget config ( https://frida.re/docs/gadget/ )"
         )
 
@@ -145,6 +240,83 @@ def parse_args ():
             help = "Bypass the ABI detection and force the usage of a specific architecture for the injected Frida gadget."
         )
 
+    parser.add_argument (
+            '--frida-version',
+            type = str,
+            help = "Use the specified Frida version (e.g.: '16.4.8') instead of the latest one."
+        )
+
+    parser.add_argument (
+            '--offline',
+            action = "store_true",
+            help = ("Don't query GitHub at all, and use only the gadgets already present in the cache.\n"
+                "If --frida-version is not provided, the newest cached version is used."
+            )
+        )
+
+    parser.add_argument (
+            '-j', '--jobs',
+            type = positive_int,
+            default = os.cpu_count (),
+            help = f"Number of APK parts to zipalign and sign at the same time. Default: {os.cpu_count ()}"
+        )
+
+    parser.add_argument (
+            '--page-size',
+            metavar = "KB",
+            type = int,
+            choices = [ 4, 16 ],
+            default = 4,
+            help = ("Page size (in KB) the uncompressed native libraries are aligned to. Use 16 for devices with 16 KB pages.\n"
+                "Default: 4"
+            )
+        )
+
+    parser.add_argument (
+            '--schemes',
+            default = "auto",
+            help = ("Comma-separated list of APK signature schemes to use (e.g.: 'v2,v3').\n"
+                "With 'auto', v1 is only used if the app supports Android versions older than 7.0 (minSdkVersion < 24).\n"
+                "Default: auto"
+            )
+        )
+
+    parser.add_argument (
+            '--verify',
+            action = "store_true",
+            help = ("After signing, check the patched APKs: alignment, signatures (with apksig), the manifest and the\n"
+                "entry points of the dex files. To check them later, see the `verify` subcommand."
+            )
+        )
+
+    parser.add_argument (
+            '--max-memory',
+            metavar = "MB",
+            type = int,
+            help = ("Approximate memory budget of the process. Half of it goes to the heap of the JVM, and the dex files\n"
+                f"bigger than {SPILL_SHARE * 100:g}%% of it are kept in temporary files (and mapped) instead of in memory.\n"
+                "In batch mode, the budget is split among the workers. Default: no limit"
+            )
+        )
+
+    parser.add_argument (
+            '--metrics',
+            metavar = "FILE",
+            type = Path,
+            help = ("Write the measurements of every stage and every call to the Java patcher (wall and CPU time, Bytes\n"
+                "read and written, entries, peak RSS and JVM heap) to this file, as JSON lines."
+            )
+        )
+
+    parser.add_argument (
+            '--trace',
+            metavar = "FILE",
+            type = Path,
+            help = "Write the same measurements as --metrics as a Chrome trace (see chrome://tracing or https://ui.perfetto.dev)."
+        )
+
+    add_cache_arguments (parser)
+
     #####
     # Options depending on another
     #####
@@ -158,8 +330,11 @@ def parse_args ():
         )
 
 
-    args = parser.parse_args ()
-
+def check_args (parser, args):
+    """
+    Verifies the dependencies between flags and reads the files passed as arguments.
+    The contents are read right away so the parsed arguments can be sent to other processes (see `batch`).
+    """
     ####
     # Verifies dependencies between flags
     ####
@@ -172,10 +347,234 @@ def parse_args ():
         parser.print_help (stderr)
         sys_exit (1)
 
+    if args.max_memory is not None and args.max_memory <= 0:
+        logger.error ("The argument `--max-memory` must be a positive number of MB. See help for more info")
+        parser.print_help (stderr)
+        sys_exit (1)
+
+    # --schemes: "auto" is stored as None, to be resolved for every app
+    if args.schemes == "auto":
+        args.schemes = None
+    else:
+        args.schemes = [ x.strip () for x in args.schemes.split (",") if x.strip () ]
+
+        if not args.schemes or not set (args.schemes) <= SIGNATURE_SCHEMES:
+            logger.error (f"Invalid signature schemes: {args.schemes}. Valid values: {sorted (SIGNATURE_SCHEMES)}")
+            parser.print_help (stderr)
+            sys_exit (1)
+
+    # The paths are kept for --watch
+    args.frida_script_path = None
+    args.gadget_config_path = None
+
+    if args.frida_script:
+        args.frida_script_path = Path (args.frida_script.name)
+        args.frida_script = args.frida_script.read ()
+
+    if args.gadget_config:
+        args.gadget_config_path = Path (args.gadget_config.name)
+        args.gadget_config = args.gadget_config.read ()
+
+    return args
+
+
+def parse_args (argv = None):
+
+    parser = argparse.ArgumentParser (
+            prog = "APK patcher",
+            description = ("Script to automate the decompilation, patch and rebuild of any Android split applications (those apps that have base.apk, plus .config.<something>.apk) to inject the provided Frida script.\n"
+                "To patch many apps at once, see `%(prog)s batch -h`; to run it as a service, see `%(prog)s serve -h`; to check\n"
+                "the patched APKs again, see `%(prog)s verify -h`"
+            ),
+            formatter_class = argparse.RawTextHelpFormatter
+        )
+
+    parser.add_argument (
+            'base_path',
+            type = str,
+            help = ("Common prefix for all the split apk files.\n"
+                    "For example, if we have:\n"
+                    "  - com.example.1234.apk\n"
+                    "  - com.example.1234.config.armeabi_v7a.apk\n"
+                    "  - com.example.1234.config.en.apk\n"
+                    "  - com.example.1234.config.xxhdpi.apk\n\n"
+                    "'base-name' must be \"com.example.1234.\" (note the dot at the end)\n\n"
+                    "It can also be a bundle with all the splits inside (.apks, .xapk or .apkm), which is read without\n"
+                    "extracting it.\n"
+                )
+        )
+
+    parser.add_argument (
+            '--output-bundle',
+            type = Path,
+            help = ("Also write all the patched APKs into this single bundle. If the app was read from a bundle, the output\n"
+                "keeps its layout (and the rest of its files, like manifest.json)."
+            )
+        )
+
+    parser.add_argument (
+            '--watch',
+            action = "store_true",
+            help = ("After patching the app, keep watching the Frida script (and the Gadget config, if provided). When they\n"
+                "change, only the APKs containing them are updated and signed again. Requires --load"
+            )
+        )
+
+    add_common_arguments (parser)
+
+    args = check_args (parser, parser.parse_args (argv))
+
+    # --watch requires --load, with a real file
+    if args.watch \
+        and (args.frida_script_path is None or not args.frida_script_path.is_file ()):
+
+        logger.error ("The argument `--watch` requires `--load` with a regular file. See help for more info")
+        parser.print_help (stderr)
+        sys_exit (1)
 
     return args
 
 
+def parse_batch_args (argv):
+
+    parser = argparse.ArgumentParser (
+            prog = "APK patcher batch",
+            description = ("Patches many apps in one go, using a pool of worker processes.\n"
+                "A failure on one app doesn't stop the others, and a JSON summary (with the time spent on each stage) is written\n"
+                "to the output directory of every app."
+            ),
+            formatter_class = argparse.RawTextHelpFormatter
+        )
+
+    parser.add_argument (
+            'manifest',
+            type = str,
+            help = ("Either a file with one base path per line (see `base_path` on the single-app mode), or a glob pattern.\n"
+                "With a glob, every matched APK (or APK inside a matched directory) that isn't a config split is patched.\n"
+                "Bundles (.apks, .xapk, .apkm) are patched as well. For example: 'apps/*.apk' or 'apps/*/'"
+            )
+        )
+
+    parser.add_argument (
+            '-w', '--workers',
+            type = positive_int,
+            default = os.cpu_count (),
+            help = f"Number of worker processes (each one with its own JVM). Default: {os.cpu_count ()}"
+        )
+
+    parser.add_argument (
+            '-s', '--summary',
+            type = Path,
+            help = "Also write the summaries of all the apps to this file (as JSON lines)."
+        )
+
+    add_common_arguments (parser)
+
+    return check_args (parser, parser.parse_args (argv))
+
+
+def parse_serve_args (argv):
+
+    parser = argparse.ArgumentParser (
+            prog = "APK patcher serve",
+            description = ("Runs a patch server, which keeps the JVM, the signing keys and the caches loaded between apps.\n"
+                "Jobs are sent with `POST /jobs` and a JSON body like { \"args\": [ \"com.example.1234.\", \"-l\", \"script.js\" ] },\n"
+                "where \"args\" are the same arguments of the single-app mode (with paths on the server's host). The progress\n"
+                "of every stage is streamed back as JSON lines, and the last line is the summary of the job.\n"
+                "`GET /status` returns the number of running and queued jobs."
+            ),
+            formatter_class = argparse.RawTextHelpFormatter
+        )
+
+    parser.add_argument (
+            '--listen',
+            default = SERVER_ADDRESS,
+            help = ("Address to listen on: either <host>:<port> (HTTP over TCP) or unix:<path> (HTTP over a Unix socket).\n"
+                f"Default: {SERVER_ADDRESS}"
+            )
+        )
+
+    parser.add_argument (
+            '-w', '--workers',
+            type = int,
+            default = os.cpu_count (),
+            help = f"Number of jobs run at the same time. Default: {os.cpu_count ()}"
+        )
+
+    parser.add_argument (
+            '--queue-size',
+            type = int,
+            default = SERVER_QUEUE_SIZE,
+            help = ("Number of jobs that can wait for a free worker. When the queue is full, new jobs are rejected with\n"
+                f"503 (Service Unavailable) until there's room again. Default: {SERVER_QUEUE_SIZE}"
+            )
+        )
+
+    parser.add_argument (
+            '-v', '--verbose',
+            action = "count",
+            default = 1,
+            help = "Increase the verbosity. Can be specified up to 3 times."
+        )
+
+    parser.add_argument (
+            '--max-memory',
+            metavar = "MB",
+            type = int,
+            help = ("Approximate memory budget of the server. The heap of the JVM is sized from it, and the jobs that don't\n"
+                "set their own --max-memory get an equal share of it per worker. Default: no limit"
+            )
+        )
+
+    add_cache_arguments (parser)
+
+    return parser.parse_args (argv)
+
+
+def parse_verify_args (argv):
+
+    parser = argparse.ArgumentParser (
+            prog = "APK patcher verify",
+            description = ("Checks the patched APKs of a directory without installing them: alignment, signatures (with apksig),\n"
+                "the AndroidManifest.xml and the entry points of the dex files. The time spent on every check is reported,\n"
+                "and the exit code is 1 if any problem is found."
+            ),
+            formatter_class = argparse.RawTextHelpFormatter
+        )
+
+    parser.add_argument (
+            'out_dir',
+            type = Path,
+            nargs = "+",
+            help = "Directories with the patched APKs (e.g.: com.example.1234.patched)."
+        )
+
+    parser.add_argument (
+            '--page-size',
+            metavar = "KB",
+            type = int,
+            choices = [ 4, 16 ],
+            default = 4,
+            help = "Page size (in KB) the uncompressed native libraries must be aligned to. Default: 4"
+        )
+
+    parser.add_argument (
+            '-j', '--jobs',
+            type = positive_int,
+            default = os.cpu_count (),
+            help = f"Number of checks run at the same time. Default: {os.cpu_count ()}"
+        )
+
+    parser.add_argument (
+            '-v', '--verbose',
+            action = "count",
+            default = 1,
+            help = "Increase the verbosity. Can be specified up to 3 times."
+        )
+
+    return parser.parse_args (argv)
+
+
 def find_apk_parts (base_name):
     """
     Scans the specified path looking for all the available parts of the split APK.
@@ -188,6 +587,8 @@ def find_apk_parts (base_name):
     Note that there might be multiple such files (i.e.: 'test.config.armeabi_v7a.apk' and 'test.config.arm64-v8a.apk'),
     so the returned result will reflect all these .
 
+    If base_name is a bundle (see BUNDLE_EXTENSIONS), the APKs inside it are returned instead (see find_bundle_parts()).
+
     Return
         :dict
         The following is a sample returned object:
@@ -211,39 +612,25 @@ def find_apk_parts (base_name):
     """
     base_path = Path (base_name)
 
+    if base_path.suffix in BUNDLE_EXTENSIONS and base_path.is_file ():
+        return find_bundle_parts (base_path)
+
     file_list = base_path.parent.glob (f"{base_path.name}*apk")
     parts = {}
 
     base = str (base_path.name)
 
-    re_abi = re.compile (f"{base}config\\.(arm|x86)[^.]+\\.apk")
-    re_density = re.compile (f"{base}config\\.[a-z]+dpi\\.apk") # https://developer.android.com/training/multiscreen/screendensities
-    re_lang = re.compile (f"{base}config\\.[a-z][a-z]\\.apk")
-
     for f in file_list:
 
         file = str (f.name)
 
         if file == f"{base}apk":
             parts ["main"] = f
+            continue
 
-        elif re_abi.match (file):
-            if "abi" in parts:
-                parts ["abi"].append (f)
-            else:
-                parts ["abi"] = [ f ]
-
-        elif re_density.match (file):
-            if "density" in parts:
-                parts ["density"].append (f)
-            else:
-                parts ["density"] = [ f ]
-
-        elif re_lang.match (file):
-            if "lang" in parts:
-                parts ["lang"].append (f)
-            else:
-                parts ["lang"] = [ f ]
+        split_type = get_split_type (file [len (base):]) if file.startswith (base) else None
+        if split_type is not None:
+            parts.setdefault (split_type, []).append (f)
 
     if "main" not in parts:
         raise FileNotFoundError (f"Couldn't find the main APK (searched for '{base}apk')")
@@ -251,572 +638,3806 @@ def find_apk_parts (base_name):
     return parts
 
 
-def get_entry_points (main_apk_path):
+def get_split_config (filename):
+    """
+    Returns the configuration of a config split, from its file name; or None if it's not a config split.
+    The names used by the different tools are supported. For example, "arm64_v8a" for:
+        - com.example.1234.config.arm64_v8a.apk (or just config.arm64_v8a.apk)
+        - split_config.arm64_v8a.apk (APKMirror)
+        - base-arm64_v8a.apk (bundletool)
     """
-    Unpacks the main APK and parses AndroidManifest.xml to extract the entry points of the app.
+    name = filename [:-len (".apk")] if filename.endswith (".apk") else filename
 
-    Args
-        main_apk_path: str
-            Path to the APK containing the AndroidManifest.xml
+    match = re.search (r"(?:^|[._])config\.([^.]+)$", name) or re.fullmatch (r"base-([^.]+)", name)
+    if match is None or match.group (1) == "master":
+        return None
 
-    Returns
-        [:str]
-        A list with the names of the classes that were marked as an entry point on the Manifest
-    """
-    entry_points = []
-
-    with zipfile.ZipFile (main_apk_path, "r") as apk:
-        with apk.open ("AndroidManifest.xml") as manifest:
-            parsed = AXMLPrinter (manifest.read ())
-            xml = parsed.get_xml_obj ()
-
-            android_name = "{http://schemas.android.com/apk/res/android}name"
-            android_target = "{http://schemas.android.com/apk/res/android}targetActivity"
-            # We're looking for any activity (or activity-alias) wtih action="android.intent.action.MAIN", regardless of its category
-            # There might be multiple main activities, depending on how it is launched: https://stackoverflow.com/a/75269947
-            #
-            # We expect the following hierarchy:
-            #  <activity android:theme=...>
-            #    <intent-filter>
-            #      <action android:name="android.intent.action.MAIN"/>
-            #      <category android:name="android.intent.category.LAUNCHER"/>
-            #      <action android:name="android.intent.action.VIEW"/>
-            #    </intent-filter>
-            #  </activity>
-            #
-            # Therefore, and since Python's default XML parser doesn't support .getparent(), the XPath must go directly to the parent
-            # using '/..' (looks like Python libraries don't support '/parent::*' )
-            xpath = f".//activity/intent-filter/action[@{android_name}='android.intent.action.MAIN']/../.."
-            logger.debug (f'Searching for the entry point using the following XPath: `{xpath}`')
-            main_activities = xml.findall (xpath)
-
-            # If none was found, maybe the activity was defined as an 'activity-alias':
-            #   <activity-alias
-            #           android:name="com.example.LoginActivity"
-            #           android:targetActivity="com.example.LaunchActivity">
-            # The actual code will be inside com.example.LaunchActivity
-            #
-            # https://developer.android.com/guide/topics/manifest/activity-alias-element
-            search_alias = not main_activities
-            if search_alias:
-                xpath = f".//activity-alias/intent-filter/action[@{android_name}='android.intent.action.MAIN']/../.."
-
-                logger.debug ("No main activity was found using the previous filter. Trying with <activity-alias>...")
-                main_activities = xml.findall (xpath)
-
-            # Python libraries also don't seem to support '/@attrib' to get the attribute directly, so I guess we'll have to do it by hand...
-            for activity in main_activities:
-                name = activity.get (android_target if search_alias else android_name)
-
-                if name not in entry_points:
-                    entry_points.append (name)
-
-    return entry_points
-
-
-def java_patch_bytecode (dex_raw_bytes, dex_version, main_class, init_method):
+    return match.group (1)
+
+
+def get_split_type (filename):
     """
-    Interfaces with the custom patcher written in Java, which uses the dexlib2 library.
-    This is needed because androguard doesn't support modifying the dex files, as far as I could tell
+    Returns the kind of config split ("abi", "density" or "lang") of the given file name (see get_split_config()), or
+    None if it's not one of them.
     """
-    output = None
-    class_name = main_class.name
-    method_name = init_method.name
+    config = get_split_config (filename)
+    if config is None:
+        return None
 
-    logger.debug (f"Interfacing with the Java patcher to modify {class_name}->{method_name}" +
-        f"// Dex version: {dex_version}")
+    if re.fullmatch (r"(arm|x86)[^.]+", config):
+        return "abi"
 
-    j_dexBytes = ByteArrayInputStream (dex_raw_bytes)
-    j_className = String (class_name)
-    j_methodName = String (method_name)
-    j_dexVersion = dex_version # Basic type; no conversion is needed. This variable is for better code readability
+    # https://developer.android.com/training/multiscreen/screendensities
+    if re.fullmatch (r"[a-z]+dpi", config):
+        return "density"
 
-    try:
-        j_output = Patcher.patchDexFile (j_dexBytes, j_className, j_methodName, j_dexVersion)
+    if re.fullmatch (r"[a-z][a-z]", config):
+        return "lang"
 
-        output = bytes (j_output.toByteArray ())
+    return None
 
-    except IOException as e:
-        logger.error (f"Exception from Java at patchDexFile(): {e} ")
 
-    return output
+class FileRange (RawIOBase):
+    """
+    Read-only, seekable view of `size` Bytes of a file, starting at `offset`.
+    It's used to read the uncompressed APKs inside a bundle as if they were regular files, without extracting them.
+    """
 
+    def __init__ (self, path, offset, size):
+        super ().__init__ ()
+        self.handle = open (path, "rb")
+        self.offset = offset
+        self.size = size
+        self.position = 0
 
-def get_init_method (main_class):
-    # https://source.android.com/docs/core/runtime/dex-format#access-flags
-    # 0x10000 -> constructor
-    # If there are many constructors, we just take the first one (although we could patch all of them, just in case...)
-    init_method = list (
-            filter (
-                    lambda x: x.access_flags & 0x10000,
-                    main_class.get_methods ()
-                )
-        )[0]
 
-    return init_method
+    def readable (self):
+        return True
 
 
-def copy_to_zip (handle_zip_original, handle_zip_new, filename, data = None):
-    """
-    Copies the filename from zip_original to zip_new.
-    If "data" is provided, those bytes are copied instead of the original file data.
+    def seekable (self):
+        return True
 
-    Args
-        handle_zip_original: ZipFile
-            Handle to the original zipfile from where to copy the data.
 
-        handle_zip_new: ZipFile
-            Handle to the new zipfile, where the data will be copied to.
+    def fileno (self):
+        return self.handle.fileno ()
 
-        filename: str
-            Path to the file that will be copied.
 
-        data: bytes
-            Data to be put into the new zip, instead of the original file's data.
-            The original file's metadata is kept.
-    """
-    # The metadata is kept regardless of the data we copy
-    info = handle_zip_original.getinfo (filename)
+    def tell (self):
+        return self.position
 
-    if data is None:
-        with handle_zip_original.open (filename) as zipped_file:
-            handle_zip_new.writestr (info, zipped_file.read ())
 
-    else:
-        handle_zip_new.writestr (info, data)
+    def seek (self, position, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.size
 
+        if position < 0:
+            raise ValueError (f"Negative seek position {position}")
 
-def patch_bytecode (main_apk_path, mod_apk_path, target_classes):
-    """
-    Finds the specified class withing the main APK and patches its Bytecode to load the library "libgadget.so"
+        self.position = position
+        return self.position
 
-    Args
-        main_apk_path: str
-            Path to the APK containing the AndroidManifest.xml
 
-        mod_apk_path: str
-            Path to the modified APK where the patched items will be written to
+    def readinto (self, buffer):
+        length = max (0, min (len (buffer), self.size - self.position))
+        if not length:
+            return 0
 
-        target_class: [str]
-            FQN of the classes to patch, as extracted by get_entry_points()
+        self.handle.seek (self.offset + self.position)
+        length = self.handle.readinto (memoryview (buffer) [:length])
+        self.position += length
 
-    Returns
-        :bool
-        True on success, False otherwise
-    """
-    with (
-        zipfile.ZipFile (main_apk_path, "r") as apk,
-        zipfile.ZipFile (mod_apk_path, "w") as apk_mod
-    ):
-        done = False
-        for filename in apk.namelist ():
+        return length
 
-            if (not done) and filename.endswith (".dex"):
 
-                dex_bytes = apk.open (filename, "r").read ()
-                logger.info (f"Parsing {filename}...")
-                data = DEX (dex_bytes)
+    def close (self):
+        self.handle.close ()
+        super ().close ()
 
-                for t in target_classes:
-                    # There might be multiple subclasses (i.e.: Main, Main$a, Main$b, ...), but the entry_point is the
-                    # parent one, so we have to search only for "Main;", hence the regex "{t};"
-                    main_class = list (
-                            filter (
-                                    lambda x: re.search (f"{t};", x.get_name ()),
-                                    data.get_classes ()
-                                )
-                        )
 
-                    if not main_class:
-                        # Not the droids we're looking for... Just add them to the output APK
-                        copy_to_zip (apk, apk_mod, filename)
-                        continue
+class BundleEntry:
+    """
+    An APK inside a bundle (.apks, .xapk, .apkm). It can be used instead of the Path of a loose APK by all the stages
+    that read the APKs (see open_apk()), and it has the same `name` and `stem`.
+    """
 
-                    # If there are more than one element (is that even possible?), we just take the first one
-                    main_class = main_class [0]
+    def __init__ (self, bundle_path, info, data_offset):
+        self.bundle_path = bundle_path
+        self.info = info
+        self.data_offset = data_offset
+        self.name = info.filename.rsplit ("/", 1) [-1]
+        self.stem = self.name [:-len (".apk")]
 
-                    init_method = get_init_method (main_class)
-                    logger.info (f"Found init method: {init_method}")
 
-                    patched_dex = java_patch_bytecode (dex_bytes, data.version, main_class, init_method)
+    def open (self):
+        """
+        Returns a seekable file object with the contents of the APK.
+        The uncompressed APKs (the usual case) are read straight from the bundle. The compressed ones are decompressed
+        on the fly, which is slower if they have to be read backwards.
+        """
+        if self.info.compress_type == zipfile.ZIP_STORED:
+            return FileRange (self.bundle_path, self.data_offset, self.info.file_size)
 
-                    if not patched_dex:
-                        logger.error ("Couldn't patch the desired method")
-                        return False
+        logger.debug (f"{self} is compressed inside the bundle")
+        # The file of the bundle stays open until the returned object is closed
+        with zipfile.ZipFile (self.bundle_path, "r") as bundle:
+            return bundle.open (self.info)
 
-                    copy_to_zip (apk, apk_mod, filename, patched_dex)
-                    done = True
 
-            else:
-                copy_to_zip (apk, apk_mod, filename)
+    def __str__ (self):
+        return f"{self.bundle_path}!{self.info.filename}"
 
 
-    return done
+def open_apk (apk):
+    """
+    Opens the given APK (either a Path or a BundleEntry) for reading.
+    """
+    return apk.open () if isinstance (apk, BundleEntry) else open (apk, "rb")
 
 
-def get_arch_from_filename (filename):
+def copy_apk (apk, out_path):
     """
-    Deducts the required architecture(s) from the file name.
+    Copies the given APK (either a Path or a BundleEntry) to out_path.
+    """
+    if not isinstance (apk, BundleEntry):
+        clone_file (apk, out_path)
+        return
+
+    with apk.open () as src, open (out_path, "wb") as dst:
+        copyfileobj (src, dst, COPY_CHUNK_SIZE)
+
+
+def find_bundle_parts (bundle_path):
+    """
+    Like find_apk_parts(), for the APKs inside a bundle (.apks from bundletool, .xapk or .apkm), which are returned as
+    BundleEntry objects instead of paths.
+
+    The main APK is base.apk (APKMirror), base-master.apk (bundletool) or, if there are none of them, the only APK that
+    is not a config split (XAPK, where it's named after the package).
+    """
+    parts = {}
+    candidates = []
+
+    with zipfile.ZipFile (bundle_path, "r") as bundle:
+        for info in bundle.infolist ():
+            if info.is_dir () or not info.filename.endswith (".apk"):
+                continue
+
+            entry = BundleEntry (bundle_path, info, get_data_offset (bundle, info))
+
+            if entry.name in ("base.apk", "base-master.apk"):
+                parts ["main"] = entry
+                continue
+
+            split_type = get_split_type (entry.name)
+            if split_type is not None:
+                parts.setdefault (split_type, []).append (entry)
+            else:
+                candidates.append (entry)
+
+    if "main" not in parts and len (candidates) == 1:
+        parts ["main"] = candidates.pop ()
+
+    for entry in candidates:
+        if entry is not parts.get ("main"):
+            logger.warning (f"{entry} is not a base or config split, so it's left out")
+
+    if "main" not in parts:
+        raise FileNotFoundError (f"Couldn't find the main APK inside {bundle_path}")
+
+    return parts
+
+
+def write_bundle (parts, out_dir, bundle_path):
+    """
+    Writes the (already signed) APKs of out_dir into a single bundle, in one pass.
+
+    If the app was read from a bundle, the output has the same layout: every APK goes where it was, and the rest of
+    the entries (e.g.: manifest.json or the icon of an XAPK) are copied as they are. Otherwise, the APKs are put at the
+    root of the bundle.
+
+    Returns
+        :int
+        Number of entries written.
+    """
+    files = get_full_filelist (parts)
+    source = files [0].bundle_path if isinstance (files [0], BundleEntry) else None
+
+    with zipfile.ZipFile (bundle_path, "w") as out_bundle:
+        if source is None:
+            for f in files:
+                write_entry (out_bundle, zipfile.ZipInfo (f.name), out_dir / f.name)
+
+            return len (files)
+
+        # Location inside the bundle => patched APK
+        patched = { f.info.filename: out_dir / f.name for f in files }
+
+        with zipfile.ZipFile (source, "r") as in_bundle:
+            for info in in_bundle.infolist ():
+                if info.filename in patched:
+                    # The APKs are already compressed
+                    write_entry (out_bundle, zipfile.ZipInfo (info.filename, info.date_time), patched [info.filename])
+
+                elif not info.filename.endswith (".apk"):
+                    raw_copy_to_zip (in_bundle, out_bundle, info.filename)
+
+        return len (out_bundle.infolist ())
+
+
+def iter_axml (data, tags = None):
+    """
+    Walks through the chunks of a binary XML file (AXML), like AndroidManifest.xml, without building its tree.
+
+    Only the android: attributes (and the ones without namespace, like "package") are returned, by their name without
+    the prefix. Their values are decoded to the same text that would be on the original XML.
+
+    Args
+        data: bytes
+            Raw AXML file.
+
+        tags: set
+            If provided, the attributes of the elements with any other tag are not decoded (an empty dict is returned).
+
+    Returns
+        :generator
+        Yields ("start", <tag>, { <attribute>: <value> }) and ("end", <tag>, None) for every element, in order.
+
+    Raises
+        ValueError, if the data is not a valid AXML file.
+    """
+    if len (data) < 8 or struct.unpack_from ("<H", data) [0] != AXML_FILE:
+        raise ValueError ("Not an AXML file")
+
+    string_offsets = ()
+    strings_start = 0
+    is_utf8 = False
+    resource_ids = ()
+    # Index in the string pool => decoded string, and index of the attribute name => name to return (or None)
+    strings = {}
+    attribute_names = {}
+
+    def get_string (idx):
+        if idx in strings:
+            return strings [idx]
+
+        if idx >= len (string_offsets):
+            return None
+
+        offset = strings_start + string_offsets [idx]
+        if is_utf8:
+            # Length in characters, then length in Bytes (each one takes 2 Bytes if it's over 0x7f)
+            for _ in range (2):
+                length = data [offset]
+                offset += 1
+                if length & 0x80:
+                    length = (length & 0x7f) << 8 | data [offset]
+                    offset += 1
+
+            strings [idx] = bytes (data [offset:offset + length]).decode ("utf-8", errors = "replace")
+        else:
+            (length,) = struct.unpack_from ("<H", data, offset)
+            offset += 2
+            if length & 0x8000:
+                length = (length & 0x7fff) << 16 | struct.unpack_from ("<H", data, offset) [0]
+                offset += 2
+
+            strings [idx] = bytes (data [offset:offset + length * 2]).decode ("utf-16-le", errors = "replace")
+
+        return strings [idx]
+
+    def get_value (raw_value, data_type, value):
+        # https://developer.android.com/reference/android/util/TypedValue
+        if raw_value != 0xffffffff:
+            return get_string (raw_value)
+
+        if data_type == 0x03: # TYPE_STRING
+            return get_string (value)
+
+        if data_type in (0x01, 0x02): # TYPE_REFERENCE, TYPE_ATTRIBUTE
+            return ("@" if data_type == 0x01 else "?") + f"{value:08X}"
+
+        if data_type == 0x10: # TYPE_INT_DEC
+            return str (value - (1 << 32) if value & 0x80000000 else value)
+
+        if data_type == 0x12: # TYPE_INT_BOOLEAN
+            return "true" if value else "false"
+
+        return f"0x{value:08x}"
+
+    (_, header_size, file_size) = struct.unpack_from ("<HHI", data)
+    offset = header_size
+    end = min (file_size, len (data))
+
+    try:
+        while offset + 8 <= end:
+            chunk_type, header_size, chunk_size = struct.unpack_from ("<HHI", data, offset)
+            if chunk_size < 8:
+                raise ValueError (f"Invalid chunk at {offset:#x}")
+
+            if chunk_type == AXML_STRING_POOL:
+                count, _, flags, strings_start = struct.unpack_from ("<4I", data, offset + 8)
+                string_offsets = struct.unpack_from (f"<{count}I", data, offset + header_size)
+                strings_start += offset
+                is_utf8 = bool (flags & 0x100)
+
+            elif chunk_type == AXML_RESOURCE_MAP:
+                resource_ids = struct.unpack_from (f"<{(chunk_size - header_size) // 4}I", data, offset + header_size)
+
+            elif chunk_type == AXML_START_ELEMENT:
+                # ResXMLTree_attrExt: ns, name, attributeStart, attributeSize, attributeCount...
+                _, name, attr_start, attr_size, attr_count = struct.unpack_from ("<IIHHH", data, offset + header_size)
+                tag = get_string (name)
+
+                attributes = {}
+                if tags is None or tag in tags:
+                    for i in range (attr_count):
+                        attr_off = offset + header_size + attr_start + i * attr_size
+                        # ResXMLTree_attribute: ns, name, rawValue, and the Res_value (size, res0, dataType, data)
+                        attr_ns, attr_name, raw_value, data_type, value = struct.unpack_from ("<III3xBI", data, attr_off)
+
+                        if (attr_ns, attr_name) not in attribute_names:
+                            if attr_name < len (resource_ids) and resource_ids [attr_name] in ANDROID_ATTRIBUTES:
+                                key = ANDROID_ATTRIBUTES [resource_ids [attr_name]]
+                            elif attr_ns == 0xffffffff or get_string (attr_ns) == ANDROID_NS:
+                                key = get_string (attr_name)
+                            else:
+                                key = None
+
+                            attribute_names [attr_ns, attr_name] = key
+
+                        key = attribute_names [attr_ns, attr_name]
+                        if key is not None:
+                            attributes [key] = get_value (raw_value, data_type, value)
+
+                yield ("start", tag, attributes)
+
+            elif chunk_type == AXML_END_ELEMENT:
+                (_, name) = struct.unpack_from ("<II", data, offset + header_size)
+                yield ("end", get_string (name), None)
+
+            offset += chunk_size
+
+    except (struct.error, IndexError) as e:
+        raise ValueError (f"Malformed AXML file: {e}") from e
+
+
+class ManifestFacts:
+    """
+    Everything the different stages need to know about the AndroidManifest.xml, read in a single pass with iter_axml().
+    This replaces parsing the whole manifest (with androguard or pyaxml) every time something has to be checked.
+
+    Attributes
+        raw: bytes
+            The AXML file, to patch it later (see fix_manifest()).
+
+        package: str
+            Package name of the app.
+
+        entry_points: [str]
+            FQN of the activities with the MAIN action or, if there are none, of the targets of the activity-aliases
+            with it.
+
+        permissions: [str]
+            Permissions requested with <uses-permission>.
+
+        application: {:str => :str}
+            android: attributes of <application> (e.g.: { "extractNativeLibs": "false" }).
+
+        min_sdk: int
+            minSdkVersion (1, if there is none).
+
+        required_split_types: [str]
+            android:requiredSplitTypes of <manifest> (e.g.: [ "base__abi", "base__density" ]). If "base__abi" is there,
+            the native libraries of the app are shipped in the ABI splits.
+    """
+
+    def __init__ (self, raw):
+        self.raw = raw
+        self.package = None
+        self.permissions = []
+        self.application = {}
+        self.min_sdk = 1
+        self.required_split_types = []
+
+        # We're looking for any activity (or activity-alias) wtih action="android.intent.action.MAIN", regardless of its category
+        # There might be multiple main activities, depending on how it is launched: https://stackoverflow.com/a/75269947
+        #
+        # We expect the following hierarchy:
+        #  <activity android:theme=...>
+        #    <intent-filter>
+        #      <action android:name="android.intent.action.MAIN"/>
+        #      <category android:name="android.intent.category.LAUNCHER"/>
+        #      <action android:name="android.intent.action.VIEW"/>
+        #    </intent-filter>
+        #  </activity>
+        main_activities = []
+        main_aliases = []
+
+        path = []
+        component = None
+        is_main = False
+
+        # The attributes of the rest of the elements (e.g.: <category>, <meta-data>...) are not even decoded
+        tags = {
+            "manifest", "application", "uses-permission", "uses-permission-sdk-23", "uses-sdk", "activity",
+            "activity-alias", "action"
+        }
+
+        for event, tag, attributes in iter_axml (raw, tags):
+            if event == "end":
+                if path:
+                    path.pop ()
+
+                if len (path) == 2 and component is not None and tag in ("activity", "activity-alias"):
+                    if is_main:
+                        if tag == "activity":
+                            main_activities.append (component.get ("name"))
+                        else:
+                            main_aliases.append (component.get ("targetActivity"))
+
+                    component = None
+                    is_main = False
+
+                continue
+
+            path.append (tag)
+            depth = len (path)
+
+            if depth > 5 or path [0] != "manifest":
+                continue
+
+            if depth == 1:
+                self.package = attributes.get ("package")
+                self.required_split_types = [
+                    x for x in (attributes.get ("requiredSplitTypes") or "").split (",") if x
+                ]
+
+            elif depth == 2 and tag == "application":
+                self.application = attributes
+
+            elif depth == 2 and tag in ("uses-permission", "uses-permission-sdk-23") and "name" in attributes:
+                self.permissions.append (attributes ["name"])
+
+            elif depth == 2 and tag == "uses-sdk":
+                min_sdk = attributes.get ("minSdkVersion")
+                # Codenames of preview versions (e.g.: "VanillaIceCream") are not numbers, but they're always recent
+                if min_sdk is not None:
+                    self.min_sdk = int (min_sdk) if min_sdk.lstrip ("-").isdigit () else V2_MIN_SDK
+
+            elif depth == 3 and path [1] == "application" and tag in ("activity", "activity-alias"):
+                component = attributes
+
+            elif depth == 5 and component is not None and tag == "action" and path [3] == "intent-filter":
+                is_main |= attributes.get ("name") == "android.intent.action.MAIN"
+
+        # If none was found, maybe the activity was defined as an 'activity-alias':
+        #   <activity-alias
+        #           android:name="com.example.LoginActivity"
+        #           android:targetActivity="com.example.LaunchActivity">
+        # The actual code will be inside com.example.LaunchActivity
+        #
+        # https://developer.android.com/guide/topics/manifest/activity-alias-element
+        if not main_activities:
+            logger.debug ("No main activity was found. Using the <activity-alias> with the MAIN action instead")
+
+        self.entry_points = []
+        for name in (main_activities or main_aliases):
+            name = self.resolve_class_name (name)
+            if name and name not in self.entry_points:
+                self.entry_points.append (name)
+
+
+    def resolve_class_name (self, name):
+        """
+        Returns the FQN of a class as written on the manifest, which may be relative to the package (".Main", or just
+        "Main").
+        """
+        if not name or not self.package:
+            return name
+
+        if name.startswith ("."):
+            return self.package + name
+
+        if "." not in name:
+            return self.package + "." + name
+
+        return name
+
+
+    def has_permission (self, permission_name):
+        """
+        Returns True if the given permission (the full name, e.g.: "android.permission.INTERNET") is requested.
+        """
+        return permission_name in self.permissions
+
+
+def read_manifest (main_apk_path):
+    """
+    Reads the AndroidManifest.xml of the given APK.
+
+    Args
+        main_apk_path: Path, BundleEntry
+            The APK containing the AndroidManifest.xml
+
+    Returns
+        :ManifestFacts
+        The information extracted from the manifest, to be shared by all the stages.
+    """
+    with open_apk (main_apk_path) as apk_file, zipfile.ZipFile (apk_file, "r") as apk:
+        return ManifestFacts (apk.read ("AndroidManifest.xml"))
+
+
+# ApkPatcher.Patcher, loaded by get_patcher()
+PATCHER = None
+PATCHER_LOCK = threading.Lock ()
+# Options of the JVM, when it's started by get_patcher() (see set_memory_budget())
+JVM_OPTIONS = []
+
+def set_memory_budget (max_memory):
+    """
+    Sizes the heap of the JVM from the --max-memory budget (in MB), or removes the limit if it's None.
+    It has no effect once the JVM is started (see get_patcher()).
+    """
+    JVM_OPTIONS.clear ()
+
+    if max_memory:
+        JVM_OPTIONS.append (f"-Xmx{max (JVM_MIN_HEAP, int (max_memory * JVM_HEAP_SHARE))}m")
+
+
+def get_patcher ():
+    """
+    Starts the JVM and loads the custom patcher written in Java (ApkPatcher.Patcher).
+    This happens only once per process, when the first stage that needs Java is run. After that, the Java classes
+    can be imported directly (e.g.: `from java.lang import String`).
+
+    Raises
+        PatchError, if the patcher couldn't be loaded.
+    """
+    global PATCHER
+
+    # The parts of every app are aligned and signed from several threads
+    with PATCHER_LOCK:
+        if PATCHER is not None:
+            return PATCHER
+
+        import jpype
+        import jpype.imports
+
+        if not jpype.isJVMStarted ():
+            logger.debug ("Starting the JVM...")
+            # Required before importing the Java classes
+            # With interrupt = False, Ctrl+C raises a KeyboardInterrupt (e.g.: to stop --watch) instead of halting the JVM
+            jpype.startJVM (*JVM_OPTIONS, classpath = JAVA_CLASSPATH, interrupt = False)
+
+        from java.lang import UnsupportedClassVersionError
+        try:
+            from ApkPatcher import Patcher
+        except UnsupportedClassVersionError as e:
+            logger.debug (f"Using JVM at {jpype.getDefaultJVMPath ()}")
+            logger.error (f"(FIX) -> Try to recompile the Java library. See './Java/APK patcher/README.md'")
+            logger.error (f"(FIX 2) -> If you have another version of Java installed, try that one instead")
+            raise PatchError (f"{e}", -1)
+
+        # The messages and measurements of the Java side are sent to report_from_java(), instead of stdout
+        Patcher.setReporter (jpype.JProxy ("ApkPatcher.Reporter", dict = { "report": report_from_java }))
+
+        PATCHER = Patcher
+
+    return PATCHER
+
+
+def report_from_java (level, event, message, metrics):
+    """
+    Implementation of ApkPatcher.Reporter: logs the messages of the Java patcher, and records its measurements (if
+    --metrics or --trace are used).
+    It's called from the same thread that called the Java method.
+    """
+    logger.log (str (level), f"[JAVA] {message}")
+
+    if metrics is not None and METRICS is not None:
+        METRICS.add_java (str (event), { str (key): int (metrics [key]) for key in metrics.keySet () })
+
+
+# SigningSession for every combination of keystore and schemes (see get_signing_session())
+SIGNING_SESSIONS = {}
+# The patch server (see `serve`) runs many apps at the same time
+SIGNING_SESSIONS_LOCK = threading.Lock ()
+
+def get_signing_session (keystore_data, schemes):
+    """
+    Returns a Java SigningSession to sign many APKs with the given keystore and signature schemes.
+    The keystore is parsed only the first time, and the session is reused by all the apps patched by this process.
+
+    Args
+        keystore_data: bytes
+            Raw PKCS12 KeyStore.
+
+        schemes: [str]
+            Signature schemes to use (see SIGNATURE_SCHEMES).
+    """
+    get_patcher ()
+    from ApkPatcher import SigningSession
+
+    key = (keystore_data, tuple (sorted (schemes)))
+    with SIGNING_SESSIONS_LOCK:
+        if key not in SIGNING_SESSIONS:
+            logger.debug (f"Loading the keystore to sign with {sorted (schemes)}")
+            SIGNING_SESSIONS [key] = SigningSession (keystore_data).setSchemes (
+                    "v1" in schemes,
+                    "v2" in schemes,
+                    "v3" in schemes
+                )
+
+        return SIGNING_SESSIONS [key]
+
+
+def java_patch_bytecode (dex_data, dex_version, targets):
+    """
+    Interfaces with the custom patcher written in Java, which uses the dexlib2 library.
+    This is needed because androguard doesn't support modifying the dex files, as far as I could tell
+
+    The data is exchanged through direct ByteBuffers, so it's not copied to cross the bridge (dexlib2 still copies the
+    input once, into the Java heap).
+
+    The whole file is rebuilt, even if only a method changes. An app that hasn't been patched yet doesn't reference
+    "gadget" nor System.loadLibrary(), and adding their ids in place would renumber every string, type and method
+    sorted after them (instructions, annotations, debug info...), which is a full rewrite anyway.
+
+    Args
+        dex_data: bytes, memoryview
+            Raw dex file. Any object supporting the buffer protocol is accepted.
+
+        dex_version: int
+            Version of the dex file, or -1 to use the default one.
+
+        targets: [(str, str)]
+            Descriptor of the class and name of the method to patch. All of them are patched in a single rewrite.
+
+    Returns
+        :memoryview
+        The patched dex file, or None on error.
+    """
+    Patcher = get_patcher ()
+    import jpype.nio
+    from jpype import JArray
+    from java.lang import String
+    from java.io import IOException
+
+    output = None
+
+    logger.debug ("Interfacing with the Java patcher to modify " +
+        ", ".join (f"{class_name}->{method_name}" for class_name, method_name in targets) +
+        f" // Dex version: {dex_version}")
+
+    j_dexBuffer = jpype.nio.convertToDirectBuffer (dex_data)
+    j_classNames = JArray (String) ([ class_name for class_name, _ in targets ])
+    j_methodNames = JArray (String) ([ method_name for _, method_name in targets ])
+    j_dexVersion = dex_version # Basic type; no conversion is needed. This variable is for better code readability
+
+    try:
+        j_output = Patcher.patchDexBuffer (j_dexBuffer, j_classNames, j_methodNames, j_dexVersion)
+
+        output = memoryview (j_output)
+
+    except IOException as e:
+        logger.error (f"Exception from Java at patchDexBuffer(): {e} ")
+
+    return output
+
+
+def read_uleb128 (data, offset):
+    """
+    Decodes the unsigned LEB128 value at the given offset.
+
+    Returns
+        (:int, :int)
+        The decoded value and the offset right after it.
+    """
+    result = 0
+    shift = 0
+
+    while True:
+        byte = data [offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+
+        if byte < 0x80:
+            return result, offset
+
+
+class DexIndex:
+    """
+    Minimal DEX reader, to find the classes without parsing the whole file.
+    The data can be any buffer (e.g.: bytes, or a memoryview of a memory-mapped APK).
+
+    Only the header, string_ids, type_ids and class_defs are read when it's created. The rest (class_data_item,
+    method_ids, proto_ids...) is parsed only when it's requested.
+    https://source.android.com/docs/core/runtime/dex-format
+    """
+
+    def __init__ (self, data):
+        if data [:4] != b"dex\n":
+            raise ValueError ("Not a DEX file")
+
+        self.data = data
+        self.version = int (bytes (data [4:7]))
+
+        (
+            string_ids_size, self.string_ids_off,
+            type_ids_size, self.type_ids_off,
+            _, self.proto_ids_off,
+            _, _, # field_ids
+            self.method_ids_size, self.method_ids_off,
+            class_defs_size, self.class_defs_off
+        ) = struct.unpack_from ("<12I", data, 0x38)
+
+        self.string_ids = struct.unpack_from (f"<{string_ids_size}I", data, self.string_ids_off)
+        self.type_ids = struct.unpack_from (f"<{type_ids_size}I", data, self.type_ids_off)
+
+        # Descriptor (e.g.: "Lcom/example/Main;") => index in class_defs
+        self.classes = {}
+        for i in range (class_defs_size):
+            (class_idx,) = struct.unpack_from ("<I", data, self.class_defs_off + i * 32)
+            self.classes [self.get_string (self.type_ids [class_idx])] = i
+
+
+    def get_string (self, string_idx):
+        """
+        Returns the string with the given index in string_ids.
+        """
+        # string_data_item: uleb128 with the length in UTF-16 code units, then the MUTF-8 data ended by a NUL Byte.
+        # Every code unit takes up to 3 Bytes
+        length, start = read_uleb128 (self.data, self.string_ids [string_idx])
+        data = bytes (self.data [start:start + 3 * length + 1])
+
+        return data.split (b"\0", 1) [0].decode ("utf-8", errors = "replace")
+
+
+    def find_class (self, name):
+        """
+        Returns the descriptor of the class with the given FQN (as written on the Manifest), or None if it isn't
+        defined in this file.
+        Relative names (".Main", or just "Main") are matched against the end of the descriptors. They only get here if
+        the package of the app is unknown (see ManifestFacts.resolve_class_name()), and classes with the same name may
+        be in other packages too: in that case, the first one is used and a warning is logged.
+        """
+        descriptor = "L" + name.replace (".", "/") + ";"
+        if descriptor in self.classes:
+            return descriptor
+
+        if name.startswith (".") or "." not in name:
+            suffix = "/" + name.lstrip (".").replace (".", "/") + ";"
+            matches = [ descriptor for descriptor in self.classes if descriptor.endswith (suffix) ]
+            if len (matches) > 1:
+                logger.warning (f"The class '{name}' is ambiguous: {matches}. Using {matches [0]}")
+
+            if matches:
+                return matches [0]
+
+        return None
+
+
+    def get_prototype (self, proto_idx):
+        """
+        Returns the prototype with the given index in proto_ids, as "(<parameter types>)<return type>".
+        """
+        # proto_id_item: shorty_idx, return_type_idx, parameters_off (a type_list: size, and then the type indexes)
+        _, return_type, parameters_off = struct.unpack_from ("<3I", self.data, self.proto_ids_off + proto_idx * 12)
+
+        parameters = ()
+        if parameters_off:
+            (size,) = struct.unpack_from ("<I", self.data, parameters_off)
+            parameters = struct.unpack_from (f"<{size}H", self.data, parameters_off + 4)
+
+        return (
+            "(" + "".join (self.get_string (self.type_ids [t]) for t in parameters) + ")"
+            + self.get_string (self.type_ids [return_type])
+        )
+
+
+    def get_direct_methods (self, descriptor):
+        """
+        Returns the direct methods (constructors, static and private methods) of the given class, in the order they are
+        defined, as (name, access_flags, code_off) tuples.
+        """
+        class_def_off = self.class_defs_off + self.classes [descriptor] * 32
+        (class_data_off,) = struct.unpack_from ("<I", self.data, class_def_off + 24)
+        if not class_data_off:
+            return []
+
+        static_fields, offset = read_uleb128 (self.data, class_data_off)
+        instance_fields, offset = read_uleb128 (self.data, offset)
+        direct_methods, offset = read_uleb128 (self.data, offset)
+        _, offset = read_uleb128 (self.data, offset) # virtual_methods_size
+
+        # The fields (field_idx_diff and access_flags of each one) come before the methods, so they're skipped. The
+        # virtual methods come after the direct ones, so they don't need to be read
+        for _ in range (2 * (static_fields + instance_fields)):
+            _, offset = read_uleb128 (self.data, offset)
+
+        methods = []
+        method_idx = 0
+        for _ in range (direct_methods):
+            method_idx_diff, offset = read_uleb128 (self.data, offset)
+            access_flags, offset = read_uleb128 (self.data, offset)
+            code_off, offset = read_uleb128 (self.data, offset)
+
+            method_idx += method_idx_diff
+            # method_id_item: class_idx (ushort), proto_idx (ushort), name_idx (uint)
+            (name_idx,) = struct.unpack_from ("<I", self.data, self.method_ids_off + method_idx * 8 + 4)
+            methods.append ((self.get_string (name_idx), access_flags, code_off))
+
+        return methods
+
+
+    def get_method (self, method_idx):
+        """
+        Returns the class descriptor, name and prototype of the method with the given index in method_ids.
+        """
+        # method_id_item: class_idx (ushort), proto_idx (ushort), name_idx (uint)
+        class_idx, proto_idx, name_idx = struct.unpack_from ("<HHI", self.data, self.method_ids_off + method_idx * 8)
+
+        return (
+            self.get_string (self.type_ids [class_idx]),
+            self.get_string (name_idx),
+            self.get_prototype (proto_idx)
+        )
+
+
+    def get_constructors (self, descriptor):
+        """
+        Returns the names of the constructors (<clinit>, <init>) of the given class, in the order they are defined.
+        """
+        # Constructors are always direct methods
+        # https://source.android.com/docs/core/runtime/dex-format#access-flags
+        # 0x10000 -> constructor
+        return [ name for name, access_flags, _ in self.get_direct_methods (descriptor) if access_flags & 0x10000 ]
+
+
+def set_alignment (handle_zip_new, info, alignment, zip64 = False):
+    """
+    Replaces the extra field of an uncompressed entry with padding, so its data starts at a multiple of `alignment`
+    when it's written at the current end of handle_zip_new.
+    The padding uses the same extra field as apksigner (0xD935), which also records the alignment.
+
+    `zip64` must be True if zipfile is going to add a Zip64 extra field to the local header.
+    """
+    # Local file header (30 Bytes) + file name + our extra field (at least 6 Bytes) [+ Zip64 extra field]
+    header_size = 30 + len (info.filename.encode ("utf-8")) + 6
+    if zip64:
+        header_size += 20
+
+    padding = -(handle_zip_new.fp.tell () + header_size) % alignment
+    info.extra = struct.pack ("<HHH", ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + b"\0" * padding
+
+
+def get_alignment (filename, alignment = 4, so_alignment = 4096):
+    """
+    Returns the alignment required for the given (uncompressed) entry of the APK.
+    Native libraries are page-aligned so they can be mapped directly from the APK.
+    """
+    return so_alignment if filename.endswith (".so") else alignment
+
+
+def get_data_offset (handle_zip, info):
+    """
+    Returns the offset of the (compressed) data of the given entry within the Zip file.
+    The data starts right after the local header, whose extra field may be different from the one in the central
+    directory (that's why the length can't be taken from `info`)
+    """
+    handle_zip.fp.seek (info.header_offset)
+    local_header = handle_zip.fp.read (zipfile.sizeFileHeader)
+    name_len, extra_len = struct.unpack ("<HH", local_header [26:30])
+
+    return info.header_offset + zipfile.sizeFileHeader + name_len + extra_len
+
+
+def raw_copy_to_zip (handle_zip_original, handle_zip_new, filename, alignment = None):
+    """
+    Copies the filename from zip_original to zip_new as it is, without decompressing and compressing it again.
+    The compressed data, CRC and metadata of the original entry are kept; only the local header is written anew (to
+    drop the data descriptor and, if needed, align the data).
+    """
+    # The ZipInfo of the original is still used to read the entry (e.g.: to copy it again), so only a copy is changed
+    info = copy.copy (handle_zip_original.getinfo (filename))
+    src = handle_zip_original.fp
+    dst = handle_zip_new.fp
+
+    src.seek (get_data_offset (handle_zip_original, info))
+
+    # The sizes and CRC are already known, so they go into the local header
+    info.flag_bits &= ~ZIP_DATA_DESCRIPTOR_FLAG
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+
+    if alignment and info.compress_type == zipfile.ZIP_STORED:
+        set_alignment (handle_zip_new, info, alignment, zip64)
+
+    info.header_offset = dst.tell ()
+    dst.write (info.FileHeader (zip64))
+
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = src.read (min (remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile (f"Truncated data on {filename}")
+
+        dst.write (chunk)
+        remaining -= len (chunk)
+
+    # Registers the entry, so it's included in the central directory when handle_zip_new is closed
+    handle_zip_new.filelist.append (info)
+    handle_zip_new.NameToInfo [info.filename] = info
+    handle_zip_new.start_dir = dst.tell ()
+
+
+def get_data_size (data):
+    """
+    Returns the size of the data of a new entry (see write_entry()).
+    """
+    return data.stat ().st_size if isinstance (data, Path) else len (data)
+
+
+def write_entry (handle_zip_new, info, data):
+    """
+    Writes a new entry with the given data: either the contents (bytes, or any other buffer), or a Path to the file
+    with them, which is copied in chunks.
+    """
+    if not isinstance (data, Path):
+        handle_zip_new.writestr (info, data)
+        return
+
+    # Same condition zipfile uses for writestr(), so set_alignment() can know in advance if there will be a Zip64 field
+    info.file_size = data.stat ().st_size
+    zip64 = info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+
+    with open (data, "rb") as src, handle_zip_new.open (info, "w", force_zip64 = zip64) as dst:
+        copyfileobj (src, dst, COPY_CHUNK_SIZE)
+
+
+def copy_to_zip (handle_zip_original, handle_zip_new, filename, data = None, alignment = None):
+    """
+    Copies the filename from zip_original to zip_new.
+    If "data" is provided, those bytes are copied instead of the original file data. Otherwise, the entry is copied
+    without decompressing it (see raw_copy_to_zip()).
+
+    Args
+        handle_zip_original: ZipFile
+            Handle to the original zipfile from where to copy the data.
+
+        handle_zip_new: ZipFile
+            Handle to the new zipfile, where the data will be copied to.
+
+        filename: str
+            Path to the file that will be copied.
+
+        data: bytes, Path
+            Data to be put into the new zip, instead of the original file's data (see write_entry()).
+            The original file's metadata is kept.
+
+        alignment: int
+            If provided and the entry is not compressed, its data is aligned to this number of Bytes.
+    """
+    if data is None:
+        raw_copy_to_zip (handle_zip_original, handle_zip_new, filename, alignment)
+        return
+
+    # The metadata is kept regardless of the data we copy (see raw_copy_to_zip())
+    info = copy.copy (handle_zip_original.getinfo (filename))
+
+    if alignment and info.compress_type == zipfile.ZIP_STORED:
+        # Same condition zipfile uses for writestr()
+        set_alignment (handle_zip_new, info, alignment, get_data_size (data) * 1.05 > zipfile.ZIP64_LIMIT)
+
+    write_entry (handle_zip_new, info, data)
+
+
+def write_apk (apk_path, out_path, overlays = None, alignment = 4, so_alignment = 4096):
+    """
+    Writes a copy of the APK, with the entries in `overlays` replaced (or added), in a single pass.
+    The uncompressed entries are aligned as they are written, so the new APK doesn't have to be zipaligned.
+
+    Args
+        apk_path: Path, BundleEntry
+            The original APK. It's not modified.
+
+        out_path: str
+            Path to the new APK.
+
+        overlays: {:str => :bytes, :Path}
+            New contents of the entries to modify, by name (see write_entry()). Entries not present in the original APK
+            are added at the end, uncompressed.
+
+        alignment: int
+            Alignment (in Bytes) of the uncompressed entries.
+
+        so_alignment: int
+            Alignment (in Bytes) of the uncompressed native libraries.
+
+    Returns
+        :int
+        Number of entries written.
+    """
+    overlays = dict (overlays or {})
+
+    with (
+        open_apk (apk_path) as apk_file,
+        zipfile.ZipFile (apk_file, "r") as in_apk,
+        zipfile.ZipFile (out_path, "w") as out_apk
+    ):
+        for filename in in_apk.namelist ():
+            copy_to_zip (
+                in_apk,
+                out_apk,
+                filename,
+                overlays.pop (filename, None),
+                get_alignment (filename, alignment, so_alignment)
+            )
+
+        for filename, data in overlays.items ():
+            info = zipfile.ZipInfo (filename)
+            set_alignment (
+                out_apk,
+                info,
+                get_alignment (filename, alignment, so_alignment),
+                get_data_size (data) * 1.05 > zipfile.ZIP64_LIMIT
+            )
+            write_entry (out_apk, info, data)
+
+        return len (out_apk.infolist ())
+
+
+def get_entries_end (handle_zip):
+    """
+    Returns the offset where the local entries of the Zip file end: the start of the APK Signing Block, if there's one,
+    or the start of the central directory otherwise.
+    """
+    cd_offset = handle_zip.start_dir
+    if cd_offset < 32:
+        return cd_offset
+
+    # The block ends with its size (without counting the size field at its start) and the magic
+    handle_zip.fp.seek (cd_offset - 24)
+    size, magic = struct.unpack ("<Q16s", handle_zip.fp.read (24))
+    if magic != APK_SIGNING_BLOCK_MAGIC or size + 8 > cd_offset:
+        return cd_offset
+
+    return cd_offset - size - 8
+
+
+def get_misaligned_entries (handle_zip, alignment = 4, so_alignment = 4096):
+    """
+    Yields (filename, offset of the data, required alignment) for every uncompressed entry of the Zip file whose data
+    is not aligned yet (see get_alignment()). Only the local headers are read.
+    """
+    for info in handle_zip.infolist ():
+        if info.compress_type != zipfile.ZIP_STORED or info.is_dir ():
+            continue
+
+        required = get_alignment (info.filename, alignment, so_alignment)
+        offset = get_data_offset (handle_zip, info)
+        if offset % required:
+            yield (info.filename, offset, required)
+
+
+def is_aligned (handle_zip, alignment = 4, so_alignment = 4096):
+    """
+    Returns True if the data of every uncompressed entry of the Zip file is already aligned (see get_alignment()).
+    """
+    return next (get_misaligned_entries (handle_zip, alignment, so_alignment), None) is None
+
+
+def append_to_apk (apk_path, out_path, overlays, alignment = 4, so_alignment = 4096):
+    """
+    Like write_apk(), for new entries only: the original APK is cloned (see copy_apk()) and the new entries are written
+    after the existing ones, followed by a new central directory. The rest of the local entries are not even read, which
+    makes a difference with the ABI splits (mostly big native libraries) that only get the Frida gadget.
+
+    The old APK Signing Block is dropped, since the APK has to be signed again anyway.
+    If any of the overlays replaces an existing entry, or the uncompressed entries of the original APK are not aligned
+    yet (e.g.: for a bigger `so_alignment`), the whole APK is written with write_apk() instead.
+
+    Returns
+        :int
+        Number of entries of the new APK.
+    """
+    with open_apk (apk_path) as apk_file, zipfile.ZipFile (apk_file, "r") as in_apk:
+        names = set (in_apk.namelist ())
+        append = not names.intersection (overlays) and is_aligned (in_apk, alignment, so_alignment)
+
+    if not append:
+        logger.debug (f"Can't append the new entries to {apk_path.name}. Writing it again")
+        return write_apk (apk_path, out_path, overlays, alignment, so_alignment)
+
+    copy_apk (apk_path, out_path)
+
+    with zipfile.ZipFile (out_path, "a") as out_apk:
+        out_apk.start_dir = get_entries_end (out_apk)
+        out_apk.fp.seek (out_apk.start_dir)
+
+        for filename, data in overlays.items ():
+            info = zipfile.ZipInfo (filename)
+            set_alignment (
+                out_apk,
+                info,
+                get_alignment (filename, alignment, so_alignment),
+                get_data_size (data) * 1.05 > zipfile.ZIP64_LIMIT
+            )
+            write_entry (out_apk, info, data)
+
+        return len (out_apk.infolist ())
+
+
+def find_dex_targets (index, classes):
+    """
+    Looks for the given classes in a dex file, and for the constructor to patch in every one of them.
+
+    Args
+        index: DexIndex
+            Index of the dex file.
+
+        classes: [str]
+            FQN of the classes to look for.
+
+    Returns
+        :([str], [(str, str)])
+        The classes defined in this dex file, and the descriptor and the method to patch of every one of them (except
+        those without any constructor).
+    """
+    found = []
+    targets = []
+
+    for t in classes:
+        main_class = index.find_class (t)
+
+        if not main_class:
+            # Not the droids we're looking for...
+            continue
+
+        found.append (t)
+
+        # If there are many constructors, we just take the first one (although we could patch all of
+        # them, just in case...)
+        constructors = index.get_constructors (main_class)
+        if not constructors:
+            logger.warning (f"No constructor found for {main_class}")
+            continue
+
+        init_method = constructors [0]
+        logger.info (f"Found init method: {main_class}->{init_method}")
+        targets.append ((main_class, init_method))
+
+    return found, targets
+
+
+def get_dex_cache_key (dex_bytes, classes):
+    """
+    Returns the key, in the cache of patched dex files, of the result of patch_bytecode() on a single dex file.
+    The result only depends on the contents of the dex file (which include its version), the classes looked for in
+    it and the preamble (see DEX_CACHE_VERSION).
+    """
+    params = json.dumps ([ DEX_CACHE_VERSION, classes ]).encode ()
+
+    return f"{hashlib.sha256 (dex_bytes).hexdigest ()}/{hashlib.sha256 (params).hexdigest () [:16]}"
+
+
+def get_cached_dex (cache, key):
+    """
+    Returns the result of find_dex_targets() and the patched dex file (or None, if there was nothing to patch), as
+    stored by put_cached_dex(); or None on a miss.
+    """
+    lookup = cache.get (f"{key}/lookup")
+    if lookup is None:
+        return None
+
+    lookup = json.loads (lookup)
+    targets = [ tuple (t) for t in lookup ["targets"] ]
+    patched_dex = None
+
+    if targets:
+        # Both objects are evicted independently
+        patched_dex = cache.get (f"{key}/dex")
+        if patched_dex is None:
+            return None
+
+    return lookup ["found"], targets, patched_dex
+
+
+def put_cached_dex (cache, key, found, targets, patched_dex):
+    """
+    Stores the result of patching a single dex file (see get_cached_dex()).
+    """
+    if patched_dex is not None:
+        cache.put (f"{key}/dex", patched_dex)
+
+    cache.put (f"{key}/lookup", json.dumps ({ "found": found, "targets": targets }).encode ())
+
+
+class SpillDir:
+    """
+    Directory where the buffers bigger than `threshold` Bytes are kept as temporary files, instead of in memory, to stay
+    within the --max-memory budget. The files are removed with close().
+    """
+
+    def __init__ (self, directory, threshold):
+        self.directory = directory
+        self.threshold = threshold
+        self.count = 0
+
+        self.directory.mkdir (parents = True, exist_ok = True)
+
+
+    def get_path (self, name):
+        self.count += 1
+        return self.directory / f"{self.count}-{name.replace ('/', '_')}"
+
+
+    def read_entry (self, handle_zip, info):
+        """
+        Returns the decompressed data of the given entry: in memory if it's small, or mapped from a temporary file.
+        """
+        if info.file_size <= self.threshold:
+            return handle_zip.read (info)
+
+        path = self.get_path (info.filename)
+        logger.debug (f"Decompressing {info.filename} into {path}")
+
+        with handle_zip.open (info) as src, open (path, "wb") as dst:
+            copyfileobj (src, dst, COPY_CHUNK_SIZE)
+
+        # The pages of the map are backed by the file, so they can be dropped under memory pressure
+        with open (path, "rb") as handle:
+            return memoryview (mmap.mmap (handle.fileno (), 0, access = mmap.ACCESS_READ))
+
+
+    def spill (self, data, name):
+        """
+        Returns the data as it is if it's small, or the Path of a temporary file with it (see write_entry()).
+        """
+        if data is None or isinstance (data, Path) or len (data) <= self.threshold:
+            return data
+
+        path = self.get_path (name)
+        logger.debug (f"Moving {name} into {path}")
+        path.write_bytes (data)
+
+        return path
+
+
+    def close (self):
+        rmtree (self.directory, ignore_errors = True)
+
+
+def get_spill_dir (directory, max_memory):
+    """
+    Returns the SpillDir for the given --max-memory budget (in MB), or None if there's no budget.
+    """
+    if not max_memory:
+        return None
+
+    return SpillDir (directory, max (COPY_CHUNK_SIZE, int (max_memory * 1024 * 1024 * SPILL_SHARE)))
+
+
+def patch_bytecode (main_apk_path, target_classes, cache = None, spill = None):
+    """
+    Finds the specified classes withing the main APK and patches their Bytecode to load the library "libgadget.so".
+    The classes may be spread across many dex files, but every dex file is parsed and patched only once, with all the
+    classes it defines.
+
+    Args
+        main_apk_path: Path, BundleEntry
+            The APK containing the AndroidManifest.xml
+
+        target_class: [str]
+            FQN of the classes to patch, as extracted by read_manifest()
+
+        cache: FileCache
+            Cache of patched dex files. On a hit, the dex file is neither parsed nor patched; and the classes it
+            defines are taken from the cache too.
+
+        spill: SpillDir
+            If provided, the big dex files (original and patched) are kept in temporary files instead of in memory.
+
+    Returns
+        {:str => :memoryview, :Path}
+        The patched dex files, as { "<dex name>": <patched dex> }, to be written with write_apk().
+        On error, an empty dictionary is returned.
+    """
+    overlays = {}
+    apk_map = None
+    pending = list (target_classes)
+
+    with open_apk (main_apk_path) as apk_file, zipfile.ZipFile (apk_file, "r") as apk:
+        for filename in apk.namelist ():
+
+            if pending and filename.endswith (".dex"):
+
+                info = apk.getinfo (filename)
+                if info.compress_type == zipfile.ZIP_STORED and apk_map is None:
+                    try:
+                        apk_map = mmap.mmap (apk_file.fileno (), 0, access = mmap.ACCESS_READ)
+                    except (OSError, ValueError):
+                        # e.g.: a compressed APK inside a bundle
+                        apk_map = False
+
+                if info.compress_type == zipfile.ZIP_STORED and apk_map:
+                    # Uncompressed dex files are read straight from the APK (or from the bundle containing it), and
+                    # handed over as they are to the Java patcher. The map is not closed explicitly: the JVM may still
+                    # be using it, and it's released once nobody references it
+                    offset = getattr (apk_file, "offset", 0) + get_data_offset (apk, info)
+                    dex_bytes = memoryview (apk_map) [offset:offset + info.file_size]
+                elif spill:
+                    dex_bytes = spill.read_entry (apk, info)
+                else:
+                    dex_bytes = apk.read (filename)
+
+                key = get_dex_cache_key (dex_bytes, pending) if cache else None
+                cached = get_cached_dex (cache, key) if cache else None
+
+                if cached is not None:
+                    found, targets, patched_dex = cached
+                    if targets:
+                        logger.info (f"Using the cached patch of {filename}")
+
+                else:
+                    logger.info (f"Indexing {filename}...")
+                    index = DexIndex (dex_bytes)
+
+                    found, targets = find_dex_targets (index, pending)
+
+                    patched_dex = None
+                    if targets:
+                        patched_dex = java_patch_bytecode (dex_bytes, index.version, targets)
+                        if not patched_dex:
+                            logger.error (f"Couldn't patch the desired methods in {filename}")
+                            return {}
+
+                    if cache:
+                        put_cached_dex (cache, key, found, targets, patched_dex)
+
+                for t in found:
+                    pending.remove (t)
+
+                if patched_dex is not None:
+                    overlays [filename] = spill.spill (patched_dex, filename) if spill else patched_dex
+
+    for t in pending:
+        logger.warning (f"Class {t} not found in any dex file")
+
+    if not overlays:
+        logger.error ("None of the entry points could be patched")
+
+    return overlays
+
+
+def get_arch_from_filename (filename):
+    """
+    Deducts the required architecture(s) from the file name.
     If no arch could be deduced, then all possibilities are returned.
 
-    The expected file name is: com.test.config.<ABI>.apk
+    The expected file name is: com.test.config.<ABI>.apk (or any other name supported by get_split_config())
+    """
+    # Thanks to Pathlib.stem, we can just take out the .apk extension
+    # and then get the '<ABI>' part using .stem.split (".")[-1]
+    # This way, no index checking has to be performed ([-1] always exists)
+    abi = get_split_config (filename.name) or filename.stem.split (".")[-1]
+    all_arch = [ ABI_MAPPING[x] for x in ABI_MAPPING ]
+
+    logger.debug (f"Inferred ABI from file {filename}: {abi}")
+
+    # Filenames do not have '-', but use '_'
+    abi = abi.replace ("_", "-")
+    if not abi in ABI_MAPPING:
+        logger.debug (f"Failed to find {abi} within the ABI_MAPPING: {ABI_MAPPING}")
+        return all_arch
+
+    return [ ABI_MAPPING [abi] ]
+
+
+def arch_to_dirname (arch):
+    """
+    Converts the given arch to the dirname expected inside an APK.
+    If the requested architecture was not found, this method returns None
+    """
+    for abi in ABI_MAPPING:
+        if ABI_MAPPING [abi] == arch:
+            return abi
+
+    return None
+
+
+def atomic_write (path, data):
+    """
+    Writes the data into a temporary sibling of `path` and then renames it, so other processes never see a
+    partially written file.
+    """
+    tmp_path = path.with_name (f"{path.name}.{os.getpid ()}.tmp")
+    tmp_path.write_bytes (data)
+    os.replace (tmp_path, path)
+
+
+def hash_file (path):
+    """
+    Returns the SHA-256 (in hex) of the given file (or BundleEntry), read in chunks.
+    """
+    digest = hashlib.sha256 ()
+
+    with open_apk (path) as handle:
+        while chunk := handle.read (COPY_CHUNK_SIZE):
+            digest.update (chunk)
+
+    return digest.hexdigest ()
+
+
+def clone_file (src, dst, hardlink = False):
+    """
+    Copies `src` to `dst` (which must not exist) as cheaply as the filesystem allows.
+
+    With `hardlink`, both paths point to the same file if possible, so none of them must be modified in place later.
+    Otherwise (or if they're on different filesystems), the data is copied with copy_file_range(), which shares the
+    blocks (reflink) on filesystems like btrfs or XFS; and, if that's not available either, with a regular copy.
+    """
+    if hardlink:
+        try:
+            os.link (src, dst)
+            return
+        except OSError:
+            pass
+
+    with open (src, "rb") as fsrc, open (dst, "wb") as fdst:
+        try:
+            remaining = os.fstat (fsrc.fileno ()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range (fsrc.fileno (), fdst.fileno (), remaining)
+                if not copied:
+                    break
+
+                remaining -= copied
+
+        except (AttributeError, OSError):
+            # Not supported by the OS (or between these filesystems)
+            fsrc.seek (0)
+            fdst.seek (0)
+            fdst.truncate ()
+            copyfileobj (fsrc, fdst, COPY_CHUNK_SIZE)
+
+
+class FileCache:
+    """
+    Content-addressed cache on disk.
+
+    The data is stored under `<root>/objects/<sha256>` and every key is a small file under `<root>/refs/<key>` with
+    the digest of the object it points to. Since the name of every object is its own checksum, corrupted entries are
+    detected (and discarded) when they are read.
+
+    The modification time of the objects is updated on every hit, so the least recently used ones are evicted first
+    when the total size goes over `max_size` Bytes.
+    """
+
+    def __init__ (self, root, max_size = None):
+        self.root = Path (root)
+        self.max_size = max_size
+        self.objects = self.root / "objects"
+        self.refs = self.root / "refs"
+
+
+    def get (self, key):
+        """
+        Returns the cached data for the given key, or None if it's not in the cache (or its checksum doesn't match).
+        Keys are relative paths, like "frida-gadget/16.4.8/arm64".
+        """
+        ref = self.refs / key
+
+        try:
+            digest = ref.read_text ().strip ()
+            obj = self.objects / digest
+            data = obj.read_bytes ()
+        except OSError:
+            return None
+
+        if hashlib.sha256 (data).hexdigest () != digest:
+            logger.warning (f"Checksum mismatch on the cached {key}. Discarding it...")
+            obj.unlink (missing_ok = True)
+            ref.unlink (missing_ok = True)
+            return None
+
+        # Marks the object as recently used
+        os.utime (obj)
+        logger.debug (f"Cache hit: {key} ({digest})")
+
+        return data
+
+
+    def put (self, key, data):
+        """
+        Stores the data under the given key and evicts the oldest entries, if needed.
+        Returns the digest of the data.
+        """
+        digest = hashlib.sha256 (data).hexdigest ()
+        obj = self.objects / digest
+        ref = self.refs / key
+
+        self.objects.mkdir (parents = True, exist_ok = True)
+        ref.parent.mkdir (parents = True, exist_ok = True)
+
+        if obj.exists ():
+            os.utime (obj)
+        else:
+            atomic_write (obj, data)
+
+        atomic_write (ref, digest.encode ())
+        logger.debug (f"Cached {key} ({digest})")
+
+        self.evict ()
+
+        return digest
+
+
+    def get_path (self, key):
+        """
+        Like get(), but returns the path to the cached object (once its checksum has been verified) instead of its
+        contents. The file must not be modified.
+        """
+        ref = self.refs / key
+
+        try:
+            digest = ref.read_text ().strip ()
+            obj = self.objects / digest
+            valid = hash_file (obj) == digest
+        except OSError:
+            return None
+
+        if not valid:
+            logger.warning (f"Checksum mismatch on the cached {key}. Discarding it...")
+            obj.unlink (missing_ok = True)
+            ref.unlink (missing_ok = True)
+            return None
+
+        os.utime (obj)
+        logger.debug (f"Cache hit: {key} ({digest})")
+
+        return obj
+
+
+    def get_file (self, key, path):
+        """
+        Like get(), but the cached data is placed at `path` (hardlinked, if possible; see clone_file()) instead of
+        being read into memory. Since the file may be shared with the cache, it must not be modified in place.
+        Returns True on a hit.
+        """
+        obj = self.get_path (key)
+        if obj is None:
+            return False
+
+        clone_file (obj, path, hardlink = True)
+
+        return True
+
+
+    def put_file (self, key, path):
+        """
+        Like put(), but the data is taken from the file at `path`, which is hardlinked into the cache (if possible)
+        instead of being copied. The file must not be modified in place afterwards.
+        Returns the digest of the data.
+        """
+        digest = hash_file (path)
+        obj = self.objects / digest
+        ref = self.refs / key
+
+        self.objects.mkdir (parents = True, exist_ok = True)
+        ref.parent.mkdir (parents = True, exist_ok = True)
+
+        if obj.exists ():
+            os.utime (obj)
+        else:
+            tmp_path = obj.with_name (f"{obj.name}.{os.getpid ()}.{threading.get_ident ()}.tmp")
+            try:
+                clone_file (path, tmp_path, hardlink = True)
+                os.replace (tmp_path, obj)
+            finally:
+                tmp_path.unlink (missing_ok = True)
+
+        atomic_write (ref, digest.encode ())
+        logger.debug (f"Cached {key} ({digest})")
+
+        self.evict ()
+
+        return digest
+
+
+    def put_chunks (self, key, chunks):
+        """
+        Like put(), but the data is written as it's generated by the iterable `chunks`, so it doesn't have to be in
+        memory at once. If the iterable raises an exception, nothing is stored.
+        Returns the digest of the data.
+        """
+        ref = self.refs / key
+        sha256 = hashlib.sha256 ()
+
+        self.objects.mkdir (parents = True, exist_ok = True)
+        ref.parent.mkdir (parents = True, exist_ok = True)
+
+        tmp_path = self.objects / f"chunks.{os.getpid ()}.{threading.get_ident ()}.tmp"
+        try:
+            with open (tmp_path, "wb") as handle:
+                for chunk in chunks:
+                    sha256.update (chunk)
+                    handle.write (chunk)
+
+            digest = sha256.hexdigest ()
+            os.replace (tmp_path, self.objects / digest)
+        finally:
+            tmp_path.unlink (missing_ok = True)
+
+        atomic_write (ref, digest.encode ())
+        logger.debug (f"Cached {key} ({digest})")
+
+        self.evict ()
+
+        return digest
+
+
+    def keys (self, prefix = ""):
+        """
+        Returns all the keys under the given prefix (e.g.: "frida-gadget/").
+        """
+        base = self.refs / prefix
+        if not base.is_dir ():
+            return []
+
+        return [
+            p.relative_to (self.refs).as_posix ()
+            for p in base.rglob ("*")
+            if p.is_file () and not p.name.endswith (".tmp")
+        ]
+
+
+    def evict (self):
+        """
+        Removes the least recently used objects (and the refs pointing to them) until the cache fits in `max_size`.
+        """
+        if self.max_size is None or not self.objects.is_dir ():
+            return
+
+        # Temporary files (with a '.' on their name) may belong to another process still writing them
+        objects = [ (p.stat (), p) for p in self.objects.iterdir () if "." not in p.name ]
+        total = sum (st.st_size for st, _ in objects)
+        evicted = set ()
+
+        for st, obj in sorted (objects, key = lambda x: x [0].st_mtime):
+            if total <= self.max_size:
+                break
+
+            logger.debug (f"Evicting {obj} from the cache ({st.st_size} Bytes)")
+            obj.unlink (missing_ok = True)
+            evicted.add (obj.name)
+            total -= st.st_size
+
+        if not evicted:
+            return
+
+        for key in self.keys ():
+            ref = self.refs / key
+            try:
+                if ref.read_text ().strip () in evicted:
+                    ref.unlink ()
+            except OSError:
+                pass
+
+
+class MemoryCache:
+    """
+    Keeps in memory every object read from (or written to) a FileCache, and the location of every file already
+    verified, so a long-running process (see `serve`) only reads them from disk once. It can be used anywhere a
+    FileCache is expected.
+    """
+
+    def __init__ (self, cache):
+        self.cache = cache
+        self.objects = {}
+        self.paths = {}
+        self.lock = threading.Lock ()
+
+
+    def get (self, key):
+        with self.lock:
+            if key in self.objects:
+                return self.objects [key]
+
+        data = self.cache.get (key)
+        if data is not None:
+            with self.lock:
+                self.objects [key] = data
+
+        return data
+
+
+    def get_path (self, key):
+        with self.lock:
+            path = self.paths.get (key)
+
+        # It may have been evicted by another process
+        if path is not None and path.exists ():
+            return path
+
+        path = self.cache.get_path (key)
+        with self.lock:
+            self.paths [key] = path
+
+        return path
+
+
+    def put (self, key, data):
+        digest = self.cache.put (key, data)
+
+        with self.lock:
+            self.objects [key] = data
+
+        return digest
+
+
+    def put_chunks (self, key, chunks):
+        digest = self.cache.put_chunks (key, chunks)
+
+        with self.lock:
+            self.paths.pop (key, None)
+
+        return digest
+
+
+    def keys (self, prefix = ""):
+        return self.cache.keys (prefix)
+
+
+def version_key (version):
+    """
+    Sorting key for version strings like "16.4.8". Non-numeric parts are ignored.
+    """
+    return [ int (x) for x in re.findall (r"\d+", version) ]
+
+
+def get_frida_release (version = None):
+    """
+    Gets the metadata of the specified Frida release (or the latest one, if no version is provided) from GitHub.
+    Returns the parsed JSON, or None on error.
+    """
+    import requests
+
+    url = FRIDA_TAG_URL.format (version = version) if version else FRIDA_ASSETS_URL
+
+    logger.info (f"Requesting {url}")
+    r = requests.get (url)
+    if r.status_code != 200:
+        logger.error (f"Couldn't GET {url} . Response code: {r.status_code} {r.reason}")
+        return None
+
+    return r.json ()
+
+
+def resolve_frida_version (version = None, cache = None, offline = False):
+    """
+    Determines which Frida version to use.
+
+    Returns
+        (:str, :dict)
+        The version and, if it had to be requested, the release metadata (as returned by get_frida_release()).
+        If no version could be determined, (None, None) is returned.
+    """
+    if version:
+        return version, None
+
+    if offline:
+        cached = set (key.split ("/") [1] for key in cache.keys ("frida-gadget/")) if cache else set ()
+        if not cached:
+            logger.error ("Running in offline mode, but there are no cached gadgets to use")
+            return None, None
+
+        version = max (cached, key = version_key)
+        logger.info (f"Using Frida version {version} (newest in cache)")
+        return version, None
+
+    release = get_frida_release ()
+    if release is None:
+        return None, None
+
+    version = release ["tag_name"]
+    logger.info (f"Using Frida version {version} (latest)")
+
+    return version, release
+
+
+def download_frida_gadget (asset, key, cache):
+    """
+    Downloads the given asset of a Frida release (the .xz of a gadget) and stores it, decompressed, under `key` in the
+    cache. The response is decompressed as it arrives, so only a few chunks are in memory at any time.
+
+    Raises
+        ValueError, if the asset couldn't be downloaded or its checksum doesn't match.
+    """
+    import requests
+
+    download_url = asset ["browser_download_url"]
+    logger.info (f"Located {asset ['name']} @ {download_url}")
+
+    with requests.get (download_url, stream = True) as r:
+        if r.status_code != 200:
+            raise ValueError (f"Couldn't GET {download_url} . Response code: {r.status_code} {r.reason}")
+
+        decompressor = LZMADecompressor (format = FORMAT_XZ)
+        xz_digest = hashlib.sha256 ()
+
+        def decompressed_chunks ():
+            for chunk in r.iter_content (COPY_CHUNK_SIZE):
+                xz_digest.update (chunk)
+                yield decompressor.decompress (chunk, COPY_CHUNK_SIZE)
+
+                # The output of every chunk is bounded too
+                while not decompressor.needs_input and not decompressor.eof:
+                    yield decompressor.decompress (b"", COPY_CHUNK_SIZE)
+
+            if not decompressor.eof:
+                raise ValueError (f"Truncated download of {asset ['name']}")
+
+            # Newer releases include the checksum of every asset, like "sha256:<hex>". The gadget is only added to
+            # the cache if it matches
+            expected = asset.get ("digest")
+            if expected and expected.startswith ("sha256:") and xz_digest.hexdigest () != expected.split (":", 1) [1]:
+                raise ValueError (f"Checksum mismatch on the downloaded {asset ['name']}")
+
+        cache.put_chunks (key, decompressed_chunks ())
+
+
+def get_frida_gadgets (architectures, version, release = None, cache = None, offline = False):
+    """
+    Returns the decompressed Frida gadgets (libgadget.so) for the given architectures and version.
+    The gadgets missing from the cache are downloaded (all of them at the same time) from the assets of the release,
+    which is requested only once if it wasn't provided.
+
+    Args
+        cache: FileCache
+            Cache where the gadgets are looked for and stored. The returned paths point into it.
+
+    Returns
+        {:str => :Path}
+        The decompressed gadget of every architecture that could be retrieved.
+    """
+    gadgets = {}
+    missing = []
+
+    for arch in dict.fromkeys (architectures):
+        path = cache.get_path (f"frida-gadget/{version}/{arch}")
+        if path is not None:
+            gadgets [arch] = path
+        else:
+            missing.append (arch)
+
+    if not missing:
+        return gadgets
+
+    if offline:
+        logger.error (f"The gadgets for {missing} (Frida {version}) are not in the cache, and we're running in offline mode")
+        return gadgets
+
+    if release is None:
+        release = get_frida_release (version)
+        if release is None:
+            return gadgets
+
+    assets = { asset ["name"]: asset for asset in release ["assets"] }
+    downloads = {}
+
+    with ThreadPoolExecutor (max_workers = len (missing)) as pool:
+        for arch in missing:
+            target = f"frida-gadget-{version}-android-{arch}.so.xz"
+            if target not in assets:
+                logger.error (f"Couldn't find {target} within the assets of Frida {version}")
+                continue
+
+            downloads [arch] = pool.submit (download_frida_gadget, assets [target], f"frida-gadget/{version}/{arch}", cache)
+
+        for arch, future in downloads.items ():
+            try:
+                future.result ()
+            except Exception as e:
+                logger.error (f"Couldn't download the gadget for {arch}: {e}")
+                continue
+
+            path = cache.get_path (f"frida-gadget/{version}/{arch}")
+            if path is not None:
+                gadgets [arch] = path
+
+    return gadgets
+
+
+def get_native_abis (apk_path):
+    """
+    Returns the ABIs with native libraries (lib/<abi>/*.so) in the given APK (or BundleEntry).
+    Only the central directory is read.
+    """
+    with open_apk (apk_path) as apk_file, zipfile.ZipFile (apk_file, "r") as apk:
+        names = apk.namelist ()
+
+    abis = {}
+    for name in names:
+        parts = name.split ("/")
+        if len (parts) == 3 and parts [0] == "lib" and parts [2].endswith (".so"):
+            abis [parts [1]] = True
+
+    return list (abis)
+
+
+def get_gadget_abis (apk_path, forced_arch = None, manifest = None):
+    """
+    Returns the ABIs whose gadget has to be added to the given APK, with their Frida architecture.
+
+    The ABIs are the ones the APK already has native libraries for. Adding any other one would only make the APK bigger
+    or, worse, make the device pick an ABI for which the rest of the libraries of the app are missing.
+    The APKs without native libraries get no gadget at all, unless it's the main APK of an app without ABI splits: in
+    that case the device can pick any ABI, so the gadgets of all of them are added (see get_arch_from_filename()).
+    If none of the ABI splits of an app has native libraries, nothing is returned for any of them, yet each one must
+    still get the gadget of the ABI in its name (see get_arch_from_filename()), since the patched entry point loads it.
+
+    Args
+        apk_path: Path, BundleEntry
+            The APK to inspect.
+
+        forced_arch: str
+            ABI (or Frida architecture) passed with --arch, which bypasses the detection.
+
+        manifest: ManifestFacts
+            Manifest of the app, to warn when its native libraries should be on ABI splits that are missing.
+
+    Returns
+        {:str => :str}
+        The Frida architecture of every ABI (e.g.: { "arm64-v8a": "arm64" }).
+    """
+    if forced_arch:
+        arch = ABI_MAPPING.get (forced_arch, forced_arch)
+        return { arch_to_dirname (arch) or forced_arch: arch }
+
+    abis = {}
+    for abi in get_native_abis (apk_path):
+        if abi in NATIVE_ABI_MAPPING:
+            abis [abi] = NATIVE_ABI_MAPPING [abi]
+        else:
+            logger.warning (f"There's no Frida gadget for the ABI '{abi}' of {apk_path.name}")
+
+    if abis:
+        logger.debug (f"Native libraries found on {apk_path.name}: {list (abis)}")
+        return abis
+
+    if get_split_type (apk_path.name) == "abi":
+        logger.info (f"{apk_path.name} has no native libraries, so no gadget is added to it")
+        return abis
+
+    if manifest is not None and "base__abi" in manifest.required_split_types:
+        logger.warning ("The app requires ABI splits, but none were found. Adding the gadgets of all the ABIs")
+
+    return { arch_to_dirname (arch): arch for arch in get_arch_from_filename (apk_path) }
+
+
+def add_native_lib_to_apk (apk_path, frida_script = None, gadget_config = None, forced_arch = None, forced_dir = None,
+                           frida_version = None, offline = False, cache = None, frida_release = None, gadgets = None,
+                           manifest = None, abis = None):
+    """
+    Gets the Frida gadget (from the cache or GitHub) for the architecture(s) of the given APK (see get_gadget_abis()).
+
+    If the gadgets have already been retrieved with get_frida_gadgets() (e.g.: for all the splits of the app at once),
+    they can be provided in `gadgets`. Otherwise, they're retrieved here. The same goes for the ABIs, in `abis`.
+
+    Returns
+        {:str => :bytes, :Path}
+        The new entries (libgadget.so and, if provided, the config and the script) to add to the APK with write_apk().
+        The gadgets are given as the path to the file in the cache.
+
+    Raises
+        PatchError, if the gadget of any of the ABIs couldn't be retrieved. The patched entry point would load a
+        library that isn't there, and the app would crash at launch.
+    """
+    if abis is None:
+        abis = get_gadget_abis (apk_path, forced_arch, manifest)
+    overlays = {}
+
+    if not abis:
+        return overlays
+
+    if gadgets is None:
+        frida_version, resolved_release = resolve_frida_version (frida_version, cache, offline)
+        if frida_version is None:
+            raise PatchError ("Couldn't determine the Frida version to use", -5)
+
+        gadgets = get_frida_gadgets (abis.values (), frida_version, frida_release or resolved_release, cache, offline)
+
+    missing = [ arch for arch in dict.fromkeys (abis.values ()) if arch not in gadgets ]
+    if missing:
+        raise PatchError (f"Couldn't retrieve the Frida gadget for {', '.join (missing)}", -5)
+
+    for abi, arch in abis.items ():
+        logger.info (f"Processing architecture {arch}")
+
+        lib = gadgets [arch]
+        dirname = forced_dir if forced_dir else ("lib/" + abi)
+
+        overlays [f"{dirname}/libgadget.so"] = lib
+        if gadget_config:
+            overlays [f"{dirname}/libgadget.config.so"] = gadget_config
+        if frida_script:
+            overlays [f"{dirname}/libgadget.js.so"] = frida_script
+        logger.debug (f"Added all *.so to {apk_path.name}!{dirname}/")
+
+    return overlays
+
+
+def get_full_filelist (parts, use_basename = False):
+    """
+    Given a dictionary generated by `find_apk_parts()`, gets all the filenames of each part and
+    returns them as a list.
+
+    The argument `use_basename` controls whether the full Path (as an object) or the file basename (as a string)
+    should be included in the list.
+
+    Expected input format:
+        {
+            "main": "test.apk", // This is the only mandatory item. The other keys may or may not be present
+            "abi": [
+                "test.config.armeabi_v7a.apk",
+                "test.config.arm64_v8a.apk"
+            ],
+            "density": [
+                "test.config.xxhdpi.apk",
+                "test.config.ldpi.apk"
+            ],
+            "lang": [
+                "test.config.en.apk",
+                "test.config.de.apk"
+            ]
+        }
+    """
+    files = []
+
+    # If "main" is not there, something is very wrong. I'll let that fail
+    files.append (parts ["main"].name if use_basename else parts ["main"])
+
+    for k in [ "abi", "density", "lang" ]:
+        if k in parts:
+            if use_basename:
+                for p in parts [k]:
+                    files.append (p.name)
+            else:
+                files += parts [k]
+
+    return files
+
+
+def add_permission (manifest_xml, permission_name):
+    """
+    Adds the specified permission to the given XML object (lxml.etree.Element or xml.etree.ElementTree), which is
+    expected to have the AndroidManifest.xml format (i.e.: the element "manifest" must at be the root).
+
+    The permission name must be the full one (i.e.: "android.permission.INTERNET", not just "INTERNET")
+    """
+    try:
+        from lxml import etree
+    except ImportError:
+        import xml.etree.ElementTree as etree
+
+    android_name = "{http://schemas.android.com/apk/res/android}name"
+
+    new_perm = etree.Element ("uses-permission")
+    new_perm.attrib [android_name] = permission_name
+
+    # https://developer.android.com/guide/topics/manifest/uses-permission-element
+    # <uses-permission> is contained within <manifest>, which is the (assumed) root
+    # of manifest_xml
+    manifest_xml.append (new_perm)
+
+
+def set_extract_native_libs (manifest_xml):
+    """
+    Parses the given XML object (lxml.etree.Element or xml.etree.ElementTree), which is
+    expected to have the AndroidManifest.xml format (i.e.: the element "application" must exist), and
+    sets the attribute `android:extractNativeLibs` to True, if it's not already set.
+    """
+    android_extractNativeLibs = "{http://schemas.android.com/apk/res/android}extractNativeLibs"
+
+    for app in manifest_xml.findall ("application"):
+        if not app.attrib [android_extractNativeLibs] \
+            or app.attrib [android_extractNativeLibs] == "false":
+
+            logger.debug ("android:extractNativeLibs was set to false. Patching...")
+            app.attrib [android_extractNativeLibs] = "true"
+
+
+
+def fix_manifest (manifest):
+    """
+    Modifies the AndroidManifest.xml of the given APK.
+    The following items are modified:
+        - Add `<uses-permission android:name="android.permission.INTERNET" />`, if not already present
+        - Add `extractNativeLibs=true`, if not already present
+
+    Args
+        manifest: ManifestFacts
+            The manifest of the main APK, as returned by read_manifest().
+
+    Returns
+        {:str => :bytes}
+        The re-encoded manifest, as { "AndroidManifest.xml": <AXML> }, to be written with write_apk().
+        If nothing has to be changed, an empty dictionary is returned.
+    """
+    filename = "AndroidManifest.xml"
+
+    inet_perm = "android.permission.INTERNET"
+    if not manifest.has_permission (inet_perm):
+        logger.debug (f"No {inet_perm} permission.")
+        logger.warning ("It's possible that the gadget has no internet connectivity. Check `logcat` for messages like `Frida: Failed to start: Unable to create socket: Operation not permitted`")
+        # FIXME
+#        add_permission (xml, inet_perm)
+    else:
+        logger.debug (f"App has {inet_perm} permission.")
+
+    # The libraries are extracted by default, so the manifest only has to be re-encoded if it's explicitly disabled
+    if manifest.application.get ("extractNativeLibs") != "false":
+        logger.debug ("android:extractNativeLibs is not disabled. The manifest is left as it is")
+        return {}
+
+    import pyaxml.axml
+
+    axml, _ = pyaxml.AXML.from_axml (manifest.raw)
+    xml = axml.to_xml ()
+
+    set_extract_native_libs (xml)
+#    print (etree.tostring (xml, pretty_print = True).decode ("utf-8"))
+
+    reencoded_axml = pyaxml.axml.AXML ()
+    reencoded_axml.from_xml (xml)
+
+#    asdf, _ = pyaxml.AXML.from_axml (reencoded_axml.pack ())
+#    print ("============================")
+#    print (etree.tostring (asdf.to_xml (), pretty_print = True).decode ("utf-8"))
+
+    #################
+    # FIXME: seems to break the resulting AXML:
+    # $ aapt2 d xmltree --file AndroidManifest.xml patched_output/app-debug.apk
+    # ResourceType W 08-09 11:26:14 25258 25258] XML size 0x856 or headerSize 0x1c is not on an integer boundary.
+    # patched_output/app-debug.apk: error: failed to parse binary AndroidManifest.xml: failed to initialize ResXMLTree.
+    #
+    # For the moment, the original manifest ( `return {}` ) is preserved
+    #################
+
+    return { filename: reencoded_axml.pack () }
+#    logger.warning ("[FIXME] Patching of the AndroidManifest.xml tends to fail. Discarding patch...")
+#    return {}
+
+
+def get_signature_schemes (schemes, min_sdk):
+    """
+    Returns the signature schemes to use: the ones requested with --schemes or, if None, the ones needed by an app
+    supporting the given minSdkVersion.
+    """
+    if schemes is not None:
+        return schemes
+
+    # v1 is slow (it digests every entry) and only needed before Android 7.0
+    schemes = [ "v2", "v3" ]
+    if min_sdk < V2_MIN_SDK:
+        schemes.append ("v1")
+
+    return schemes
+
+
+def get_split_cache_params (keystore_data, schemes, so_alignment):
+    """
+    Returns the part of the key, in the cache of signed splits, shared by all the splits finalized with the same
+    parameters: the key (its fingerprint, not the key itself), the signature schemes and the alignment.
+    """
+    params = json.dumps ([
+            SPLIT_CACHE_VERSION,
+            hashlib.sha256 (keystore_data).hexdigest (),
+            sorted (schemes),
+            so_alignment
+        ])
+
+    return hashlib.sha256 (params.encode ()).hexdigest () [:16]
+
+
+def finalize_apk (apk_path, out_path, signer, so_alignment = 4096, cache = None, cache_params = None):
+    """
+    Signs the APK at `out_path` with the given SigningSession (see get_signing_session()).
+    If it's not there (because it wasn't modified), the original APK is copied and zipaligned first (with the native
+    libraries aligned to `so_alignment`). The modified ones are already aligned by write_apk().
+
+    The aligned and signed copies of the unmodified APKs only depend on their contents and `cache_params` (see
+    get_split_cache_params()), so they are kept in `cache` (if provided) and hardlinked from there the next time.
+    """
+    logger.debug (f"Processing {out_path}")
+
+    key = None
+    if cache and not out_path.exists ():
+        key = f"{hash_file (apk_path)}/{cache_params}"
+
+        if cache.get_file (key, out_path):
+            logger.debug (f"Using the cached signed copy of {apk_path}")
+            return
+
+    Patcher = get_patcher ()
+
+    if not out_path.exists ():
+        logger.debug (f"Copying unmodified file: {apk_path}")
+        copy_apk (apk_path, out_path)
+
+        logger.debug (f"Zipaligning {out_path}...")
+        Patcher.zipAlign (str (out_path), 4, so_alignment)
+
+    # We have to sign all parts with the same key, regardless of whether
+    # we modified them or not
+    logger.debug (f"Signing {out_path}...")
+    tmp_path = out_path.with_name (f"{out_path.name}.signed.tmp")
+    signer.sign (str (out_path), str (tmp_path))
+    os.replace (tmp_path, out_path)
+
+    if key is not None:
+        cache.put_file (key, out_path)
+
+
+def get_axml_errors (data):
+    """
+    Checks the layout of the chunks of a binary XML file (see iter_axml()), which is more lenient than Android: the
+    sizes in the headers must match the file, and every chunk must be 4-Byte aligned.
+
+    Returns
+        [:str]
+        The problems found (an empty list if there are none).
+    """
+    if len (data) < 8:
+        return [ "The file is too short" ]
+
+    file_type, header_size, file_size = struct.unpack_from ("<HHI", data)
+    if file_type != AXML_FILE:
+        return [ f"Unknown file type {file_type:#x}" ]
+
+    errors = []
+    if file_size != len (data):
+        errors.append (f"The header says the file has {file_size} Bytes, but it has {len (data)}")
+
+    offset = header_size
+    while offset < len (data):
+        if offset + 8 > len (data):
+            errors.append (f"Truncated chunk at {offset:#x}")
+            break
+
+        chunk_type, header_size, chunk_size = struct.unpack_from ("<HHI", data, offset)
+        if header_size < 8 or chunk_size < header_size:
+            errors.append (f"Invalid header of the chunk at {offset:#x}")
+            break
+
+        if offset + chunk_size > len (data):
+            errors.append (f"The chunk at {offset:#x} ({chunk_size} Bytes) goes past the end of the file")
+            break
+
+        if chunk_size % 4:
+            errors.append (f"The size of the chunk {chunk_type:#06x} at {offset:#x} ({chunk_size}) is not a multiple of 4")
+
+        if chunk_type == AXML_STRING_POOL:
+            count, _, _, strings_start = struct.unpack_from ("<4I", data, offset + 8)
+            string_offsets = struct.unpack_from (f"<{count}I", data, offset + header_size)
+            if any (strings_start + string_offset >= chunk_size for string_offset in string_offsets):
+                errors.append (f"The string pool at {offset:#x} points past its end")
+
+        offset += chunk_size
+
+    return errors
+
+
+def get_dex_errors (data):
+    """
+    Checks the header of a dex file: its size, checksum (Adler-32) and signature (SHA-1), and that the map_list is
+    within the file.
+
+    Returns
+        [:str]
+        The problems found (an empty list if there are none).
+    """
+    errors = []
+
+    (checksum,) = struct.unpack_from ("<I", data, 8)
+    (file_size,) = struct.unpack_from ("<I", data, 0x20)
+    (map_off,) = struct.unpack_from ("<I", data, 0x34)
+
+    if file_size != len (data):
+        errors.append (f"The header says the file has {file_size} Bytes, but it has {len (data)}")
+
+    if zlib.adler32 (memoryview (data) [12:]) != checksum:
+        errors.append ("Wrong checksum")
+
+    if hashlib.sha1 (memoryview (data) [32:]).digest () != bytes (data [12:32]):
+        errors.append ("Wrong signature")
+
+    if map_off + 4 > len (data):
+        errors.append (f"The map_list ({map_off:#x}) is out of the file")
+        return errors
+
+    (size,) = struct.unpack_from ("<I", data, map_off)
+    for i in range (size):
+        # map_item: type (ushort), unused (ushort), size, offset
+        item_type, _, _, offset = struct.unpack_from ("<HHII", data, map_off + 4 + i * 12)
+        if offset >= len (data):
+            errors.append (f"The section {item_type:#06x} ({offset:#x}) is out of the file")
+
+    return errors
+
+
+def has_gadget_preamble (index, code_off):
+    """
+    Returns True if the method with the code_item at the given offset starts with System.loadLibrary ("gadget"), as
+    added by java_patch_bytecode().
+    """
+    data = index.data
+
+    (insns_size,) = struct.unpack_from ("<I", data, code_off + 12)
+    insns = code_off + 16
+    if insns_size < 5:
+        return False
+
+    # const-string vAA, string@BBBB; or const-string/jumbo vAA, string@BBBBBBBB
+    unit, string_idx = struct.unpack_from ("<HH", data, insns)
+    register = unit >> 8
+    if unit & 0xff == 0x1b:
+        (string_idx,) = struct.unpack_from ("<I", data, insns + 2)
+        insns += 6
+    elif unit & 0xff == 0x1a:
+        insns += 4
+    else:
+        return False
+
+    if string_idx >= len (index.string_ids) or index.get_string (string_idx) != "gadget":
+        return False
+
+    # invoke-static {vC}, meth@BBBB; or invoke-static/range {vCCCC}, meth@BBBB
+    unit, method_idx, first = struct.unpack_from ("<3H", data, insns)
+    if unit & 0xff == 0x71:
+        count, first = unit >> 12, first & 0xf
+    elif unit & 0xff == 0x77:
+        count = unit >> 8
+    else:
+        return False
+
+    if count != 1 or first != register or method_idx >= index.method_ids_size:
+        return False
+
+    class_descriptor, name, prototype = index.get_method (method_idx)
+    return (class_descriptor, name, prototype) == ("Ljava/lang/System;", "loadLibrary", "(Ljava/lang/String;)V")
+
+
+def verify_alignment (apk_path, alignment = 4, so_alignment = 4096):
+    """
+    Checks that the uncompressed entries of the APK are aligned. Returns the problems found.
+    """
+    with zipfile.ZipFile (apk_path, "r") as apk:
+        return [
+            f"{filename} starts at {offset}, which is not aligned to {required} Bytes"
+            for filename, offset, required in get_misaligned_entries (apk, alignment, so_alignment)
+        ]
+
+
+def verify_manifest (apk_path, expected = None, fixed = False):
+    """
+    Checks that the AndroidManifest.xml of the APK is well formed, and that it still has everything that the original
+    one had (`expected`, if provided). Returns the problems found.
+
+    If `fixed` is True, android:extractNativeLibs must not be "false" anymore (see fix_manifest()).
+    """
+    with zipfile.ZipFile (apk_path, "r") as apk:
+        raw = apk.read ("AndroidManifest.xml")
+
+    errors = get_axml_errors (raw)
+    try:
+        facts = ManifestFacts (raw)
+    except ValueError as e:
+        return errors + [ str (e) ]
+
+    if not facts.entry_points:
+        errors.append ("There's no entry point")
+
+    if expected is not None:
+        for field in ("package", "entry_points", "min_sdk"):
+            if getattr (facts, field) != getattr (expected, field):
+                errors.append (f"{field} has changed: {getattr (expected, field)} -> {getattr (facts, field)}")
+
+        missing = set (expected.permissions) - set (facts.permissions)
+        if missing:
+            errors.append (f"Missing permissions: {sorted (missing)}")
+
+    if fixed and facts.application.get ("extractNativeLibs") == "false":
+        errors.append ("android:extractNativeLibs is still false")
+
+    return errors
+
+
+def verify_dex (apk_path, entry_points):
+    """
+    Checks that the constructor of every entry point starts with the call to System.loadLibrary ("gadget"), and that
+    the dex files containing them are valid. The dex files after the last entry point are not even read.
+    Returns the problems found.
+    """
+    errors = []
+    pending = list (entry_points)
+
+    with zipfile.ZipFile (apk_path, "r") as apk:
+        for filename in apk.namelist ():
+            if not pending:
+                break
+
+            if not filename.endswith (".dex"):
+                continue
+
+            data = apk.read (filename)
+            try:
+                index = DexIndex (data)
+            except (ValueError, struct.error) as e:
+                errors.append (f"{filename}: {e}")
+                continue
+
+            found = [ (name, index.find_class (name)) for name in pending ]
+            found = [ (name, descriptor) for name, descriptor in found if descriptor ]
+            if not found:
+                continue
+
+            errors += [ f"{filename}: {e}" for e in get_dex_errors (data) ]
+
+            for name, descriptor in found:
+                pending.remove (name)
+
+                constructors = index.get_constructors (descriptor)
+                if not constructors:
+                    errors.append (f"{filename}: {descriptor} has no constructor")
+                    continue
+
+                for method_name, _, code_off in index.get_direct_methods (descriptor):
+                    if method_name == constructors [0] and code_off and not has_gadget_preamble (index, code_off):
+                        errors.append (f"{filename}: {descriptor}->{method_name} doesn't load the gadget")
+
+    errors += [ f"{name} was not found in any dex file" for name in pending ]
+
+    return errors
+
+
+def verify_signature (apk_path, min_sdk = 1, certificates = None):
+    """
+    Verifies the signatures of the APK with apksig's ApkVerifier, as `adb install` would on devices running
+    `min_sdk` or newer. Returns the problems found.
+
+    If `certificates` is provided, the SHA-256 of the certificate of the (first) signer is stored in it, by file name.
+    """
+    get_patcher ()
+    from com.android.apksig import ApkVerifier
+    from java.io import File
+
+    result = ApkVerifier.Builder (File (str (apk_path))).setMinCheckedPlatformVersion (min_sdk).build ().verify ()
+
+    errors = [ str (issue) for issue in result.getErrors () ]
+    for signers in (result.getV1SchemeSigners (), result.getV2SchemeSigners (), result.getV3SchemeSigners ()):
+        for signer in signers:
+            errors += [ str (issue) for issue in signer.getErrors () ]
+
+    if not result.isVerified () and not errors:
+        errors.append ("The signature couldn't be verified")
+
+    signer_certificates = result.getSignerCertificates ()
+    if certificates is not None and not signer_certificates.isEmpty ():
+        certificates [apk_path.name] = hashlib.sha256 (bytes (signer_certificates.get (0).getEncoded ())).hexdigest ()
+
+    return errors
+
+
+def find_main_output (apks):
+    """
+    Returns the main APK among the given ones (the only one that is not a config split, or the first one with dex files).
+    """
+    candidates = [ apk for apk in apks if get_split_type (apk.name) is None ]
+    if len (candidates) == 1:
+        return candidates [0]
+
+    for apk in candidates:
+        with zipfile.ZipFile (apk, "r") as handle:
+            if "classes.dex" in handle.NameToInfo:
+                return apk
+
+    return None
+
+
+def verify_outputs (out_dir, main_name = None, so_alignment = 4096, jobs = None, expected = None, fixed = False):
+    """
+    Checks the patched APKs of out_dir, so the problems are found before installing them on a device:
+        - alignment: the uncompressed entries of every APK are aligned
+        - signature: every APK is signed (see verify_signature()), and all of them with the same certificate
+        - manifest: the AndroidManifest.xml of the main APK is well formed (see verify_manifest())
+        - dex: the entry points of the main APK load the gadget (see verify_dex())
+    The checks of all the APKs are run in parallel, and they only read the entries they need.
+
+    Args
+        out_dir: Path
+            Directory with the patched APKs.
+
+        main_name: str
+            File name of the main APK. If not provided, it's guessed (see find_main_output()).
+
+        so_alignment: int
+            Alignment (in Bytes) of the uncompressed native libraries.
+
+        jobs: int
+            Number of checks run at the same time.
+
+        expected: ManifestFacts
+            Manifest of the original app, to compare it with the patched one.
+
+        fixed: bool
+            Whether the manifest was modified by fix_manifest().
+
+    Returns
+        :dict
+        {
+            "errors": [ "<APK>: [<check>] <problem>" ],
+            "timings": { <check>: <seconds, added up for all the APKs> },
+            "apks": { <APK>: { <check>: { "seconds": <seconds>, "errors": [ <problem> ] } } }
+        }
+    """
+    apks = sorted (out_dir.glob ("*.apk"))
+    main = out_dir / main_name if main_name else find_main_output (apks)
+
+    report = { "errors": [], "timings": {}, "apks": { apk.name: {} for apk in apks } }
+    lock = threading.Lock ()
+
+    if main is None:
+        report ["errors"].append (f"Couldn't find the main APK in {out_dir}")
+        return report
+
+    def check (apk, name, function, *args):
+        start = perf_counter ()
+        try:
+            errors = function (*args)
+        except Exception as e:
+            errors = [ f"{type (e).__name__}: {e}" ]
+        elapsed = perf_counter () - start
+
+        with lock:
+            report ["apks"] [apk.name] [name] = { "seconds": round (elapsed, 3), "errors": errors }
+            report ["timings"] [name] = round (report ["timings"].get (name, 0) + elapsed, 3)
+            report ["errors"] += [ f"{apk.name}: [{name}] {error}" for error in errors ]
+
+    # The entry points and the minSdkVersion are needed by the rest of the checks
+    check (main, "manifest", verify_manifest, main, expected, fixed)
+    try:
+        manifest = read_manifest (main)
+    except (ValueError, KeyError):
+        manifest = expected
+
+    min_sdk = manifest.min_sdk if manifest else 1
+    certificates = {}
+
+    with ThreadPoolExecutor (max_workers = jobs) as pool:
+        futures = [ pool.submit (check, apk, "alignment", verify_alignment, apk, 4, so_alignment) for apk in apks ]
+        futures += [ pool.submit (check, apk, "signature", verify_signature, apk, min_sdk, certificates) for apk in apks ]
+        if manifest is not None:
+            futures.append (pool.submit (check, main, "dex", verify_dex, main, manifest.entry_points))
+
+        for future in futures:
+            future.result ()
+
+    if len (set (certificates.values ())) > 1:
+        report ["errors"].append (f"The APKs are not signed with the same certificate: {certificates}")
+
+    return report
+
+
+class PatchError (Exception):
+    """
+    Raised when an app couldn't be patched.
+    `exit_code` is the status returned by the script in the single-app mode.
+    """
+    def __init__ (self, message, exit_code):
+        super ().__init__ (message)
+        self.exit_code = exit_code
+
+
+class MetricsRecorder:
+    """
+    Collects the measurements of every stage (see timed()) and of every call to the Java patcher (see
+    report_from_java()), to write them as JSON lines (--metrics) or as a Chrome trace (--trace).
+
+    Every event is a dict with:
+        - name: the stage (e.g.: "write_apk") or the Java operation ("patchDex", "zipAlign" or "sign")
+        - cat: "stage" or "java"
+        - app: base path of the app being patched
+        - pid, tid: process and (native) thread that ran it
+        - start: seconds since the epoch
+        - wall, cpu: elapsed and CPU time, in seconds. The CPU time of a stage is the one of the whole process (JVM
+          threads included), while the one of a Java operation is the one of its thread
+        - bytes_read, bytes_written: I/O of the whole process during a stage (only on Linux), or Bytes processed by a
+          Java operation
+        - peak_rss: peak RSS of the process during a stage, in Bytes (only on Linux)
+        - jvm_heap_peak: peak usage of the JVM heap during a stage, in Bytes (only once the JVM is running)
+        - heap_used: Bytes in use in the JVM heap at the end of a Java operation
+        - entries: number of items processed (Zip entries, dex files, methods...), when it makes sense
+    """
+    def __init__ (self):
+        self.events = []
+        # Base path of the app being patched
+        self.app = None
+        # The parts of every app are aligned and signed from several threads
+        self.lock = threading.Lock ()
+
+
+    def add (self, name, category, start, fields):
+        event = {
+            "name": name,
+            "cat": category,
+            "app": self.app,
+            "pid": os.getpid (),
+            "tid": threading.get_native_id (),
+            "start": start
+        }
+        event.update (fields)
+
+        with self.lock:
+            self.events.append (event)
+
+
+    def add_java (self, name, metrics):
+        """
+        Records the measurements of a Java operation (see ApkPatcher.OperationMetrics), which just finished.
+        """
+        fields = { "wall": metrics.pop ("wall_ns") / 1e9 }
+        if "cpu_ns" in metrics:
+            fields ["cpu"] = metrics.pop ("cpu_ns") / 1e9
+        fields.update (metrics)
+
+        self.add (name, "java", time () - fields ["wall"], fields)
+
+
+    @staticmethod
+    def read_io ():
+        """
+        Returns the Bytes read and written by the process so far (including the cached reads), or (None, None) if
+        /proc/self/io is not available.
+        """
+        try:
+            with open ("/proc/self/io") as handle:
+                counters = dict (line.split (":") for line in handle)
+
+            return int (counters ["rchar"]), int (counters ["wchar"])
+
+        except (OSError, KeyError, ValueError):
+            return None, None
+
+
+    @staticmethod
+    def reset_peaks ():
+        """
+        Resets the peak RSS of the process (only on Linux) and the peak usage of the JVM heap (if it's running).
+        """
+        try:
+            with open ("/proc/self/clear_refs", "w") as handle:
+                handle.write ("5")
+        except OSError:
+            pass
+
+        if PATCHER is not None:
+            from java.lang.management import ManagementFactory, MemoryType
+
+            for pool in ManagementFactory.getMemoryPoolMXBeans ():
+                if pool.getType () == MemoryType.HEAP:
+                    pool.resetPeakUsage ()
+
+
+    @staticmethod
+    def read_peaks ():
+        """
+        Returns the peak RSS of the process and the peak usage of the JVM heap since the last reset_peaks(), in Bytes.
+        Any of them may be None, if it's not available.
+        """
+        peak_rss = None
+        try:
+            with open ("/proc/self/status") as handle:
+                for line in handle:
+                    if line.startswith ("VmHWM:"):
+                        peak_rss = int (line.split () [1]) * 1024
+                        break
+        except OSError:
+            pass
+
+        jvm_heap_peak = None
+        if PATCHER is not None:
+            from java.lang.management import ManagementFactory, MemoryType
+
+            jvm_heap_peak = sum (
+                    pool.getPeakUsage ().getUsed ()
+                    for pool in ManagementFactory.getMemoryPoolMXBeans ()
+                    if pool.getType () == MemoryType.HEAP
+                )
+
+        return peak_rss, jvm_heap_peak
+
+
+    def pop_events (self):
+        """
+        Returns the events recorded so far, and forgets them.
+        """
+        with self.lock:
+            events, self.events = self.events, []
+
+        return events
+
+
+    def write_jsonl (self, path):
+        """
+        Writes one event per line.
+        """
+        with open (path, "w") as handle:
+            for event in self.events:
+                handle.write (json.dumps (event) + "\n")
+
+
+    def write_trace (self, path):
+        """
+        Writes the events in the Trace Event Format of Chrome, as "complete" events (one per stage or Java operation).
+        The rest of the measurements are shown as the arguments of every event.
+        """
+        origin = min ((event ["start"] for event in self.events), default = 0)
+        trace_events = []
+
+        for event in self.events:
+            trace_events.append ({
+                "name": event ["name"],
+                "cat": event ["cat"],
+                "ph": "X",
+                "ts": round ((event ["start"] - origin) * 1e6),
+                "dur": round (event ["wall"] * 1e6),
+                "pid": event ["pid"],
+                "tid": event ["tid"],
+                "args": { key: value for key, value in event.items () if key not in ("name", "cat", "pid", "tid") }
+            })
+
+        with open (path, "w") as handle:
+            json.dump ({ "traceEvents": trace_events, "displayTimeUnit": "ms" }, handle)
+
+
+    def write (self, metrics_path = None, trace_path = None):
+        """
+        Writes the events to the given files (see write_jsonl() and write_trace()), if they're not None.
+        """
+        if metrics_path:
+            self.write_jsonl (metrics_path)
+            logger.info (f"Metrics written to {metrics_path}")
+
+        if trace_path:
+            self.write_trace (trace_path)
+            logger.info (f"Trace written to {trace_path}")
+
+
+# Recorder of the measurements, only set with --metrics or --trace
+METRICS = None
+# The progress of the stages run by every thread is reported to PROGRESS.callback, if it's set (see PatchService)
+PROGRESS = threading.local ()
+
+@contextmanager
+def timed (timings, stage):
+    """
+    Measures the wall time of the enclosed block and stores it (in seconds) as timings [stage].
+    If the metrics are enabled (see METRICS), the rest of the measurements are recorded too; and the block can add its
+    own (e.g.: "entries") to the yielded dict.
+    The start and the end of the stage are also sent to PROGRESS.callback, if the current thread has one.
+    """
+    fields = {}
+    recorder = METRICS
+    progress = getattr (PROGRESS, "callback", None)
+
+    if progress is not None:
+        progress ({ "event": "start", "stage": stage })
+
+    if recorder is not None:
+        recorder.reset_peaks ()
+        start_time = time ()
+        start_cpu = process_time ()
+        start_read, start_written = recorder.read_io ()
+
+    start = perf_counter ()
+    try:
+        yield fields
+    finally:
+        elapsed = perf_counter () - start
+        timings [stage] = round (elapsed, 3)
+
+        if recorder is not None:
+            read, written = recorder.read_io ()
+            peak_rss, jvm_heap_peak = recorder.read_peaks ()
+
+            recorder.add (stage, "stage", start_time, {
+                "wall": elapsed,
+                "cpu": process_time () - start_cpu,
+                "bytes_read": read - start_read if read is not None else None,
+                "bytes_written": written - start_written if written is not None else None,
+                "peak_rss": peak_rss,
+                "jvm_heap_peak": jvm_heap_peak,
+                **fields
+            })
+
+        if progress is not None:
+            progress ({ "event": "end", "stage": stage, "wall": timings [stage], **fields })
+
+
+def setup_logging (verbosity):
+
+    levels = [ "SUCCESS", "INFO", "DEBUG", "TRACE" ]
+    log_level = min ( len (levels) - 1, verbosity )
+
+    logger.remove () # Removes the default logger (and the Androguard one, if it was already imported)
+    logger.add (
+        stdout,
+        format = "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level:<8}</level> | <level>{message}</level>",
+        filter = __name__,
+        level = levels [log_level],
+        colorize = True
+    )
+
+    logger.info (f"Set debugging level to {levels [log_level]}")
+
+
+def patch_app (base_path, out_dir, args, keystore_data, gadget_cache, timings = None, dex_cache = None, split_cache = None):
+    """
+    Runs all the steps to patch the split APK identified by `base_path`, leaving the results in `out_dir` (which is
+    removed first, if it already existed).
+
+    Args
+        base_path: str
+            Common prefix for all the split apk files (see parse_args()).
+
+        out_dir: Path
+            Directory where the patched (and signed) APKs will be written.
+
+        args: argparse.Namespace
+            Parsed options, as returned by check_args().
+
+        keystore_data: bytes
+            Raw PKCS12 KeyStore used to sign all the parts.
+
+        gadget_cache: FileCache
+            Cache of the Frida gadgets.
+
+        timings: dict
+            If provided, the time spent on every stage (in seconds) is stored on it.
+
+        dex_cache: FileCache
+            Cache of the patched dex files, if any.
+
+        split_cache: FileCache
+            Cache of the aligned and signed splits that are not modified, if any.
+
+    Raises
+        PatchError, if the app couldn't be patched.
+    """
+    if timings is None:
+        timings = {}
+
+    ####
+    # Preparation of the environment
+    # The patched items will be written to a modified version inside out_dir
+    rmtree (out_dir, ignore_errors = True)
+    out_dir.mkdir (parents = True)
+
+    logger.info (f"Using {out_dir} as working directory.")
+    ####
+
+    # The big buffers are kept in temporary files, if there's a memory budget (see --max-memory)
+    spill = get_spill_dir (out_dir / ".spill", getattr (args, "max_memory", None))
+
+    try:
+        patch_parts (base_path, out_dir, args, keystore_data, gadget_cache, timings, dex_cache, split_cache, spill)
+
+    finally:
+        if spill:
+            spill.close ()
+
+
+def patch_parts (base_path, out_dir, args, keystore_data, gadget_cache, timings, dex_cache, split_cache, spill):
+    """
+    Runs all the stages of patch_app(), once out_dir is ready.
+    """
+    # 1: Locate all files that belong to this app
+    with timed (timings, "find_apk_parts"):
+        parts = find_apk_parts (base_path)
+    logger.info (f"Found parts: {get_full_filelist (parts, True)}")
+
+    main_apk_path = parts ["main"]
+    mod_apk_path = out_dir / main_apk_path.name
+
+    # 2: Find the entry point(s)
+    # The manifest is read only once, and the rest of the stages use what was extracted from it
+    with timed (timings, "read_manifest"):
+        manifest = read_manifest (main_apk_path)
+
+    entry_points = manifest.entry_points
+
+    if not entry_points:
+        raise PatchError ("Couldn't locate the entry point", -2)
+
+    logger.info (f"Found entry point(s): {entry_points}")
+
+    # All the changes to the main APK are collected here and written at once, at the end
+    overlays = {}
+    so_alignment = args.page_size * 1024
+
+    # 3: Patch the entrypoints' Bytecode
+    with timed (timings, "patch_bytecode") as stage:
+        patched = patch_bytecode (main_apk_path, entry_points, dex_cache, spill)
+        stage ["entries"] = len (patched or {})
+    if not patched:
+        raise PatchError ("Couldn't patch the Bytecode", -3)
+
+    overlays.update (patched)
+
+    # 4: Download Frida and add it to the lib/ directory
+    frida_script = args.frida_script
+    if frida_script:
+        logger.debug (f"Using the following Frida script:\n{frida_script.decode ('utf-8')}\n")
+
+    gadget_config = args.gadget_config
+    if gadget_config:
+        logger.debug (f"Using the following Gadget config:\n{gadget_config.decode ('utf-8')}\n")
+
+    with timed (timings, "add_native_lib") as stage:
+        # The ABI splits get the gadgets or, if there are none, the main APK (single APKs, or APKs without native libs)
+        # Only the ABIs the app ships libraries for are added, and the splits without native code are left untouched
+        # (unless none of them has any)
+        targets = {
+            path: abis
+            for path in parts.get ("abi", [ main_apk_path ])
+            if (abis := get_gadget_abis (path, args.arch, manifest))
+        }
+
+        if not targets:
+            # No split has native libraries, so the device picks one of them only by its ABI. The gadget must still be
+            # there, since the entry point loads it
+            logger.warning ("None of the ABI splits has native libraries. Adding to each one the gadget of its ABI")
+            targets = {
+                path: { arch_to_dirname (arch): arch for arch in get_arch_from_filename (path) }
+                for path in parts.get ("abi", [ main_apk_path ])
+            }
+
+        # The release is requested once, and all the gadgets needed by the app are retrieved at the same time
+        # Any gadget that couldn't be retrieved fails the whole app (see add_native_lib_to_apk())
+        gadgets = {}
+        if targets:
+            frida_version, frida_release = resolve_frida_version (args.frida_version, gadget_cache, args.offline)
+            if frida_version is None:
+                raise PatchError ("Couldn't determine the Frida version to use", -5)
+
+            gadgets = get_frida_gadgets (
+                    [ arch for abis in targets.values () for arch in abis.values () ],
+                    frida_version,
+                    frida_release,
+                    gadget_cache,
+                    args.offline
+                )
+
+        for path, abis in targets.items ():
+            libs = add_native_lib_to_apk (
+                    path,
+                    frida_script,
+                    gadget_config,
+                    forced_dir = args.dir_lib,
+                    gadgets = gadgets,
+                    abis = abis
+                )
+            stage ["entries"] = stage.get ("entries", 0) + len (libs)
+
+            if path == main_apk_path:
+                overlays.update (libs)
+            else:
+                append_to_apk (path, out_dir / path.name, libs, so_alignment = so_alignment)
+
+    # 5: Add extractNativeLibs=true to the AndroidManifest.xml, to
+    # extract the config
+    # Also, android.permission.INTERNET has to be added to allow the Gadget to open
+    # a socket (assuming that was the config)
+    if args.fix_manifest:
+        with timed (timings, "fix_manifest"):
+            overlays.update (fix_manifest (manifest))
+
+    with timed (timings, "write_apk") as stage:
+        stage ["entries"] = write_apk (main_apk_path, mod_apk_path, overlays, so_alignment = so_alignment)
+
+    # 6: copy everything (even the items we haven't modified) to out_dir
+    files = get_full_filelist (parts)
+
+    # 7 and 8: zipalign (if needed) and sign everything
+    # JPype releases the GIL while running Java code, so the parts can be processed concurrently
+    with timed (timings, "align_and_sign") as stage:
+        stage ["entries"] = len (files)
+
+        schemes = get_signature_schemes (args.schemes, manifest.min_sdk)
+        signer = get_signing_session (keystore_data, schemes)
+        cache_params = get_split_cache_params (keystore_data, schemes, so_alignment)
+
+        with ThreadPoolExecutor (max_workers = args.jobs) as pool:
+            futures = [
+                pool.submit (finalize_apk, f, out_dir / f.name, signer, so_alignment, split_cache, cache_params)
+                for f in files
+            ]
+
+            # Re-raises the first exception (if any)
+            for future in futures:
+                future.result ()
+
+    # 9: check the results before they're installed anywhere
+    if args.verify:
+        with timed (timings, "verify") as stage:
+            report = verify_outputs (
+                    out_dir,
+                    main_apk_path.name,
+                    so_alignment,
+                    args.jobs,
+                    manifest,
+                    args.fix_manifest and "AndroidManifest.xml" in overlays
+                )
+            stage ["errors"] = len (report ["errors"])
+
+        timings.update ({ f"verify.{check}": seconds for check, seconds in report ["timings"].items () })
+
+        for error in report ["errors"]:
+            logger.error (error)
+        if report ["errors"]:
+            raise PatchError (f"{len (report ['errors'])} problem(s) found on the patched APKs", -4)
+
+    # 10: pack everything into a single bundle, if requested
+    if getattr (args, "output_bundle", None):
+        with timed (timings, "write_bundle") as stage:
+            stage ["entries"] = write_bundle (parts, out_dir, args.output_bundle)
+
+
+def update_gadget_files (out_dir, files, signer, so_alignment = 4096):
     """
-    # Thanks to Pathlib.stem, we can just take out the .apk extension
-    # and then get the '<ABI>' part using .stem.split (".")[-1]
-    # This way, no index checking has to be performed ([-1] always exists)
-    abi = filename.stem.split (".")[-1]
-    all_arch = [ ABI_MAPPING[x] for x in ABI_MAPPING ]
+    Replaces the given Frida files (e.g.: the script) in every patched APK of out_dir that contains them, and signs
+    those APKs again. The rest of the APKs, and the rest of the entries, are left as they are.
 
-    logger.debug (f"Inferred ABI from file {filename}: {abi}")
+    Args
+        out_dir: Path
+            Directory with the patched APKs, as left by patch_app().
 
-    # Filenames do not have '-', but use '_'
-    abi = abi.replace ("_", "-")
-    if not abi in ABI_MAPPING:
-        logger.debug (f"Failed to find {abi} within the ABI_MAPPING: {ABI_MAPPING}")
-        return all_arch
+        files: {:str => :bytes}
+            New contents of the files, by name (e.g.: { "libgadget.js.so": b"..." }).
 
-    return [ ABI_MAPPING [abi] ]
+        signer: SigningSession
+            Session to sign the updated APKs (see get_signing_session()).
 
+        so_alignment: int
+            Alignment (in Bytes) of the uncompressed native libraries.
 
-def arch_to_dirname (arch):
+    Returns
+        [:Path]
+        The updated APKs.
     """
-    Converts the given arch to the dirname expected inside an APK.
-    If the requested architecture was not found, this method returns None
+    updated = []
+
+    for apk_path in sorted (out_dir.glob ("*.apk")):
+        with zipfile.ZipFile (apk_path, "r") as apk:
+            overlays = {
+                name: files [name.rsplit ("/", 1) [-1]]
+                for name in apk.namelist ()
+                if name.rsplit ("/", 1) [-1] in files
+            }
+
+        if not overlays:
+            continue
+
+        logger.debug (f"Updating {list (overlays)} in {apk_path.name}")
+
+        # The signature of the old APK is discarded by write_apk(), and a new one is added
+        unsigned_path = apk_path.with_name (f"{apk_path.name}.unsigned.tmp")
+        signed_path = apk_path.with_name (f"{apk_path.name}.signed.tmp")
+        try:
+            write_apk (apk_path, unsigned_path, overlays, so_alignment = so_alignment)
+            signer.sign (str (unsigned_path), str (signed_path))
+            os.replace (signed_path, apk_path)
+        finally:
+            unsigned_path.unlink (missing_ok = True)
+            signed_path.unlink (missing_ok = True)
+
+        updated.append (apk_path)
+
+    return updated
+
+
+def watch (args, out_dir, keystore_data):
     """
-    for abi in ABI_MAPPING:
-        if ABI_MAPPING [abi] == arch:
-            return abi
+    Entry point of --watch: once the app has been patched into out_dir, waits for changes on the Frida script and the
+    Gadget config, and updates the patched APKs with update_gadget_files(). Runs until it's interrupted (Ctrl+C).
+    """
+    # Name of the file inside the APKs => path of the watched file
+    watched = { "libgadget.js.so": args.frida_script_path }
+    if args.gadget_config_path is not None:
+        watched ["libgadget.config.so"] = args.gadget_config_path
 
-    return None
+    def get_signature (path):
+        try:
+            st = path.stat ()
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            # Some editors remove the file before writing the new one
+            return None
+
+    signatures = { name: get_signature (path) for name, path in watched.items () }
+
+    parts = find_apk_parts (args.base_path)
+    schemes = get_signature_schemes (args.schemes, read_manifest (parts ["main"]).min_sdk)
+    signer = get_signing_session (keystore_data, schemes)
+
+    logger.success (f"[+] Watching {[ str (path) for path in watched.values () ]} for changes (Ctrl+C to stop)")
+
+    try:
+        while True:
+            sleep (WATCH_INTERVAL)
+
+            changed = {}
+            for name, path in watched.items ():
+                signature = get_signature (path)
+                if signature is not None and signature != signatures [name]:
+                    signatures [name] = signature
+                    changed [name] = path.read_bytes ()
+
+            if not changed:
+                continue
 
+            logger.info (f"Changed: {list (changed)}")
+            start = perf_counter ()
 
-def add_native_lib_to_apk (apk_path, out_path, frida_script = None, gadget_config = None, forced_arch = None, forced_dir = None):
+            try:
+                with timed ({}, "update_gadget_files") as stage:
+                    updated = update_gadget_files (out_dir, changed, signer, args.page_size * 1024)
+                    stage ["entries"] = len (updated)
+
+            except Exception as e:
+                # The files may be fixed and saved again
+                logger.error (f"Couldn't update the patched APKs: {e}")
+                continue
+
+            finally:
+                if METRICS is not None:
+                    METRICS.write (args.metrics, args.trace)
+
+            logger.success (f"[+] Updated {[ path.name for path in updated ]} in {perf_counter () - start:.2f} s")
+
+    except KeyboardInterrupt:
+        logger.info ("Stopped watching")
+
+
+def find_batch_apps (manifest):
     """
-    Downloads the Frida gadget and adds it to the APK, generating a copy of it.
-    The original APK is not modified.
+    Returns the base paths of all the apps to patch in batch mode.
+
+    `manifest` is either a file with one base path per line (empty lines and lines starting with '#' are ignored), or
+    a glob pattern matching the main APKs or bundles (or the directories containing them).
     """
-    architectures = [ forced_arch ] if forced_arch else get_arch_from_filename (apk_path)
+    manifest_path = Path (manifest)
 
-    logger.info (f"Requesting {FRIDA_ASSETS_URL}")
-    r = requests.get (FRIDA_ASSETS_URL)
-    if r.status_code != 200:
-        logger.error (f"Couldn't GET {FRIDA_ASSETS_URL} . Response code: {r.status_code} {r.reason}")
-        return
+    if manifest_path.is_file ():
+        lines = [ line.strip () for line in manifest_path.read_text ().splitlines () ]
+        return [ line for line in lines if line and not line.startswith ("#") ]
 
-    frida_releases = r.json ()
-    frida_version = frida_releases ["tag_name"]
-    logger.info (f"Using Frida version {frida_version} (latest)")
+    # Relative and absolute patterns are both accepted
+    if manifest_path.is_absolute ():
+        matches = Path (manifest_path.anchor).glob (str (manifest_path.relative_to (manifest_path.anchor)))
+    else:
+        matches = Path ().glob (manifest)
 
-    frida_assets = frida_releases ["assets"]
+    base_paths = []
+    for match in sorted (matches):
+        apks = sorted (p for p in match.iterdir () if p.suffix in BUNDLE_EXTENSIONS | { ".apk" }) \
+            if match.is_dir () else [ match ]
 
-    with (
-        zipfile.ZipFile (apk_path, "r") as in_apk,
-        zipfile.ZipFile (out_path, "a") as out_apk
-    ):
+        for apk in apks:
+            if apk.suffix in BUNDLE_EXTENSIONS:
+                base_paths.append (str (apk))
 
-        # First we add all the original files to the new APK
-        for filename in in_apk.namelist ():
-            copy_to_zip (in_apk, out_apk, filename)
+            # The config splits are located later by find_apk_parts()
+            elif apk.suffix == ".apk" and ".config." not in apk.name:
+                # "com.example.1234.apk" -> "com.example.1234."
+                base_paths.append (str (apk) [:-len ("apk")])
 
-        # Then, the new items
-        for arch in architectures:
-            logger.info (f"Processing architecture {arch}")
+    return base_paths
 
-            target = f"frida-gadget-{frida_version}-android-{arch}.so.xz"
 
-            for asset in frida_assets:
-                if asset ["name"] == target:
-                    download_url = asset ["browser_download_url"]
-                    logger.info (f"Located {target} @ {download_url}")
+# State of every worker process in batch mode (see init_batch_worker())
+BATCH_WORKER = {}
 
-                    with requests.get (download_url, stream = True) as r:
-                        if r.status_code != 200:
-                            logger.info (f"Couldn't GET {FRIDA_ASSETS_URL} . Response code: {r.status_code} {r.reason}")
-                            continue
+def init_batch_worker (args):
+    """
+    Initializer of the worker processes in batch mode.
+    Every worker has its own JVM (started by its first app), which is reused for all its apps.
+    """
+    global METRICS
 
-                        lib_xz = r.content
-                        lib = decompress (lib_xz, format = FORMAT_XZ)
-                        dirname = forced_dir if forced_dir else ("lib/" + arch_to_dirname (arch))
+    setup_logging (args.verbose)
+    # args.max_memory is already the share of this worker (see run_batch())
+    set_memory_budget (args.max_memory)
 
-                        if dirname is None:
-                            # idk, man...
-                            dirname = arch
+    # The events are sent back to the main process with the summary of every app (see patch_app_in_batch())
+    if args.metrics or args.trace:
+        METRICS = MetricsRecorder ()
 
-                        out_apk.writestr (f"{dirname}/libgadget.so", lib)
-                        if gadget_config:
-                            out_apk.writestr (f"{dirname}/libgadget.config.so", gadget_config)
-                        if frida_script:
-                            out_apk.writestr (f"{dirname}/libgadget.js.so", frida_script)
-                        logger.debug (f"Added all *.so to {out_path}!{dirname}/")
+    BATCH_WORKER ["args"] = args
+    BATCH_WORKER ["keystore_data"] = base64.b64decode (KEYSTORE_B64)
+    BATCH_WORKER ["gadget_cache"] = FileCache (args.cache_dir / "gadgets", args.cache_size * 1024 * 1024)
+    BATCH_WORKER ["dex_cache"] = (
+            FileCache (args.cache_dir / "dex", args.dex_cache_size * 1024 * 1024) if args.dex_cache_size > 0 else None
+        )
+    BATCH_WORKER ["split_cache"] = (
+            FileCache (args.cache_dir / "splits", args.split_cache_size * 1024 * 1024) if args.split_cache_size > 0 else None
+        )
 
 
-def get_full_filelist (parts, use_basename = False):
+def get_out_dir (base_path):
     """
-    Given a dictionary generated by `find_apk_parts()`, gets all the filenames of each part and
-    returns them as a list.
+    Returns the directory where the patched APKs of the given app are written:
+    OUT_DIR / "com.example.1234.patched" for both "com.example.1234." and "com.example.1234.apks".
+    """
+    if Path (base_path).suffix in BUNDLE_EXTENSIONS:
+        base_path = base_path [:-len (Path (base_path).suffix)] + "."
 
-    The argument `use_basename` controls whether the full Path (as an object) or the file basename (as a string)
-    should be included in the list.
+    return OUT_DIR / (base_path + "patched")
 
-    Expected input format:
-        {
-            "main": "test.apk", // This is the only mandatory item. The other keys may or may not be present
-            "abi": [
-                "test.config.armeabi_v7a.apk",
-                "test.config.arm64_v8a.apk"
-            ],
-            "density": [
-                "test.config.xxhdpi.apk",
-                "test.config.ldpi.apk"
-            ],
-            "lang": [
-                "test.config.en.apk",
-                "test.config.de.apk"
-            ]
-        }
+
+def run_patch_job (base_path, args, keystore_data, gadget_cache, dex_cache = None, split_cache = None):
     """
-    files = []
+    Patches a single app into get_out_dir (base_path), for the batch workers and the patch server.
+    Errors are logged and included in the returned summary, so they don't abort the rest of the apps.
 
-    # If "main" is not there, something is very wrong. I'll let that fail
-    files.append (parts ["main"].name if use_basename else parts ["main"])
+    Returns
+        :dict
+        Summary of the process, also written as JSON to "<out_dir>/patch-summary.json".
+    """
+    out_dir = get_out_dir (base_path)
+    summary = {
+        "base_path": base_path,
+        "out_dir": str (out_dir),
+        "status": "ok",
+        "timings": {}
+    }
+
+    start = perf_counter ()
+    try:
+        patch_app (base_path, out_dir, args, keystore_data, gadget_cache, summary ["timings"], dex_cache, split_cache)
+        logger.success (f"[+] Patched {base_path} into {out_dir}")
 
-    for k in [ "abi", "density", "lang" ]:
-        if k in parts:
-            if use_basename:
-                for p in parts [k]:
-                    files.append (p.name)
-            else:
-                files += parts [k]
+    except Exception as e:
+        logger.error (f"Couldn't patch {base_path}: {e}")
+        summary ["status"] = "error"
+        summary ["error"] = str (e)
 
-    return files
+    summary ["total"] = round (perf_counter () - start, 3)
 
+    out_dir.mkdir (parents = True, exist_ok = True)
+    (out_dir / "patch-summary.json").write_text (json.dumps (summary, indent = 2))
 
-def permission_exists (manifest_xml, permission_name):
+    return summary
+
+
+def get_error_summary (base_path, error, total = 0):
     """
-    Iterates through the provided XML object (lxml.etree.Element or xml.etree.ElementTree) and returns:
-        - True if the given permission name exists (verbatim); or
-        - False otherwise.
+    Returns the summary of an app whose job couldn't return its own (e.g.: its worker process died), in the same format
+    as run_patch_job(). It's also written as JSON to "<out_dir>/patch-summary.json".
     """
+    out_dir = get_out_dir (base_path)
+    summary = {
+        "base_path": base_path,
+        "out_dir": str (out_dir),
+        "status": "error",
+        "error": str (error),
+        "timings": {},
+        "total": round (total, 3)
+    }
 
-    ret_val = False
-    # We're looking for something like this:
-    # <uses-permission android:name="android.permission.INTERNET" />
-    android_name = "{http://schemas.android.com/apk/res/android}name"
+    out_dir.mkdir (parents = True, exist_ok = True)
+    (out_dir / "patch-summary.json").write_text (json.dumps (summary, indent = 2))
+
+    return summary
 
-    for permission in manifest_xml.findall ("uses-permission"):
-        if permission.attrib [android_name] == permission_name:
-            ret_val = True
 
-    return ret_val
+def patch_app_in_batch (base_path):
+    """
+    Patches a single app inside a batch worker (see run_patch_job()).
+
+    Returns
+        :dict
+        Summary of the process. With --metrics or --trace, the recorded events are returned under "events" too (but
+        they're not written to the file).
+    """
+    if METRICS is not None:
+        METRICS.app = base_path
+
+    summary = run_patch_job (
+            base_path,
+            BATCH_WORKER ["args"],
+            BATCH_WORKER ["keystore_data"],
+            BATCH_WORKER ["gadget_cache"],
+            BATCH_WORKER ["dex_cache"],
+            BATCH_WORKER ["split_cache"]
+        )
+
+    if METRICS is not None:
+        summary ["events"] = METRICS.pop_events ()
 
+    return summary
 
 
-def add_permission (manifest_xml, permission_name):
+def run_batch_pool (base_paths, args, workers, add_summary):
     """
-    Adds the specified permission to the given XML object (lxml.etree.Element or xml.etree.ElementTree), which is
-    expected to have the AndroidManifest.xml format (i.e.: the element "manifest" must at be the root).
+    Patches the given apps with a new pool of `workers` processes, and passes the summary of each one to add_summary().
 
-    The permission name must be the full one (i.e.: "android.permission.INTERNET", not just "INTERNET")
+    Only `workers` apps are submitted at a time. If a worker dies (e.g.: the JVM crashed, or the process was killed for
+    running out of memory), the pool is broken and can't be used anymore, but the only apps lost with it are the ones
+    that were being patched.
+
+    Returns
+        ([:str], [:str])
+        The apps that were being patched when the pool broke, and the ones that hadn't been submitted yet. Both lists
+        are empty if the pool didn't break.
     """
-    android_name = "{http://schemas.android.com/apk/res/android}name"
+    queue = list (base_paths)
+    running = {}
+    crashed = []
 
-    new_perm = etree.Element ("uses-permission")
-    new_perm.attrib [android_name] = permission_name
+    def collect (future):
+        base_path = running.pop (future)
+        try:
+            add_summary (future.result ())
 
-    # https://developer.android.com/guide/topics/manifest/uses-permission-element
-    # <uses-permission> is contained within <manifest>, which is the (assumed) root
-    # of manifest_xml
-    manifest_xml.append (new_perm)
+        except BrokenProcessPool:
+            crashed.append (base_path)
 
+        except Exception as e:
+            logger.error (f"Couldn't patch {base_path}: {e}")
+            add_summary (get_error_summary (base_path, e))
 
-def set_extract_native_libs (manifest_xml):
+    # The JVM doesn't survive a fork(), so the workers must be spawned
+    with ProcessPoolExecutor (
+            max_workers = workers,
+            mp_context = multiprocessing.get_context ("spawn"),
+            initializer = init_batch_worker,
+            initargs = (args,)
+        ) as pool:
+
+        while (queue or running) and not crashed:
+            try:
+                while queue and len (running) < workers:
+                    future = pool.submit (patch_app_in_batch, queue [0])
+                    running [future] = queue.pop (0)
+
+            except BrokenProcessPool:
+                # The pool broke between two apps. The next one is retried like the ones that were running
+                crashed.append (queue.pop (0))
+                break
+
+            done, _ = wait (running, return_when = FIRST_COMPLETED)
+            for future in done:
+                collect (future)
+
+        # Once broken, the pool fails the rest of the futures right away
+        for future in wait (running).done:
+            collect (future)
+
+    return crashed, queue
+
+
+def run_batch (argv):
     """
-    Parses the given XML object (lxml.etree.Element or xml.etree.ElementTree), which is
-    expected to have the AndroidManifest.xml format (i.e.: the element "application" must exist), and
-    sets the attribute `android:extractNativeLibs` to True, if it's not already set.
+    Entry point of the `batch` subcommand.
     """
-    android_extractNativeLibs = "{http://schemas.android.com/apk/res/android}extractNativeLibs"
+    global METRICS
 
-    for app in manifest_xml.findall ("application"):
-        if not app.attrib [android_extractNativeLibs] \
-            or app.attrib [android_extractNativeLibs] == "false":
+    args = parse_batch_args (argv)
+    setup_logging (args.verbose)
 
-            logger.debug ("android:extractNativeLibs was set to false. Patching...")
-            app.attrib [android_extractNativeLibs] = "true"
+    if args.metrics or args.trace:
+        METRICS = MetricsRecorder ()
+
+    base_paths = find_batch_apps (args.manifest)
+    if not base_paths:
+        logger.error (f"No apps found in {args.manifest}")
+        sys_exit (1)
+
+    logger.info (f"Patching {len (base_paths)} app(s) with {args.workers} worker(s)")
+
+    # Every worker has its own JVM and buffers, so each one gets its share of the budget
+    if args.max_memory:
+        args.max_memory = max (1, args.max_memory // args.workers)
+        logger.info (f"Memory budget per worker: {args.max_memory} MB")
+
+    summaries = []
+
+    def add_summary (summary):
+        events = summary.pop ("events", [])
+        if METRICS is not None:
+            METRICS.events.extend (events)
+
+        summaries.append (summary)
+        logger.info (f"[{len (summaries)}/{len (base_paths)}] {summary ['base_path']}: {summary ['status']} ({summary ['total']} s)")
 
+    queue = base_paths
+    while queue:
+        crashed, queue = run_batch_pool (queue, args, args.workers, add_summary)
+        if not crashed:
+            continue
 
+        # One of the apps that were being patched killed its worker, and the pool with it. Each one is retried alone,
+        # so a crash can only be its own, and the rest of the apps go on with a new pool
+        logger.warning (f"A worker process died. The apps that were being patched are retried one by one: {crashed}")
+        for base_path in crashed:
+            start = perf_counter ()
+            if run_batch_pool ([ base_path ], args, 1, add_summary) [0]:
+                logger.error (f"Couldn't patch {base_path}: its worker process died")
+                add_summary (get_error_summary (base_path, "The worker process died", perf_counter () - start))
 
-def fix_manifest (apk_path, out_path):
+    if args.summary:
+        args.summary.write_text ("".join (json.dumps (s) + "\n" for s in summaries))
+
+    if METRICS is not None:
+        METRICS.write (args.metrics, args.trace)
+
+    failed = [ s ["base_path"] for s in summaries if s ["status"] != "ok" ]
+    if failed:
+        logger.error (f"{len (failed)} app(s) couldn't be patched: {failed}")
+        sys_exit (1)
+
+    logger.success (f"[+] All done! {len (summaries)} app(s) patched")
+
+
+class ServiceBusy (Exception):
     """
-    Modifies the AndroidManifest.xml and packs it into out_path.
-    The following items are modified:
-        - Add `<uses-permission android:name="android.permission.INTERNET" />`, if not already present
-        - Add `extractNativeLibs=true`, if not already present
+    Raised by PatchService.submit() when a job can't be accepted right now (the queue is full, or the same app is
+    already being patched).
     """
 
-    with (
-        zipfile.ZipFile (apk_path, "r") as in_apk,
-        zipfile.ZipFile (out_path, "a") as out_apk
-    ):
-        for filename in in_apk.namelist ():
-            if filename != "AndroidManifest.xml":
-                copy_to_zip (in_apk, out_apk, filename)
-                continue
 
-            with in_apk.open (filename) as f:
-                axml, _ = pyaxml.AXML.from_axml (f.read ())
-                xml = axml.to_xml ()
+class PatchService:
+    """
+    Runs the jobs of the patch server (see run_server()) in a pool of threads of this same process, so all of them
+    share the JVM, the signing sessions and the caches.
 
-                inet_perm = "android.permission.INTERNET"
-                if not permission_exists (xml, inet_perm):
-                    logger.debug (f"No {inet_perm} permission.")
-                    logger.warning ("It's possible that the gadget has no internet connectivity. Check `logcat` for messages like `Frida: Failed to start: Unable to create socket: Operation not permitted`")
-                    # FIXME
- #                   add_permission (xml, inet_perm)
-                else:
-                    logger.debug (f"App has {inet_perm} permission.")
+    At most `workers` jobs run at the same time, and `queue_size` more can wait for their turn. Once both are full,
+    submit() refuses new jobs instead of queueing them without limit.
 
-                set_extract_native_libs (xml)
-#                print (etree.tostring (xml, pretty_print = True).decode ("utf-8"))
+    If `max_memory` (in MB) is provided, the jobs without their own --max-memory get an equal share of it per worker.
+    """
 
-                reencoded_axml = pyaxml.axml.AXML ()
-                reencoded_axml.from_xml (xml)
+    def __init__ (self, workers, queue_size, keystore_data, gadget_cache, dex_cache = None, split_cache = None,
+                  max_memory = None):
+        self.keystore_data = keystore_data
+        self.gadget_cache = gadget_cache
+        self.dex_cache = dex_cache
+        self.split_cache = split_cache
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_memory = max_memory
+        self.pool = ThreadPoolExecutor (max_workers = workers, thread_name_prefix = "job")
+        self.lock = threading.Lock ()
+        # Base paths of the jobs running or waiting
+        self.pending = set ()
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+
+
+    def status (self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "running": self.running,
+                "queued": len (self.pending) - self.running,
+                "done": self.done,
+                "failed": self.failed
+            }
+
+
+    def submit (self, args):
+        """
+        Queues a job with the given arguments (as returned by parse_args()).
+
+        Returns
+            :queue.Queue
+            The events of the job: { "event": "queued" }, then "start" and "end" for every stage (see timed()), and
+            { "event": "done", "summary": ... } (see run_patch_job()) at last. A None is put after the last one.
+
+        Raises
+            ServiceBusy, if the job can't be accepted.
+        """
+        import queue
+
+        base_path = args.base_path
+
+        if self.max_memory and not args.max_memory:
+            args.max_memory = max (1, self.max_memory // self.workers)
+
+        with self.lock:
+            if base_path in self.pending:
+                raise ServiceBusy (f"{base_path} is already being patched")
+
+            if len (self.pending) >= self.workers + self.queue_size:
+                raise ServiceBusy ("Too many jobs")
+
+            self.pending.add (base_path)
+            position = max (0, len (self.pending) - self.workers)
+
+        events = queue.Queue ()
+        events.put ({ "event": "queued", "base_path": base_path, "position": position })
+        self.pool.submit (self.run, args, events)
+
+        return events
+
+
+    def run (self, args, events):
+        with self.lock:
+            self.running += 1
+
+        PROGRESS.callback = events.put
+        try:
+            summary = run_patch_job (
+                    args.base_path,
+                    args,
+                    self.keystore_data,
+                    self.gadget_cache,
+                    self.dex_cache,
+                    self.split_cache
+                )
+        except Exception as e:
+            # e.g.: the summary couldn't be written. The client must get an answer anyway
+            logger.error (f"Job {args.base_path} failed: {e}")
+            summary = { "base_path": args.base_path, "status": "error", "error": str (e) }
 
-#                asdf, _ = pyaxml.AXML.from_axml (reencoded_axml.pack ())
-#                print ("============================")
-#                print (etree.tostring (asdf.to_xml (), pretty_print = True).decode ("utf-8"))
+        finally:
+            PROGRESS.callback = None
 
-            #################
-            # FIXME: seems to break the resulting AXML:
-            # $ aapt2 d xmltree --file AndroidManifest.xml patched_output/app-debug.apk
-            # ResourceType W 08-09 11:26:14 25258 25258] XML size 0x856 or headerSize 0x1c is not on an integer boundary.
-            # patched_output/app-debug.apk: error: failed to parse binary AndroidManifest.xml: failed to initialize ResXMLTree.
-            #
-            # For the moment, the original manifest ( `copy_to_zip (in_apk, out_apk, filename) ` ) is preserved
-            #################
+            with self.lock:
+                self.pending.discard (args.base_path)
+                self.running -= 1
 
-            info = in_apk.getinfo (filename)
-            copy_to_zip (in_apk, out_apk, filename, reencoded_axml.pack ())
-#            logger.warning ("[FIXME] Patching of the AndroidManifest.xml tends to fail. Discarding patch...")
-#            copy_to_zip (in_apk, out_apk, filename)
+        with self.lock:
+            self.done += 1
+            self.failed += summary ["status"] != "ok"
 
+        events.put ({ "event": "done", "summary": summary })
+        events.put (None)
 
-if __name__ == "__main__":
 
-    args = parse_args ()
-    OUT_DIR = OUT_DIR / (args.base_path + "patched")
+    def close (self):
+        """
+        Waits for the running jobs to finish, and drops the queued ones.
+        """
+        self.pool.shutdown (wait = True, cancel_futures = True)
 
-    verbosity = args.verbose
-    levels = [ "SUCCESS", "INFO", "DEBUG", "TRACE" ]
-    log_level = min ( len (levels) - 1, verbosity )
 
-    logger.remove () # Removes the Androguard logger
-    logger.add (
-        stdout,
-        format = "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level:<8}</level> | <level>{message}</level>",
-        filter = __name__,
-        level = levels [log_level],
-        colorize = True
-    )
+def make_server (address, service):
+    """
+    Creates the HTTP server of the patch service on the given address (see parse_serve_args()).
+    """
+    import http.server
+    import socketserver
+
+    class Handler (http.server.BaseHTTPRequestHandler):
+        # The events of every job are streamed until it's done, and then the connection is closed
+        protocol_version = "HTTP/1.0"
+
+        def address_string (self):
+            # The clients of a Unix socket have no address
+            return self.client_address [0] if self.client_address else "unix"
+
+        def log_message (self, format, *args):
+            logger.debug (f"[SERVER] {self.address_string ()} - {format % args}")
+
+        def send_json (self, code, data, headers = None):
+            body = (json.dumps (data) + "\n").encode ()
+            self.send_response (code)
+            self.send_header ("Content-Type", "application/json")
+            self.send_header ("Content-Length", str (len (body)))
+            for name, value in (headers or {}).items ():
+                self.send_header (name, value)
+            self.end_headers ()
+            self.wfile.write (body)
+
+        def do_GET (self):
+            if self.path != "/status":
+                self.send_json (404, { "error": "Not found" })
+                return
+
+            self.send_json (200, service.status ())
+
+        def do_POST (self):
+            if self.path != "/jobs":
+                self.send_json (404, { "error": "Not found" })
+                return
+
+            try:
+                request = json.loads (self.rfile.read (int (self.headers.get ("Content-Length", 0))))
+                argv = [ str (arg) for arg in request ["args"] ]
+            except (ValueError, KeyError, TypeError):
+                self.send_json (400, { "error": "The body must be a JSON object with the list of arguments in \"args\"" })
+                return
+
+            # parse_args() exits on invalid arguments (after logging the reason)
+            try:
+                args = parse_args (argv)
+            except SystemExit:
+                self.send_json (400, { "error": f"Invalid arguments: {argv}" })
+                return
+
+            if args.watch:
+                self.send_json (400, { "error": "--watch is not supported by the server" })
+                return
+
+            try:
+                events = service.submit (args)
+            except ServiceBusy as e:
+                self.send_json (503, { "error": str (e) }, { "Retry-After": "1" })
+                return
+
+            self.send_response (200)
+            self.send_header ("Content-Type", "application/x-ndjson")
+            self.end_headers ()
+
+            client_gone = False
+            while (event := events.get ()) is not None:
+                if client_gone:
+                    # The job goes on, even if nobody's listening anymore
+                    continue
+
+                try:
+                    self.wfile.write ((json.dumps (event) + "\n").encode ())
+                    self.wfile.flush ()
+                except OSError:
+                    client_gone = True
+
+    if address.startswith ("unix:"):
+        path = Path (address [len ("unix:"):])
+        path.unlink (missing_ok = True)
+
+        server = socketserver.ThreadingUnixStreamServer (str (path), Handler)
 
-    logger.info (f"Set debugging level to {levels [log_level]}")
+    else:
+        host, _, port = address.rpartition (":")
+        server = http.server.ThreadingHTTPServer ((host or "127.0.0.1", int (port)), Handler)
+
+    server.daemon_threads = True
+
+    return server
+
+
+def run_server (argv):
+    """
+    Entry point of the `serve` subcommand.
+    """
+    args = parse_serve_args (argv)
+    setup_logging (args.verbose)
+    set_memory_budget (args.max_memory)
 
-    ####
-    # Preparation of the environment
     keystore_data = base64.b64decode (KEYSTORE_B64)
-    # The patched items will be written to a modified version inside OUT_DIR
-    rmtree (OUT_DIR, ignore_errors = True)
-    OUT_DIR.mkdir (parents = True)
+    # The gadgets are small and few, so they're kept in memory too
+    gadget_cache = MemoryCache (FileCache (args.cache_dir / "gadgets", args.cache_size * 1024 * 1024))
+    dex_cache = FileCache (args.cache_dir / "dex", args.dex_cache_size * 1024 * 1024) if args.dex_cache_size > 0 else None
+    split_cache = (
+            FileCache (args.cache_dir / "splits", args.split_cache_size * 1024 * 1024) if args.split_cache_size > 0 else None
+        )
 
-    logger.info (f"Using {OUT_DIR} as working directory.")
-    ####
+    # Everything the jobs have in common is loaded before accepting the first one
+    logger.info ("Loading the Java patcher and the signing keys...")
+    for schemes in ([ "v2", "v3" ], [ "v1", "v2", "v3" ]):
+        get_signing_session (keystore_data, schemes)
 
-    # 1: Locate all files that belong to this app
-    parts = find_apk_parts (args.base_path)
-    logger.info (f"Found parts: {get_full_filelist (parts, True)}")
+    service = PatchService (
+            args.workers, args.queue_size, keystore_data, gadget_cache, dex_cache, split_cache, args.max_memory
+        )
+    server = make_server (args.listen, service)
 
-    main_apk_path = parts ["main"]
-    mod_apk_path = OUT_DIR / main_apk_path.name
+    logger.success (f"[+] Listening on {args.listen} with {args.workers} worker(s) (Ctrl+C to stop)")
 
-    # 2: Find the entry point(s)
-    entry_points = get_entry_points (main_apk_path)
+    try:
+        server.serve_forever ()
 
-    if not entry_points:
-        logger.error ("Couldn't locate the entry point")
-        sys_exit (-2)
+    except KeyboardInterrupt:
+        logger.info ("Stopping the server...")
 
-    logger.info (f"Found entry point(s): {entry_points}")
+    finally:
+        server.server_close ()
+        service.close ()
 
-    # 3: Patch the entrypoints' Bytecode
-    patched = patch_bytecode (main_apk_path, mod_apk_path, entry_points)
-    if not patched:
-        logger.critical ("Couldn't patch the Bytecode")
-        sys_exit (-3)
+        if args.listen.startswith ("unix:"):
+            Path (args.listen [len ("unix:"):]).unlink (missing_ok = True)
 
-    # 4: Download Frida and add it to the lib/ directory
-    frida_script = None
-    if args.frida_script:
-        frida_script = args.frida_script.read ()
-        logger.debug (f"Using the following Frida script:\n{frida_script.decode ('utf-8')}\n")
 
-    gadget_config = None
-    if args.gadget_config:
-        gadget_config = args.gadget_config.read ()
-        logger.debug (f"Using the following Gadget config:\n{gadget_config.decode ('utf-8')}\n")
+def run_verify (argv):
+    """
+    Entry point of the `verify` subcommand.
 
-    if "abi" in parts:
+    Returns
+        :int
+        The exit code: 0 if all the APKs are fine, 1 otherwise.
+    """
+    args = parse_verify_args (argv)
+    setup_logging (args.verbose)
 
-        for path in parts ["abi"]:
-            out_path = OUT_DIR / path.name
-            add_native_lib_to_apk (
-                    path,
-                    out_path,
-                    frida_script,
-                    forced_arch = args.arch,
-                    forced_dir = args.dir_lib
-                )
+    failed = False
+    for out_dir in args.out_dir:
+        report = verify_outputs (out_dir, so_alignment = args.page_size * 1024, jobs = args.jobs)
 
-    else:
-        # Support for single APKs (or APKs without native libs)
-        tmp_mod = mod_apk_path.with_suffix (".tmp")
-        add_native_lib_to_apk (
-                mod_apk_path,
-                tmp_mod,
-                frida_script,
-                forced_arch = args.arch,
-                forced_dir = args.dir_lib
-            )
-        move (tmp_mod, mod_apk_path)
+        for check, seconds in report ["timings"].items ():
+            logger.info (f"{out_dir.name}: {check} took {seconds:.3f} s")
 
-    # 5: Add extractNativeLibs=true to the AndroidManifest.xml, to
-    # extract the config
-    # Also, android.permission.INTERNET has to be added to allow the Gadget to open
-    # a socket (assuming that was the config)
-    if args.fix_manifest:
-        tmp_mod = mod_apk_path.with_suffix (".tmp")
-        fix_manifest (mod_apk_path, tmp_mod)
-        move (tmp_mod, mod_apk_path)
+        for error in report ["errors"]:
+            logger.error (error)
 
-    # 6: copy everything (even the items we haven't modified) to OUT_DIR
-    files = get_full_filelist (parts)
+        if report ["errors"]:
+            failed = True
+        else:
+            logger.success (f"[+] {out_dir} ({len (report ['apks'])} APKs) passed all the checks")
 
-    for f in files:
-        out_path = OUT_DIR / f.name
-        logger.debug (f"Processing {out_path}")
+    return 1 if failed else 0
 
-        if not out_path.exists ():
-            logger.debug (f"Copying unmodified file: {f}")
-            copy (f, out_path)
 
-    # 7: zipalign everything
-        logger.debug ("Zipaligning...")
-        Patcher.zipAlign (str (out_path))
+if __name__ == "__main__":
+
+    if len (sys.argv) > 1 and sys.argv [1] == "verify":
+        sys_exit (run_verify (sys.argv [2:]))
+
+    if len (sys.argv) > 1 and sys.argv [1] == "batch":
+        run_batch (sys.argv [2:])
+        sys_exit (0)
+
+    if len (sys.argv) > 1 and sys.argv [1] == "serve":
+        run_server (sys.argv [2:])
+        sys_exit (0)
+
+    args = parse_args ()
+    OUT_DIR = get_out_dir (args.base_path)
+
+    setup_logging (args.verbose)
+    set_memory_budget (args.max_memory)
+
+    keystore_data = base64.b64decode (KEYSTORE_B64)
+    gadget_cache = FileCache (args.cache_dir / "gadgets", args.cache_size * 1024 * 1024)
+    dex_cache = FileCache (args.cache_dir / "dex", args.dex_cache_size * 1024 * 1024) if args.dex_cache_size > 0 else None
+    split_cache = (
+            FileCache (args.cache_dir / "splits", args.split_cache_size * 1024 * 1024) if args.split_cache_size > 0 else None
+        )
+
+    if args.metrics or args.trace:
+        METRICS = MetricsRecorder ()
+        METRICS.app = args.base_path
+
+    try:
+        patch_app (
+            args.base_path,
+            OUT_DIR,
+            args,
+            keystore_data,
+            gadget_cache,
+            dex_cache = dex_cache,
+            split_cache = split_cache
+        )
 
-    # 8: sign everything
-        # We have to sign all parts with the same key, regardless of whether
-        # we modified them or not
-        logger.debug ("Signing...")
-        tmp_file = str (Patcher.signApk (str (out_path), keystore_data))
-        move (tmp_file, out_path)
+    except PatchError as e:
+        logger.critical (f"{e}")
+        sys_exit (e.exit_code)
+
+    finally:
+        # Also on error, to see where it failed
+        if METRICS is not None:
+            METRICS.write (args.metrics, args.trace)
 
     logger.success (f"[+] All done! The output APK can be found under {OUT_DIR}")
+
+    if args.watch:
+        watch (args, OUT_DIR, keystore_data)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Compares the ways of reading the entry points (and the rest of the facts needed by the patcher) from AndroidManifest.xml:
+    - tree: androguard's AXMLPrinter + XPath, as it was done before ManifestFacts (only if androguard is installed)
+    - pyaxml: pyaxml.AXML.from_axml () + to_xml (), which fix_manifest () used to do on every run
+    - scan: ManifestFacts, which walks the chunks once without building any tree
+
+Usage:
+    python benchmarks/bench_manifest.py [--activities N] [--repeat N]
+"""
+
+import argparse
+
+from common import best_of, load_apk_patcher, make_manifest
+
+
+ANDROID_NAME = "{http://schemas.android.com/apk/res/android}name"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser (description = "Tree-based vs. streaming parsing of AndroidManifest.xml")
+    parser.add_argument ("--activities", type = int, default = 2000, help = "Activities in the generated manifest")
+    parser.add_argument ("--repeat", type = int, default = 5, help = "Runs per measurement (the best one is kept)")
+    args = parser.parse_args ()
+
+    apk_patcher = load_apk_patcher ()
+    apk_patcher.logger.remove ()
+
+    manifest = make_manifest (args.activities)
+
+    def tree ():
+        from androguard.core.axml import AXMLPrinter
+
+        xml = AXMLPrinter (manifest).get_xml_obj ()
+        xpath = f".//activity/intent-filter/action[@{ANDROID_NAME}='android.intent.action.MAIN']/../.."
+        return [ activity.get (ANDROID_NAME) for activity in xml.findall (xpath) ]
+
+    def pyaxml ():
+        import pyaxml
+
+        axml, _ = pyaxml.AXML.from_axml (manifest)
+        return axml.to_xml ()
+
+    def scan ():
+        return apk_patcher.ManifestFacts (manifest).entry_points
+
+    modes = [ ("pyaxml", pyaxml), ("scan", scan) ]
+    try:
+        import androguard # noqa: F401
+        from loguru import logger
+        logger.remove ()
+        modes.insert (0, ("tree", tree))
+    except ImportError:
+        print ("androguard is not installed: skipping the 'tree' mode")
+
+    assert scan () == [ "com.example.Main" ]
+
+    print (f"\nManifest size: {len (manifest) / 1024:.1f} KB ({args.activities} activities)\n")
+    print (f"{'mode':<8} {'time (ms)':>10}")
+    for name, function in modes:
+        # Warm-up (imports)
+        function ()
+        print (f"{name:<8} {best_of (args.repeat, function) * 1000:>10.2f}")
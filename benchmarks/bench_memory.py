@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Patches a big synthetic app (see corpus.py) with `apk-patcher.py --max-memory` in a child process, and checks that the
+peak RSS of that process (JVM included) stays under the budget. Only on Linux.
+
+The defaults generate an app of ~400 MB: two dex files of ~40 MB each, and 192 MB of uncompressed entries in both the
+main APK and the ABI split. With --compare, the same app is patched without a budget too, to see the difference.
+
+The gadgets are downloaded from a local stand-in of the Frida releases (see frida_stub.py) before the child is started,
+so it runs with --offline.
+
+Usage:
+    python benchmarks/bench_memory.py [--max-memory MB] [--compare] [corpus options...]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from pathlib import Path
+
+from common import REPO_DIR, load_apk_patcher
+from corpus import add_corpus_arguments, corpus_options, make_corpus
+from frida_stub import ARCHITECTURES, FridaStub
+
+
+FRIDA_VERSION = "16.0.0"
+
+
+def run_patcher (base_path, cache_dir, max_memory = None):
+    """
+    Runs apk-patcher.py on the given app, and returns its exit code and its peak RSS (in Bytes).
+    """
+    command = [
+        sys.executable, str (REPO_DIR / "apk-patcher.py"), base_path,
+        "--offline", "--frida-version", FRIDA_VERSION, "--cache-dir", str (cache_dir)
+    ]
+    if max_memory:
+        command += [ "--max-memory", str (max_memory) ]
+
+    process = subprocess.Popen (command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    # The usage of this child only (ru_maxrss is in KB on Linux)
+    _, status, usage = os.wait4 (process.pid, 0)
+    # Already reaped, so Popen must not wait for it again
+    process.returncode = os.waitstatus_to_exitcode (status)
+
+    return process.returncode, usage.ru_maxrss * 1024
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser (description = "Peak RSS of the whole patcher under a --max-memory budget")
+    add_corpus_arguments (parser)
+    parser.set_defaults (dex = 2, classes = 100000, stored = 48, stored_size = 4 * 1024 * 1024)
+    parser.add_argument ("--max-memory", type = int, default = 1024, help = "Budget (in MB). Default: 1024")
+    parser.add_argument ("--compare", action = "store_true", help = "Also patch the app without a budget")
+    parser.add_argument ("--gadget-size", type = int, default = 20 * 1024 * 1024, help = "Size of the fake gadgets (Bytes)")
+    args = parser.parse_args ()
+
+    apk_patcher = load_apk_patcher ()
+    apk_patcher.logger.remove ()
+
+    with tempfile.TemporaryDirectory (prefix = "apk-patcher-bench-") as tmp:
+        tmp = Path (tmp)
+
+        options = corpus_options (args)
+        options ["apps"] = 1
+
+        print (f"Generating the app: {options}")
+        [ base_path ] = make_corpus (apk_patcher, tmp / "corpus", **options)
+        size = sum (path.stat ().st_size for path in (tmp / "corpus").glob ("*.apk"))
+
+        stub = FridaStub (versions = (FRIDA_VERSION,), gadget_size = args.gadget_size)
+        stub.patch (apk_patcher)
+        cache = apk_patcher.FileCache (tmp / "cache" / "gadgets")
+        apk_patcher.get_frida_gadgets (ARCHITECTURES, FRIDA_VERSION, cache = cache)
+        stub.close ()
+
+        runs = [ args.max_memory ] + ([ None ] if args.compare else [])
+        results = {}
+        for max_memory in runs:
+            results [max_memory] = run_patcher (base_path, tmp / "cache", max_memory)
+
+    print (f"\nApp size: {size / 1024 / 1024:.1f} MB")
+    print (f"{'budget (MB)':>12} {'exit code':>10} {'peak RSS (MB)':>14}")
+    for max_memory, (exit_code, peak) in results.items ():
+        print (f"{max_memory or 'none':>12} {exit_code:>10} {peak / 1024 / 1024:>14.1f}")
+
+    exit_code, peak = results [args.max_memory]
+    if exit_code != 0:
+        print (f"\nThe patcher failed with --max-memory {args.max_memory} (exit code {exit_code})")
+        sys.exit (1)
+
+    if peak > args.max_memory * 1024 * 1024:
+        print (f"\nThe peak RSS ({peak / 1024 / 1024:.1f} MB) is over the budget ({args.max_memory} MB)")
+        sys.exit (1)
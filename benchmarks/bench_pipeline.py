@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Runs every stage of the pipeline on a synthetic corpus (see corpus.py) and measures, for each one:
+    - Wall time (the best of --repeat runs, added up for all the apps)
+    - Throughput: MB processed by the stage per second
+    - Peak RSS of the process while the stage was running (JVM included). Only on Linux
+
+The stages are:
+    - manifest: read_manifest ()
+    - dex_locate: DexIndex of every dex file of the main APK, until the entry points are found
+    - dex_rewrite: java_patch_bytecode () on the dex files with entry points
+    - gadget: add_native_lib_to_apk () + append_to_apk () on every ABI split, with the gadgets downloaded from a local
+      stand-in of the Frida releases (see frida_stub.py)
+    - write_apk: write_apk () of the main APK, with the patched dex files
+    - align: zipalign of the parts that weren't modified
+    - sign: signature of all the parts
+
+With --save-baseline, the results are stored as the reference. Otherwise, they're compared with the baseline and the
+script fails when a stage is slower, or uses more memory, than allowed by --tolerance and --memory-tolerance.
+The baseline depends on the machine, so it isn't committed: it should be generated (with --save-baseline) on the same
+one where it's checked.
+
+Exit codes:
+    0: no regressions (or the baseline was saved)
+    1: regressions with respect to the baseline
+    2: the baseline was generated with other settings
+    3: there's no baseline to compare with
+
+Usage:
+    python benchmarks/bench_pipeline.py [--repeat N] [--baseline FILE] [--save-baseline]
+        [--tolerance X] [--memory-tolerance X] [--min-delta S] [corpus options...]
+"""
+
+import argparse
+import base64
+import json
+import sys
+import tempfile
+import zipfile
+
+from contextlib import contextmanager
+from pathlib import Path
+from shutil import copy
+from time import perf_counter, sleep
+
+from common import load_apk_patcher
+from corpus import add_corpus_arguments, corpus_options, make_corpus
+from frida_stub import FridaStub
+
+
+STAGES = [ "manifest", "dex_locate", "dex_rewrite", "gadget", "write_apk", "align", "sign" ]
+DEFAULT_BASELINE = Path (__file__).resolve ().parent / "baseline.json"
+
+
+def get_rss (field):
+    """
+    Returns the given field (VmRSS, VmHWM...) of /proc/self/status, in Bytes, or None if it's not available.
+    """
+    try:
+        with open ("/proc/self/status") as status:
+            for line in status:
+                if line.startswith (field + ":"):
+                    return int (line.split () [1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def reset_peak_rss ():
+    """
+    Resets the peak RSS (VmHWM) of the process to its current RSS, so the peak of every stage can be measured.
+    """
+    try:
+        with open ("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write ("5")
+    except OSError:
+        pass
+
+
+@contextmanager
+def measure (results, stage, size):
+    """
+    Measures the wall time and the peak RSS of the code within the context, and adds them to results [stage], with
+    the number of Bytes processed.
+    """
+    reset_peak_rss ()
+    start = perf_counter ()
+
+    yield
+
+    elapsed = perf_counter () - start
+    peak = get_rss ("VmHWM")
+
+    result = results.setdefault (stage, { "seconds": 0, "bytes": 0, "peak_rss": None })
+    result ["seconds"] += elapsed
+    result ["bytes"] += size
+    if peak is not None:
+        result ["peak_rss"] = max (result ["peak_rss"] or 0, peak)
+
+
+def run_pipeline (apk_patcher, base_path, out_dir, keystore_data, results):
+    """
+    Patches the app at base_path like patch_app() does (without the Frida script), measuring every stage.
+    """
+    out_dir.mkdir (parents = True)
+    so_alignment = 16 * 1024
+
+    parts = apk_patcher.find_apk_parts (base_path)
+    main_apk_path = parts ["main"]
+
+    with zipfile.ZipFile (main_apk_path) as apk:
+        manifest_size = apk.getinfo ("AndroidManifest.xml").file_size
+        dex_files = [ info for info in apk.infolist () if info.filename.endswith (".dex") ]
+
+    with measure (results, "manifest", manifest_size):
+        manifest = apk_patcher.read_manifest (main_apk_path)
+
+    # Dex file => (data, index, [(class, method)])
+    located = {}
+    pending = list (manifest.entry_points)
+
+    with measure (results, "dex_locate", sum (info.file_size for info in dex_files)):
+        with zipfile.ZipFile (main_apk_path) as apk:
+            for info in dex_files:
+                if not pending:
+                    break
+
+                data = apk.read (info)
+                index = apk_patcher.DexIndex (data)
+
+                targets = []
+                for name in list (pending):
+                    descriptor = index.find_class (name)
+                    if descriptor:
+                        pending.remove (name)
+                        targets.append ((descriptor, index.get_constructors (descriptor) [0]))
+
+                if targets:
+                    located [info.filename] = (data, index, targets)
+
+    overlays = {}
+    with measure (results, "dex_rewrite", sum (len (data) for data, _, _ in located.values ())):
+        for filename, (data, index, targets) in located.items ():
+            overlays [filename] = apk_patcher.java_patch_bytecode (data, index.version, targets)
+
+    assert overlays, f"Couldn't patch the entry points of {base_path}"
+
+    gadget_cache = apk_patcher.FileCache (out_dir / "cache")
+    with measure (results, "gadget", sum (path.stat ().st_size for path in parts.get ("abi", []))):
+        for path in parts.get ("abi", []):
+            libs = apk_patcher.add_native_lib_to_apk (path, cache = gadget_cache)
+            apk_patcher.append_to_apk (path, out_dir / path.name, libs, so_alignment = so_alignment)
+
+    with measure (results, "write_apk", main_apk_path.stat ().st_size):
+        apk_patcher.write_apk (main_apk_path, out_dir / main_apk_path.name, overlays, so_alignment = so_alignment)
+
+    files = apk_patcher.get_full_filelist (parts)
+    unmodified = [ path for path in files if not (out_dir / path.name).exists () ]
+
+    Patcher = apk_patcher.get_patcher ()
+    with measure (results, "align", sum (path.stat ().st_size for path in unmodified)):
+        for path in unmodified:
+            copy (path, out_dir / path.name)
+            Patcher.zipAlign (str (out_dir / path.name), 4, so_alignment)
+
+    schemes = [ "v2", "v3" ] + ([ "v1" ] if manifest.min_sdk < apk_patcher.V2_MIN_SDK else [])
+    signer = apk_patcher.get_signing_session (keystore_data, schemes)
+
+    with measure (results, "sign", sum ((out_dir / path.name).stat ().st_size for path in files)):
+        for path in files:
+            out_path = out_dir / path.name
+            tmp_path = out_path.with_name (f"{out_path.name}.signed.tmp")
+            signer.sign (str (out_path), str (tmp_path))
+            tmp_path.replace (out_path)
+
+
+def compare (results, baseline, tolerance, memory_tolerance, min_delta):
+    """
+    Returns the list of regressions (as printable strings) of the results with respect to the baseline.
+    """
+    regressions = []
+
+    for stage in STAGES:
+        current = results ["stages"].get (stage)
+        reference = baseline ["stages"].get (stage)
+        if not current or not reference:
+            continue
+
+        seconds, base_seconds = current ["seconds"], reference ["seconds"]
+        if seconds > base_seconds * (1 + tolerance) and seconds - base_seconds > min_delta:
+            regressions.append (f"{stage}: {seconds:.3f} s (baseline: {base_seconds:.3f} s)")
+
+        peak, base_peak = current ["peak_rss"], reference ["peak_rss"]
+        if peak and base_peak and peak > base_peak * (1 + memory_tolerance):
+            regressions.append (f"{stage}: peak RSS {peak / 1024 / 1024:.1f} MB (baseline: {base_peak / 1024 / 1024:.1f} MB)")
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser (description = "Per-stage benchmark of the whole pipeline, on a synthetic corpus")
+    add_corpus_arguments (parser)
+    parser.add_argument ("--repeat", type = int, default = 3, help = "Runs per app (the best one is kept)")
+    parser.add_argument ("--gadget-size", type = int, default = 4 * 1024 * 1024, help = "Size of the fake gadgets (Bytes)")
+    parser.add_argument ("--baseline", type = Path, default = DEFAULT_BASELINE, help = f"Default: {DEFAULT_BASELINE}")
+    parser.add_argument ("--save-baseline", action = "store_true", help = "Store the results as the new baseline")
+    parser.add_argument ("--tolerance", type = float, default = 0.25, help = "Allowed slowdown of every stage (0.25 = 25%%)")
+    parser.add_argument ("--memory-tolerance", type = float, default = 0.25, help = "Allowed growth of the peak RSS")
+    parser.add_argument ("--min-delta", type = float, default = 0.05,
+        help = "Slowdowns shorter than this (in seconds) are ignored, since they're just noise")
+    parser.add_argument ("--json", type = Path, help = "Also write the results to this file")
+    args = parser.parse_args ()
+
+    # Checked before the (long) run, so a CI job without a baseline fails right away instead of passing
+    if not args.save_baseline and not args.baseline.exists ():
+        print (f"No baseline to compare with ({args.baseline}). Use --save-baseline to create it")
+        sys.exit (3)
+
+    apk_patcher = load_apk_patcher ()
+    apk_patcher.logger.remove ()
+
+    stub = FridaStub (gadget_size = args.gadget_size)
+    stub.patch (apk_patcher)
+
+    keystore_data = base64.b64decode (apk_patcher.KEYSTORE_B64)
+    options = corpus_options (args)
+
+    with tempfile.TemporaryDirectory (prefix = "apk-patcher-bench-") as tmp:
+        tmp = Path (tmp)
+
+        print (f"Generating the corpus: {options}")
+        apps = make_corpus (apk_patcher, tmp / "corpus", **options)
+
+        # Warm-up (JVM, class loading, JIT...)
+        run_pipeline (apk_patcher, apps [0], tmp / "warmup", keystore_data, {})
+
+        # Best run of every stage, added up for all the apps
+        stages = {}
+        for i, base_path in enumerate (apps):
+            best = {}
+            for j in range (args.repeat):
+                # The JVM keeps compiling and collecting garbage for a while after every run, which slows down the
+                # first stages of the next one on machines with few cores
+                sleep (0.5)
+
+                results = {}
+                run_pipeline (apk_patcher, base_path, tmp / f"out-{i}-{j}", keystore_data, results)
+
+                for stage, result in results.items ():
+                    if stage not in best or result ["seconds"] < best [stage] ["seconds"]:
+                        best [stage] = result
+
+            for stage, result in best.items ():
+                total = stages.setdefault (stage, { "seconds": 0, "bytes": 0, "peak_rss": None })
+                total ["seconds"] += result ["seconds"]
+                total ["bytes"] += result ["bytes"]
+                if result ["peak_rss"] is not None:
+                    total ["peak_rss"] = max (total ["peak_rss"] or 0, result ["peak_rss"])
+
+    stub.close ()
+
+    for result in stages.values ():
+        result ["throughput"] = result ["bytes"] / result ["seconds"] if result ["seconds"] else 0
+
+    results = {
+        "corpus": options,
+        "gadget_size": args.gadget_size,
+        "stages": stages
+    }
+
+    print (f"\n{'stage':<12} {'time (s)':>9} {'MB':>8} {'MB/s':>9} {'peak RSS (MB)':>14}")
+    for stage in STAGES:
+        result = stages [stage]
+        peak = f"{result ['peak_rss'] / 1024 / 1024:.1f}" if result ["peak_rss"] else "n/a"
+        print (f"{stage:<12} {result ['seconds']:>9.3f} {result ['bytes'] / 1024 / 1024:>8.1f} "
+               f"{result ['throughput'] / 1024 / 1024:>9.1f} {peak:>14}")
+
+    if args.json:
+        args.json.write_text (json.dumps (results, indent = 2))
+
+    if args.save_baseline:
+        args.baseline.write_text (json.dumps (results, indent = 2))
+        print (f"\nBaseline saved to {args.baseline}")
+        sys.exit (0)
+
+    baseline = json.loads (args.baseline.read_text ())
+    settings = ("corpus", "gadget_size")
+    if any (baseline.get (key) != results [key] for key in settings):
+        print (f"\nThe baseline was generated with other settings: { { key: baseline.get (key) for key in settings } }")
+        sys.exit (2)
+
+    regressions = compare (results, baseline, args.tolerance, args.memory_tolerance, args.min_delta)
+    if regressions:
+        print ("\nREGRESSIONS:")
+        for regression in regressions:
+            print (f"    {regression}")
+        sys.exit (1)
+
+    print (f"\nNo regressions with respect to {args.baseline}")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Measures the startup cost of apk-patcher.py:
+    - Wall time of `-h` and of an app that fails on the first stage (find_apk_parts)
+    - Time until the first stage finishes on a real app (only with --base-path)
+    - Slowest imports, as reported by `python -X importtime`
+
+Usage:
+    python benchmarks/bench_startup.py [--base-path com.example.1234.] [--repeat N] [--top N]
+"""
+
+import argparse
+import subprocess
+import sys
+import tempfile
+
+from time import perf_counter
+
+from common import REPO_DIR
+
+
+SCRIPT = str (REPO_DIR / "apk-patcher.py")
+
+
+def run (args, repeat):
+    """
+    Returns the shortest wall time (in seconds) of `repeat` runs of the script with the given arguments.
+    """
+    times = []
+    for _ in range (repeat):
+        start = perf_counter ()
+        subprocess.run ([ sys.executable, SCRIPT ] + args, capture_output = True)
+        times.append (perf_counter () - start)
+
+    return min (times)
+
+
+def time_to_first_stage (base_path, repeat):
+    """
+    Returns the shortest time (in seconds) until the script logs the result of find_apk_parts().
+    The process is killed right after that, so nothing is written besides the (empty) output directory.
+    """
+    times = []
+    for _ in range (repeat):
+        start = perf_counter ()
+        with subprocess.Popen (
+                [ sys.executable, SCRIPT, "-v", base_path ],
+                stdout = subprocess.PIPE,
+                stderr = subprocess.DEVNULL,
+                text = True
+            ) as process:
+
+            for line in process.stdout:
+                if "Found parts" in line:
+                    times.append (perf_counter () - start)
+                    break
+
+            process.kill ()
+
+    return min (times) if times else float ("nan")
+
+
+def import_times (top):
+    """
+    Runs `python -X importtime apk-patcher.py -h` and returns the total import time and the `top` slowest top-level
+    imports, as [ (cumulative microseconds, module) ].
+    """
+    result = subprocess.run ([ sys.executable, "-X", "importtime", SCRIPT, "-h" ], capture_output = True, text = True)
+
+    total = 0
+    top_level = []
+    # Format: "import time: <self [us]> | <cumulative [us]> | <indentation><module>"
+    for line in result.stderr.splitlines ():
+        if not line.startswith ("import time:") or "self [us]" in line:
+            continue
+
+        self_us, cumulative_us, module = line [len ("import time:"):].split ("|")
+        total += int (self_us)
+
+        # The nested imports are indented with two extra spaces per level
+        if not module [1:].startswith (" "):
+            top_level.append ((int (cumulative_us), module.strip ()))
+
+    return total, sorted (top_level, reverse = True) [:top]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser (description = "Startup time of apk-patcher.py")
+    parser.add_argument ("--base-path", help = "App used to measure the time until the first stage is done")
+    parser.add_argument ("--repeat", type = int, default = 5, help = "Runs per measurement (the best one is kept)")
+    parser.add_argument ("--top", type = int, default = 10, help = "Number of imports to show")
+    args = parser.parse_args ()
+
+    with tempfile.TemporaryDirectory () as tmp:
+        print (f"{'-h':<32} {run (['-h'], args.repeat):>8.3f} s")
+        print (f"{'missing app (find_apk_parts)':<32} {run ([tmp + '/missing.'], args.repeat):>8.3f} s")
+
+    if args.base_path:
+        print (f"{'time to first stage':<32} {time_to_first_stage (args.base_path, args.repeat):>8.3f} s")
+
+    total, slowest = import_times (args.top)
+    print (f"\nTotal import time: {total / 1e6:.3f} s. Slowest top-level imports:")
+    for cumulative_us, module in slowest:
+        print (f"    {module:<40} {cumulative_us / 1e6:>8.3f} s")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Measures how long it takes to write the APKs modified by patch_bytecode(), add_native_lib_to_apk() and fix_manifest()
+when the untouched entries are:
+    - copied raw (current behaviour of copy_to_zip()); or
+    - decompressed and compressed again (previous behaviour).
+
+Usage:
+    python benchmarks/bench_zip_copy.py [--resources N] [--repeat N]
+"""
+
+import argparse
+import tempfile
+
+from pathlib import Path
+
+from common import load_apk_patcher, make_apk, best_of
+
+
+def recompress_copy_to_zip (handle_zip_original, handle_zip_new, filename, data = None, alignment = None):
+    """
+    Previous implementation of copy_to_zip(), which inflated and deflated every entry again.
+    """
+    info = handle_zip_original.getinfo (filename)
+
+    if data is None:
+        with handle_zip_original.open (filename) as zipped_file:
+            data = zipped_file.read ()
+
+    handle_zip_new.writestr (info, data)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser (description = "Raw copy vs. recompression of the untouched APK entries")
+    parser.add_argument ("--resources", type = int, default = 2000, help = "Number of compressed entries in the APK")
+    parser.add_argument ("--repeat", type = int, default = 3, help = "Runs per measurement (the best one is kept)")
+    args = parser.parse_args ()
+
+    apk_patcher = load_apk_patcher ()
+    raw_copy_to_zip = apk_patcher.copy_to_zip
+
+    # The entries each stage adds or replaces
+    stages = {
+        "patch_bytecode": { "classes.dex": bytes (2 * 1024 * 1024) },
+        "add_native_lib_to_apk": {
+            "lib/arm64-v8a/libgadget.so": bytes (20 * 1024 * 1024),
+            "lib/arm64-v8a/libgadget.js.so": b"console.log ('hi');"
+        },
+        "fix_manifest": { "AndroidManifest.xml": bytes (4096) }
+    }
+
+    with tempfile.TemporaryDirectory () as tmp:
+        apk = make_apk (Path (tmp) / "bench.apk", resources = args.resources)
+        out = Path (tmp) / "out.apk"
+
+        print (f"{'stage':<24} {'recompress (s)':>15} {'raw copy (s)':>13} {'speedup':>8}")
+
+        for stage, overlays in stages.items ():
+            apk_patcher.copy_to_zip = recompress_copy_to_zip
+            before = best_of (args.repeat, apk_patcher.write_apk, apk, out, overlays)
+
+            apk_patcher.copy_to_zip = raw_copy_to_zip
+            after = best_of (args.repeat, apk_patcher.write_apk, apk, out, overlays)
+
+            print (f"{stage:<24} {before:>15.3f} {after:>13.3f} {before / after:>7.1f}x")
@@ -0,0 +1,154 @@
+"""
+Helpers shared by the benchmarks.
+"""
+
+import importlib.util
+import random
+import zipfile
+
+from pathlib import Path
+from time import perf_counter
+
+
+REPO_DIR = Path (__file__).resolve ().parent.parent
+
+
+def load_apk_patcher ():
+    """
+    Imports apk-patcher.py as a module (its name has a dash, so it can't be imported the usual way).
+    """
+    spec = importlib.util.spec_from_file_location ("apk_patcher", REPO_DIR / "apk-patcher.py")
+    module = importlib.util.module_from_spec (spec)
+    spec.loader.exec_module (module)
+
+    return module
+
+
+def make_apk (path, resources = 2000, resource_size = 4096, stored = 20, stored_size = 256 * 1024, seed = 0):
+    """
+    Generates a reproducible APK-like Zip file with:
+        - A fake AndroidManifest.xml and classes.dex
+        - `resources` compressed entries (res/*.xml) of about `resource_size` Bytes, which compress like text does
+        - `stored` uncompressed entries (lib/arm64-v8a/*.so) of `stored_size` Bytes
+    """
+    rng = random.Random (seed)
+    words = [ rng.randbytes (rng.randint (2, 10)).hex ().encode () for _ in range (512) ]
+
+    def text (size):
+        return b" ".join (rng.choice (words) for _ in range (size // 8)) [:size]
+
+    with zipfile.ZipFile (path, "w", zipfile.ZIP_DEFLATED) as apk:
+        apk.writestr ("AndroidManifest.xml", text (4096))
+        apk.writestr ("classes.dex", rng.randbytes (2 * 1024 * 1024))
+
+        for i in range (resources):
+            apk.writestr (f"res/layout/r{i}.xml", text (resource_size))
+
+        for i in range (stored):
+            info = zipfile.ZipInfo (f"lib/arm64-v8a/lib{i}.so")
+            apk.writestr (info, rng.randbytes (stored_size))
+
+    return path
+
+
+def best_of (repeat, function, *args, **kwargs):
+    """
+    Runs the function `repeat` times and returns the shortest wall time, in seconds.
+    """
+    times = []
+    for _ in range (repeat):
+        start = perf_counter ()
+        function (*args, **kwargs)
+        times.append (perf_counter () - start)
+
+    return min (times)
+
+
+def make_dex (apk_patcher, classes = 20000, string_size = 256, main_class = "Lcom/example/Main;",
+              class_prefix = "Lcom/example/gen/C"):
+    """
+    Generates a valid dex file with `classes` classes (named `class_prefix` + number), plus `main_class` (if it's not
+    None), each one with a constructor that loads a string of `string_size` characters, so the size of the file can be
+    controlled.
+    Requires the JVM, which is started with apk_patcher.get_patcher().
+
+    Returns
+        :bytes
+    """
+    apk_patcher.get_patcher ()
+
+    from com.android.tools.smali.dexlib2 import Opcode, Opcodes
+    from com.android.tools.smali.dexlib2.immutable import (
+        ImmutableClassDef, ImmutableMethod, ImmutableMethodImplementation, ImmutableDexFile
+    )
+    from com.android.tools.smali.dexlib2.immutable.instruction import (
+        ImmutableInstruction10x, ImmutableInstruction21c, ImmutableInstruction35c
+    )
+    from com.android.tools.smali.dexlib2.immutable.reference import ImmutableMethodReference, ImmutableStringReference
+    from com.android.tools.smali.dexlib2.writer.io import MemoryDataStore
+    from com.android.tools.smali.dexlib2.writer.pool import DexPool
+    from java.util import ArrayList, HashSet
+
+    super_init = ImmutableMethodReference ("Ljava/lang/Object;", "<init>", ArrayList (), "V")
+
+    def make_class (name, i):
+        # const-string v0, "<padding>"; invoke-direct {p0}, Object-><init>(); return-void
+        instructions = ArrayList ()
+        instructions.add (ImmutableInstruction21c (Opcode.CONST_STRING, 0, ImmutableStringReference (f"{i:x}".rjust (string_size, "x"))))
+        instructions.add (ImmutableInstruction35c (Opcode.INVOKE_DIRECT, 1, 1, 0, 0, 0, 0, super_init))
+        instructions.add (ImmutableInstruction10x (Opcode.RETURN_VOID))
+
+        implementation = ImmutableMethodImplementation (2, instructions, None, None)
+        # 0x10001 -> public constructor
+        methods = ArrayList ()
+        methods.add (ImmutableMethod (name, "<init>", ArrayList (), "V", 0x10001, HashSet (), HashSet (), implementation))
+
+        return ImmutableClassDef (name, 1, "Ljava/lang/Object;", None, None, HashSet (), ArrayList (), methods)
+
+    class_defs = ArrayList ()
+    if main_class:
+        class_defs.add (make_class (main_class, -1))
+    for i in range (classes):
+        class_defs.add (make_class (f"{class_prefix}{i};", i))
+
+    store = MemoryDataStore ()
+    DexPool.writeTo (store, ImmutableDexFile (Opcodes.getDefault (), class_defs))
+
+    return bytes (store.getBuffer ()) [:store.getSize ()]
+
+
+def make_manifest (activities = 500, package = "com.example", main_activity = "com.example.Main"):
+    """
+    Generates a binary AndroidManifest.xml (AXML) with `activities` activities, each one with an intent-filter, plus
+    `main_activity` (the only one with the MAIN action).
+    Requires pyaxml and lxml.
+
+    Returns
+        :bytes
+    """
+    import pyaxml.axml
+    from lxml import etree
+
+    android = "http://schemas.android.com/apk/res/android"
+    name = f"{{{android}}}name"
+
+    manifest = etree.Element ("manifest", nsmap = { "android": android }, package = package)
+    etree.SubElement (manifest, "uses-sdk", { f"{{{android}}}minSdkVersion": "21" })
+    etree.SubElement (manifest, "uses-permission", { name: "android.permission.INTERNET" })
+    application = etree.SubElement (manifest, "application", { f"{{{android}}}extractNativeLibs": "false" })
+
+    def add_activity (activity_name, action):
+        activity = etree.SubElement (application, "activity", { name: activity_name })
+        intent_filter = etree.SubElement (activity, "intent-filter")
+        etree.SubElement (intent_filter, "action", { name: action })
+        etree.SubElement (intent_filter, "category", { name: "android.intent.category.DEFAULT" })
+
+    for i in range (activities):
+        add_activity (f"{package}.gen.Activity{i}", "android.intent.action.VIEW")
+
+    add_activity (main_activity, "android.intent.action.MAIN")
+
+    axml = pyaxml.axml.AXML ()
+    axml.from_xml (manifest)
+
+    return axml.pack ()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Generates reproducible synthetic split APKs, to benchmark the whole pipeline without real apps:
+    - <name>.apk: AndroidManifest.xml, `dex` dex files (the entry point is in the last one), resources.arsc and
+      `resources` compressed entries, plus `stored` uncompressed assets
+    - <name>.config.<abi>.apk: `stored` uncompressed native libraries
+    - <name>.config.<density>.apk and <name>.config.<lang>.apk: a manifest and a resources.arsc
+
+The same arguments (and seed) always generate the same files, byte by byte.
+
+Usage:
+    python benchmarks/corpus.py OUT_DIR [--apps N] [--dex N] [--classes N] [--resources N] [--stored N] ...
+"""
+
+import argparse
+import random
+import zipfile
+
+from pathlib import Path
+
+from common import load_apk_patcher, make_dex, make_manifest
+
+
+def add_entry (apk, name, data, stored = False):
+    """
+    Adds an entry with a fixed timestamp, so the output doesn't depend on when it was generated.
+    """
+    info = zipfile.ZipInfo (name)
+    info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+    apk.writestr (info, data)
+
+
+def make_app (apk_patcher, out_dir, package = "com.example.app", dex = 2, classes = 2000, resources = 500,
+              resource_size = 4096, stored = 4, stored_size = 256 * 1024, abis = ("arm64_v8a",),
+              densities = ("xxhdpi",), langs = ("en",), seed = 0):
+    """
+    Generates a split APK in `out_dir`.
+
+    Args
+        apk_patcher: module
+            apk-patcher.py, as returned by load_apk_patcher(). Its JVM is used to generate the dex files.
+
+        package: str
+            Package name, which is also the name of the files.
+
+        dex: int
+            Number of dex files, with `classes` classes each.
+
+        resources, resource_size: int
+            Number and size (in Bytes) of the compressed entries (res/*.xml), which compress like text does.
+
+        stored, stored_size: int
+            Number and size (in Bytes) of the uncompressed entries in the main APK (assets/) and in every ABI split
+            (lib/<abi>/*.so).
+
+        abis, densities, langs: [str]
+            Suffixes of the config splits (e.g.: "arm64_v8a", "xxhdpi", "en").
+
+        seed: int
+            Seed for the random contents.
+
+    Returns
+        :str
+        The base path of the app (e.g.: "<out_dir>/com.example.app."), as expected by apk-patcher.py.
+    """
+    out_dir = Path (out_dir)
+    out_dir.mkdir (parents = True, exist_ok = True)
+
+    rng = random.Random (seed)
+    words = [ rng.randbytes (rng.randint (2, 10)).hex ().encode () for _ in range (512) ]
+
+    def text (size):
+        return b" ".join (rng.choice (words) for _ in range (size // 8)) [:size]
+
+    main_class = f"L{package.replace ('.', '/')}/Main;"
+    manifest = make_manifest (activities = 50, package = package, main_activity = f"{package}.Main")
+    split_manifest = make_manifest (activities = 0, package = package, main_activity = f"{package}.Main")
+
+    base = out_dir / f"{package}."
+
+    with zipfile.ZipFile (f"{base}apk", "w") as apk:
+        add_entry (apk, "AndroidManifest.xml", manifest)
+
+        for i in range (dex):
+            last = i == dex - 1
+            data = make_dex (
+                    apk_patcher,
+                    classes,
+                    main_class = main_class if last else None,
+                    class_prefix = f"L{package.replace ('.', '/')}/gen{i}/C"
+                )
+            add_entry (apk, "classes.dex" if i == 0 else f"classes{i + 1}.dex", data)
+
+        add_entry (apk, "resources.arsc", rng.randbytes (64 * 1024), stored = True)
+
+        for i in range (resources):
+            add_entry (apk, f"res/layout/r{i}.xml", text (resource_size))
+
+        for i in range (stored):
+            add_entry (apk, f"assets/blob{i}.bin", rng.randbytes (stored_size), stored = True)
+
+    for abi in abis:
+        with zipfile.ZipFile (f"{base}config.{abi}.apk", "w") as apk:
+            add_entry (apk, "AndroidManifest.xml", split_manifest)
+
+            for i in range (stored):
+                add_entry (apk, f"lib/{abi.replace ('_', '-')}/lib{i}.so", rng.randbytes (stored_size), stored = True)
+
+    for config in (*densities, *langs):
+        with zipfile.ZipFile (f"{base}config.{config}.apk", "w") as apk:
+            add_entry (apk, "AndroidManifest.xml", split_manifest)
+            add_entry (apk, "resources.arsc", rng.randbytes (16 * 1024), stored = True)
+
+    return str (base)
+
+
+def make_corpus (apk_patcher, out_dir, apps = 1, seed = 0, **kwargs):
+    """
+    Generates `apps` split APKs (see make_app() for the rest of the arguments), each one with its own package name
+    and seed.
+
+    Returns
+        [:str]
+        The base paths of the apps.
+    """
+    return [
+        make_app (apk_patcher, out_dir, package = f"com.example.app{i}", seed = seed + i, **kwargs)
+        for i in range (apps)
+    ]
+
+
+def add_corpus_arguments (parser):
+    """
+    Adds the options of make_corpus() to the given parser.
+    """
+    parser.add_argument ("--apps", type = int, default = 1, help = "Number of apps")
+    parser.add_argument ("--dex", type = int, default = 2, help = "Dex files per app")
+    parser.add_argument ("--classes", type = int, default = 2000, help = "Classes per dex file (~380 Bytes each)")
+    parser.add_argument ("--resources", type = int, default = 500, help = "Compressed entries per app")
+    parser.add_argument ("--resource-size", type = int, default = 4096, help = "Size of the compressed entries (Bytes)")
+    parser.add_argument ("--stored", type = int, default = 4, help = "Uncompressed entries per APK")
+    parser.add_argument ("--stored-size", type = int, default = 256 * 1024, help = "Size of the uncompressed entries (Bytes)")
+    parser.add_argument ("--seed", type = int, default = 0, help = "Seed for the random contents")
+
+
+def corpus_options (args):
+    """
+    Returns the options of make_corpus() from the arguments parsed with add_corpus_arguments().
+    """
+    return {
+        "apps": args.apps,
+        "dex": args.dex,
+        "classes": args.classes,
+        "resources": args.resources,
+        "resource_size": args.resource_size,
+        "stored": args.stored,
+        "stored_size": args.stored_size,
+        "seed": args.seed
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser (description = "Generates reproducible synthetic split APKs")
+    parser.add_argument ("out_dir", type = Path, help = "Directory where the APKs are written")
+    add_corpus_arguments (parser)
+    args = parser.parse_args ()
+
+    apk_patcher = load_apk_patcher ()
+    apk_patcher.logger.remove ()
+
+    for base_path in make_corpus (apk_patcher, args.out_dir, **corpus_options (args)):
+        print (base_path)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the GitHub API of the Frida releases, so the benchmarks can download gadgets offline.
+
+It serves:
+    - /releases/latest and /releases/tags/<version>: the release metadata, with the same fields as GitHub
+    - /download/<asset>: fake gadgets (random data of the requested size), compressed with xz
+
+Usage (standalone, to point FRIDA_ASSETS_URL and FRIDA_TAG_URL to it by hand):
+    python benchmarks/frida_stub.py [--port N] [--gadget-size N]
+"""
+
+import argparse
+import hashlib
+import json
+import lzma
+import random
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+ARCHITECTURES = [ "arm", "arm64", "x86", "x86_64" ]
+
+
+class FridaStub:
+    """
+    HTTP server with the releases of the given Frida versions, running on a background thread.
+    The last version is returned as the latest one.
+    """
+
+    def __init__ (self, versions = ("16.0.0",), gadget_size = 1024 * 1024, port = 0, seed = 0):
+        rng = random.Random (seed)
+
+        # Name of the asset => xz data
+        self.assets = {}
+        for version in versions:
+            for arch in ARCHITECTURES:
+                # Half random and half zeros, so it compresses about as well as a real library
+                gadget = rng.randbytes (gadget_size // 2) + bytes (gadget_size - gadget_size // 2)
+                self.assets [f"frida-gadget-{version}-android-{arch}.so.xz"] = lzma.compress (
+                        gadget,
+                        format = lzma.FORMAT_XZ,
+                        preset = 0
+                    )
+
+        self.versions = list (versions)
+        self.server = ThreadingHTTPServer (("127.0.0.1", port), self.get_handler ())
+        self.url = f"http://127.0.0.1:{self.server.server_address [1]}"
+        # Number of requests received, to check whether the cache was used
+        self.requests = 0
+
+        self.thread = threading.Thread (target = self.server.serve_forever, daemon = True)
+        self.thread.start ()
+
+
+    def get_release (self, version):
+        """
+        Returns the metadata of the release, as GitHub does.
+        """
+        assets = []
+        for name, data in self.assets.items ():
+            if f"-{version}-" in name:
+                assets.append ({
+                    "name": name,
+                    "size": len (data),
+                    "digest": "sha256:" + hashlib.sha256 (data).hexdigest (),
+                    "browser_download_url": f"{self.url}/download/{name}"
+                })
+
+        return { "tag_name": version, "assets": assets }
+
+
+    def get_handler (self):
+        stub = self
+
+        class Handler (BaseHTTPRequestHandler):
+
+            def do_GET (self):
+                stub.requests += 1
+
+                if self.path == "/releases/latest":
+                    body = json.dumps (stub.get_release (stub.versions [-1])).encode ()
+                elif self.path.startswith ("/releases/tags/") and self.path.rsplit ("/", 1) [1] in stub.versions:
+                    body = json.dumps (stub.get_release (self.path.rsplit ("/", 1) [1])).encode ()
+                elif self.path.startswith ("/download/") and self.path.rsplit ("/", 1) [1] in stub.assets:
+                    body = stub.assets [self.path.rsplit ("/", 1) [1]]
+                else:
+                    self.send_error (404)
+                    return
+
+                self.send_response (200)
+                self.send_header ("Content-Length", str (len (body)))
+                self.end_headers ()
+                self.wfile.write (body)
+
+            def log_message (self, format, *args):
+                pass
+
+        return Handler
+
+
+    def patch (self, apk_patcher):
+        """
+        Points the given apk-patcher module to this server, instead of GitHub.
+        """
+        apk_patcher.FRIDA_ASSETS_URL = f"{self.url}/releases/latest"
+        apk_patcher.FRIDA_TAG_URL = f"{self.url}/releases/tags/{{version}}"
+
+
+    def close (self):
+        self.server.shutdown ()
+        self.server.server_close ()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser (description = "Local stand-in for the GitHub API of the Frida releases")
+    parser.add_argument ("--port", type = int, default = 8765, help = "Port to listen on")
+    parser.add_argument ("--gadget-size", type = int, default = 20 * 1024 * 1024, help = "Size of the fake gadgets (Bytes)")
+    parser.add_argument ("--version", action = "append", help = "Frida version to serve. Can be given many times")
+    args = parser.parse_args ()
+
+    stub = FridaStub (args.version or [ "16.0.0" ], args.gadget_size, args.port)
+    print (f"Serving on {stub.url}")
+    print (f"    FRIDA_ASSETS_URL = \"{stub.url}/releases/latest\"")
+    print (f"    FRIDA_TAG_URL = \"{stub.url}/releases/tags/{{version}}\"")
+
+    try:
+        stub.thread.join ()
+    except KeyboardInterrupt:
+        stub.close ()